@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
 
-import os
+import dataclasses
+import getpass
+import json
 import re
 import secrets
-import signal
-import subprocess
+import shlex
 import sys
-import tempfile
-import threading
 import time
 from collections.abc import Callable
 from enum import Enum
@@ -16,13 +15,29 @@ from pathlib import Path
 from typing import Any, Literal
 from urllib.parse import urlparse
 
-import psutil
-
 try:
     # This fails when the code is executed directly and not as a part of python package installation,
     # I definitely need a better way to handle this.
     # asyncio was introduced in version 3.5
-    from adbe import asyncio_helper
+    from adbe import (
+        apk_signature_helper,
+        asyncio_helper,
+        backup_helper,
+        device_info_helper,
+        device_tracker_helper,
+        framestats_helper,
+        install_helper,
+        listing_helper,
+        meminfo_helper,
+        scratch_helper,
+        screenrecord_helper,
+        screenshot_diff_helper,
+        screenshot_helper,
+        snapshot_helper,
+        sqlite_helper,
+        startup_helper,
+        transfer_helper,
+    )
     from adbe.adb_helper import (
         execute_adb_command2,
         execute_adb_shell_command,
@@ -30,8 +45,12 @@ try:
         execute_file_related_adb_shell_command,
         get_adb_shell_property,
         get_device_android_api_version,
+        get_file_related_shell_command,
         get_package,
+        is_compression_enabled,
         root_required_to_access_file,
+        start_adb_command,
+        stream_adb_shell_command,
         toggle_screen,
     )
     from adbe.output_helper import (
@@ -44,7 +63,23 @@ try:
 except ModuleNotFoundError:
     # This works when the code is executed directly.
     # noinspection PyUnresolvedReferences
+    import apk_signature_helper
     import asyncio_helper
+    import backup_helper
+    import device_info_helper
+    import device_tracker_helper
+    import framestats_helper
+    import install_helper
+    import listing_helper
+    import meminfo_helper
+    import scratch_helper
+    import screenrecord_helper
+    import screenshot_diff_helper
+    import screenshot_helper
+    import snapshot_helper
+    import sqlite_helper
+    import startup_helper
+    import transfer_helper
     from adb_helper import (
         execute_adb_command2,
         execute_adb_shell_command,
@@ -52,8 +87,12 @@ except ModuleNotFoundError:
         execute_file_related_adb_shell_command,
         get_adb_shell_property,
         get_device_android_api_version,
+        get_file_related_shell_command,
         get_package,
+        is_compression_enabled,
         root_required_to_access_file,
+        start_adb_command,
+        stream_adb_shell_command,
         toggle_screen,
     )
 
@@ -85,6 +124,16 @@ _USER_PRINT_VALUE_UNKNOWN = "unknown"
 # Value to be return as 'auto' to the user
 _USER_PRINT_VALUE_AUTO = "auto"
 
+# Large enough to keep up with the link, small enough to show --follow output promptly
+_CAT_BUFFER_SIZE = 64 * 1024
+# How long "disable wireless debugging" waits for the adb server to drop a disconnected device
+_WIRELESS_DISCONNECT_TIMEOUT_SECONDS = 5
+# The foreground activity is polled every 100 ms at first, backing off to once a second
+_MIN_ACTIVITY_POLL_INTERVAL_SECONDS = 0.1
+_MAX_ACTIVITY_POLL_INTERVAL_SECONDS = 1.0
+_APP_LAUNCH_TIMEOUT_SECONDS = 10
+_BACKUP_CONFIRMATION_TIMEOUT_SECONDS = 30
+
 SCREEN_ON = 1
 SCREEN_OFF = 2
 SCREEN_TOGGLE = 3
@@ -384,8 +433,11 @@ def get_battery_reset_cmd() -> str:
     return "dumpsys battery reset"
 
 
+# With framestats, the timings of every frame rendered in the next duration_seconds seconds are sampled and
+# summarized, and optionally saved as CSV.
 @ensure_package_exists
-def handle_get_jank(app_name: str) -> None:
+def handle_get_jank(app_name: str, *, framestats: bool = False, duration_seconds: float = 10,
+                    csv_file_path: str | None = None) -> None:
     running = _is_app_running(app_name)
     if not running:
         # Jank information cannot be fetched unless the app is running
@@ -393,6 +445,9 @@ def handle_get_jank(app_name: str) -> None:
         launch_app(app_name)
 
     try:
+        if framestats:
+            _print_framestats(app_name, duration_seconds, csv_file_path)
+            return
         cmd = f"dumpsys gfxinfo {app_name} "
         return_code, result, _ = execute_adb_shell_command2(cmd)
         print_verbose(result)
@@ -412,6 +467,51 @@ def handle_get_jank(app_name: str) -> None:
             force_stop(app_name)
 
 
+# Measures how long the app takes to start, with "am start -W", over several runs
+@ensure_package_exists
+def benchmark_startup(app_name: str, *, runs: int = 10, mode: str = "cold", drop_caches: bool = False) -> None:
+    # "cmd package resolve-activity" is only available on API 24 and above
+    _error_if_min_version_less_than(24)
+    if runs < 1:
+        print_error_and_exit(f"The number of runs must be at least 1, it is {runs:d}")
+    if drop_caches and mode != "cold":
+        print_error_and_exit("The caches can only be dropped before a cold start")
+    startup_times = startup_helper.measure_startup(app_name, runs=runs, mode=mode, drop_caches=drop_caches)
+    if not startup_times:
+        print_error_and_exit(f"All the {runs:d} runs of {app_name} failed")
+    startup_helper.print_startup_summary(app_name, mode, startup_times)
+
+
+# Samples the memory usage of the running app, e.g. during a soak test, and summarizes its trend
+@ensure_package_exists
+def handle_meminfo(app_name: str, *, duration_seconds: float = 10, period_seconds: float = 5,
+                   csv_file_path: str | None = None, json_output: bool = False) -> None:
+    if period_seconds <= 0:
+        print_error_and_exit(f"The sampling period must be positive, it is {period_seconds:g}")
+    samples = meminfo_helper.sample_memory(app_name, duration_seconds=duration_seconds,
+                                           interval_seconds=period_seconds, json_output=json_output)
+    if not samples:
+        print_error_and_exit(f"No memory usage of {app_name} was sampled")
+    if csv_file_path is not None:
+        meminfo_helper.write_samples_csv(samples, csv_file_path)
+        print_verbose(f"Saved {len(samples):d} samples to {csv_file_path}")
+    # The summary would make the output invalid JSON lines
+    if not json_output:
+        meminfo_helper.print_memory_trend(app_name, samples)
+
+
+def _print_framestats(app_name: str, duration_seconds: float, csv_file_path: str | None) -> None:
+    print_message(f"Sampling the frames of {app_name} for {duration_seconds:g} seconds...")
+    frames = framestats_helper.sample_frames(app_name, duration_seconds)
+    if not frames:
+        print_error_and_exit(f"{app_name} rendered no frames in {duration_seconds:g} seconds, "
+                             "is anything animating or being scrolled?")
+    framestats_helper.print_frame_summary(app_name, framestats_helper.get_frame_summary(frames))
+    if csv_file_path is not None:
+        framestats_helper.write_frames_csv(frames, csv_file_path)
+        print_message(f"Saved the timings of {len(frames):d} frames to {csv_file_path}")
+
+
 def _is_app_running(app_name: str) -> bool:
     return_code, result, _ = execute_adb_shell_command2("ps -o NAME")
     if return_code != 0 or not result:
@@ -420,72 +520,44 @@ def _is_app_running(app_name: str) -> bool:
     return result.find(app_name) != -1
 
 
-def handle_list_devices() -> None:
-    device_serials = _get_device_serials()
+def handle_list_devices(*, json_output: bool = False) -> None:
+    device_serials = get_device_serials()
 
     if not device_serials:
         print_error_and_exit("No attached Android device found")
 
-    for device_serial in device_serials:
-        _print_device_info(device_serial)
-
+    # One batched shell command per device, all the devices are queried at the same time
+    device_summaries = asyncio_helper.execute_in_parallel(device_info_helper.get_device_summary, device_serials)
+    for device_summary in device_summaries:
+        if json_output:
+            print_message(json.dumps(dataclasses.asdict(device_summary)))
+        else:
+            _print_device_summary(device_summary)
 
-def _get_device_serials() -> list[str]:
-    cmd = "devices -l"
-    return_code, stdout, stderr = execute_adb_command2(cmd)
-    if return_code != 0:
-        print_error_and_exit(f"Failed to execute command {cmd}, error: {stderr} ")
 
+def get_device_serials() -> list[str]:
     device_serials = []
-    # Skip the first line, it says "List of devices attached"
-    device_infos = stdout.split("\n")[1:]
-
-    if len(device_infos) == 0 or (
-            len(device_infos) == 1 and len(device_infos[0]) == 0):
-        return []
-
-    if len(device_infos) == 1:
-        device_serial = device_infos[0].split(" ")[0]
-        device_serials.append(device_serial)
-        return device_serials
-
-    for device_info in device_infos:
-        if not device_info:
-            continue
-        device_serial = device_info.split()[0]
-        if "unauthorized" in device_info:
+    for device in device_tracker_helper.get_device_list():
+        if device.state == device_tracker_helper.DEVICE_STATE_UNAUTHORIZED:
+            device_details = " ".join([device.state, *(f"{key}:{value}" for key, value in device.properties.items())])
             print_error(
-                f'Unlock Device "{device_serial}" and give USB debugging access to '
+                f'Unlock Device "{device.serial}" and give USB debugging access to '
                 "this PC/Laptop by unlocking and reconnecting "
-                f'the device. More info about this device: "{" ".join(device_info.split()[1:])}"\n')
+                f'the device. More info about this device: "{device_details}"\n')
         else:
-            device_serials.append(device_serial)
+            device_serials.append(device.serial)
     return device_serials
 
 
-def _print_device_info(device_serial: str | None = None) -> None:
-    manufacturer = get_adb_shell_property("ro.product.manufacturer", device_serial=device_serial)
-    model = get_adb_shell_property("ro.product.model", device_serial=device_serial)
-    # This worked on 4.4.3 API 19 Moto E
-    display_name = get_adb_shell_property("ro.product.display", device_serial=device_serial)
-
-    # First fallback: undocumented
-    if ((not display_name or display_name == "null")
-            and get_device_android_api_version(device_serial=device_serial) >= 19):
-        # This works on 4.4.4 API 19 Galaxy Grand Prime
-        display_name = execute_adb_shell_settings_command("get system device_name", device_serial=device_serial)
-
-    # Second fallback, documented to work on API 25 and above
-    # Source: https://developer.android.com/reference/android/provider/Settings.Global.html#DEVICE_NAME
-    if (not display_name or display_name == "null") and get_device_android_api_version(device_serial=device_serial) >= 25:
-        display_name = execute_adb_shell_settings_command("get global device_name", device_serial=device_serial)
-
-    # ABI info
-    abi = get_adb_shell_property("ro.product.cpu.abi", device_serial=device_serial)
-    release = get_adb_shell_property("ro.build.version.release", device_serial=device_serial)
-    sdk = get_adb_shell_property("ro.build.version.sdk", device_serial=device_serial)
+def _print_device_summary(device_summary: device_info_helper.DeviceSummary) -> None:
+    battery_level = f"{device_summary.battery_level:d}%" if device_summary.battery_level is not None else None
+    storage_free = (f"{device_summary.storage_free_bytes / 1024 ** 3:.1f} GB"
+                    if device_summary.storage_free_bytes is not None else None)
     print_message(
-        f"Serial ID: {device_serial}\nManufacturer: {manufacturer}\nModel: {model} ({display_name})\nRelease: {release}\nSDK version: {sdk}\nCPU: {abi}\n")
+        f"Serial ID: {device_summary.serial}\nManufacturer: {device_summary.manufacturer}\n"
+        f"Model: {device_summary.model} ({device_summary.display_name})\nRelease: {device_summary.release}\n"
+        f"SDK version: {device_summary.sdk}\nCPU: {device_summary.cpu}\nBattery: {battery_level}\n"
+        f"Storage free: {storage_free}\nScreen: {device_summary.screen}\nTransport: {device_summary.transport}\n")
 
 
 def print_top_activity() -> None:
@@ -496,12 +568,44 @@ def print_top_activity() -> None:
         print_message(f"Activity name: {activity_name}")
 
 
-def _get_top_activity_data() -> tuple[None, None]:
-    cmd = "dumpsys window windows"
+# Waits till the foreground activity is activity_name and returns whether it was before the timeout. activity_name is
+# either an app, e.g. "com.example" or "com.example/", which matches any of its activities, or a component, e.g.
+# "com.example/com.example.MainActivity" or "com.example/.MainActivity", which matches only that activity.
+# The device is polled quickly at first, and then less often, so that a long wait does not keep the device busy.
+def wait_for_activity(activity_name: str, timeout_seconds: float, *,
+                      should_stop_waiting: Callable[[], bool] | None = None) -> bool:
+    app_name, _, class_name = activity_name.partition("/")
+    # The top activity's class name is always expanded, so, the shorthand is expanded too
+    if class_name.startswith("."):
+        class_name = f"{app_name}{class_name}"
+    deadline = time.monotonic() + timeout_seconds
+    poll_interval_seconds = _MIN_ACTIVITY_POLL_INTERVAL_SECONDS
+    while True:
+        top_app_name, top_activity_name = _get_top_activity_data(quiet=True)
+        if top_app_name == app_name and (not class_name or top_activity_name == class_name):
+            return True
+        remaining_seconds = deadline - time.monotonic()
+        if remaining_seconds <= 0 or (should_stop_waiting is not None and should_stop_waiting()):
+            return False
+        print_verbose(f"Waiting for {activity_name}, the top activity is {top_app_name}/{top_activity_name}")
+        time.sleep(min(poll_interval_seconds, remaining_seconds))
+        poll_interval_seconds = min(poll_interval_seconds * 2, _MAX_ACTIVITY_POLL_INTERVAL_SECONDS)
+
+
+def handle_wait_for_activity(activity_name: str, timeout_seconds: float) -> None:
+    if not wait_for_activity(activity_name, timeout_seconds):
+        print_error_and_exit(f"{activity_name} did not come to the foreground in {timeout_seconds:g} seconds")
+    print_message(f"{activity_name} is in the foreground")
+
+
+def _get_top_activity_data(*, quiet: bool = False) -> tuple[str | None, str | None]:
+    # The window dump is hundreds of KB, only the lines with the activities are transferred. grep fails when no line
+    # matches, e.g. while the lock screen is shown, which is not an error.
+    cmd = shlex.quote("dumpsys window windows | grep 'ActivityRecord{' || true")
     return_code, output, _ = execute_adb_shell_command2(cmd)
     if return_code != 0 and not output:
         print_error_and_exit("Device returned no response, is it still connected?")
-    for line in output.split("\n"):
+    for line in (output or "").split("\n"):
         regex_result = re.search(r"ActivityRecord{.* (\S+)/(\S+)", line.strip())
         if regex_result is None:
             continue
@@ -511,15 +615,15 @@ def _get_top_activity_data() -> tuple[None, None]:
             activity_name = f"{app_name}{activity_name}"
         return app_name, activity_name
 
-    print_error("Unable to extract activity name")
+    if not quiet:
+        print_error("Unable to extract activity name")
     return None, None
 
 
 def dump_ui(xml_file: str) -> None:
-    tmp_file = _create_tmp_file("dump-ui", "xml")
+    tmp_file = scratch_helper.get_scratch_directory().new_file_path("dump-ui", "xml")
     cmd1 = f"uiautomator dump {tmp_file}"
     cmd2 = f"pull {tmp_file} {xml_file}"
-    cmd3 = f"rm {tmp_file}"
 
     print_verbose(f"Writing UI to {tmp_file}")
     return_code, _, stderr = execute_adb_shell_command2(cmd1)
@@ -528,8 +632,6 @@ def dump_ui(xml_file: str) -> None:
 
     print_verbose(f"Pulling file {xml_file}")
     return_code, _, stderr = execute_adb_command2(cmd2)
-    print_verbose(f"Deleting file {tmp_file}")
-    execute_adb_shell_command2(cmd3)
     if return_code != 0:
         print_error_and_exit(f"Failed to fetch file {tmp_file}")
     else:
@@ -608,19 +710,44 @@ def force_rtl(*, turn_on: bool) -> None:
     execute_adb_shell_settings_command_and_poke_activity_service(cmd)
 
 
-def dump_screenshot(filepath: str) -> None:
-    screenshot_file_path_on_device = _create_tmp_file("screenshot", "png")
-    dump_cmd = f"screencap -p {screenshot_file_path_on_device} "
-    return_code, stdout, stderr = execute_adb_shell_command2(dump_cmd)
-    if return_code != 0:
-        print_error_and_exit(
-            f"Failed to capture the screenshot: (stdout: {stdout}, stderr: {stderr})")
-    pull_cmd = f"pull {screenshot_file_path_on_device} {filepath}"
-    execute_adb_command2(pull_cmd)
-    del_cmd = f"rm {screenshot_file_path_on_device}"
-    execute_adb_shell_command2(del_cmd)
+# With burst, that many screenshots are saved as filepath with a sequence number, one every interval_ms milliseconds.
+# With raw, the uncompressed frame is fetched and encoded on the host, which is faster on low-end devices.
+def dump_screenshot(filepath: str, *, burst: int | None = None, interval_ms: int = 0, raw: bool = False,
+                    downscale: int = 1) -> None:
+    if downscale < 1:
+        print_error_and_exit(f"Downscale factor must be positive, it is {downscale:d}")
+    # Only the host can encode WebP
+    raw = raw or downscale > 1 or filepath.lower().endswith(".webp")
+    if burst is not None:
+        screenshot_helper.save_screenshot_burst(filepath, burst, interval_ms, raw=raw, downscale=downscale)
+    elif raw:
+        screenshot_helper.save_raw_frame(screenshot_helper.capture_raw_frame(), filepath, downscale)
+    else:
+        screenshot_helper.save_screenshot(filepath)
+
+
+# Compares the screen with the baseline image, see screenshot_diff_helper.compare_screen_with_baseline.
+# Every ignored region is "<x>,<y>,<width>,<height>" in pixels.
+def diff_screenshot(baseline_file_path: str, *, tolerance: int = 0, ignored_regions: list[str] | None = None,
+                    diff_file_path: str | None = None, max_different_pixels: int = 0) -> None:
+    if not 0 <= tolerance <= 255:
+        print_error_and_exit(f"Tolerance must be between 0 and 255, it is {tolerance:d}")
+    screenshot_diff_helper.compare_screen_with_baseline(
+        baseline_file_path, tolerance=tolerance,
+        ignored_regions=[_parse_region(region) for region in ignored_regions or []],
+        diff_file_path=diff_file_path, max_different_pixels=max_different_pixels)
 
 
+def _parse_region(region: str) -> screenshot_diff_helper.Region:
+    regex_result = re.fullmatch(r"(\d+),(\d+),(\d+),(\d+)", region.strip())
+    if regex_result is None:
+        print_error_and_exit(f'Invalid region "{region}", expected "<x>,<y>,<width>,<height>"')
+        return screenshot_diff_helper.Region(0, 0, 0, 0)
+    x, y, width, height = (int(value) for value in regex_result.groups())
+    return screenshot_diff_helper.Region(x=x, y=y, width=width, height=height)
+
+
+# From API 21, the recording is streamed to the machine and is not limited to the 3 minutes that screenrecord allows.
 def dump_screenrecord(filepath: str) -> None:
     _error_if_min_version_less_than(19)
     api_version = get_device_android_api_version()
@@ -630,51 +757,11 @@ def dump_screenrecord(filepath: str) -> None:
         print_error_and_exit("screenrecord is not supported on emulator below API 23\n"
                              "Source: https://issuetracker.google.com/issues/36982354")
 
-    original_sigint_handler = None
-
-    def _start_recording() -> str:
-        print_message("Recording video, press Ctrl+C to end...")
-        tmp_file_path = _create_tmp_file("screenrecord", "mp4")
-        dump_cmd = f"screenrecord --verbose {tmp_file_path} "
-        execute_adb_shell_command2(dump_cmd)
-        return tmp_file_path
-
-    def _pull_and_delete_file_from_device(screen_record_file_path: str) -> None:
-        print_message(f"Saving recording to {filepath}")
-        pull_cmd = f"pull {screen_record_file_path} {filepath}"
-        execute_adb_command2(pull_cmd)
-        del_cmd = f"rm {screen_record_file_path}"
-        execute_adb_shell_command2(del_cmd)
-
-    def _kill_all_child_processes() -> None:
-        current_process = psutil.Process()
-        children = current_process.children(recursive=True)
-        for child in children:
-            print_verbose(f"Child process is {child}")
-            os.kill(child.pid, signal.SIGTERM)
-
-    def _handle_recording_ended(screen_record_file_path: str) -> None:
-        print_message("Finishing...")
-        # Kill all child processes.
-        # This is not neat, but it is OK for now since we know that we have only one adb child process which is
-        # running screen recording.
-        _kill_all_child_processes()
-        # Wait for one second.
-        time.sleep(1)
-        # Finish rest of the processing.
-        _pull_and_delete_file_from_device(screen_record_file_path)
-        # And exit
-        sys.exit(0)
-
-    def signal_handler(_sig: int, _frame: Any) -> None:
-        # Restore the original handler for Ctrl-C
-        signal.signal(signal.SIGINT, original_sigint_handler)
-        _handle_recording_ended(screen_record_file_path_on_device)
-
-    original_sigint_handler = signal.getsignal(signal.SIGINT)
-    signal.signal(signal.SIGINT, signal_handler)
-
-    screen_record_file_path_on_device = _start_recording()
+    # Streaming, with "--output-format", is supported since API 21
+    if api_version < 21:
+        screenrecord_helper.record_screen_to_device_file(filepath)
+    else:
+        screenrecord_helper.record_screen(filepath)
 
 
 def get_mobile_data_saver_state() -> str:
@@ -845,41 +932,6 @@ def list_permissions(*, dangerous_only_permissions: bool) -> None:
         print_message(stdout)
 
 
-# Creates a tmp file on Android device
-def _create_tmp_file(filename_prefix: str | None = None, filename_suffix: str | None = None) -> str | None:
-    if filename_prefix is None:
-        filename_prefix = "file"
-    if filename_suffix is None:
-        filename_suffix = "tmp"
-    if filename_prefix.find("/") != -1:
-        print_error_and_exit(f'Filename prefix "{filename_prefix}" contains illegal character: "/"')
-    if filename_suffix.find("/") != -1:
-        print_error_and_exit(f'Filename suffix "{filename_suffix}" contains illegal character: "/"')
-
-    tmp_dir = "/data/local/tmp"
-
-    filepath_on_device = (
-        f"{tmp_dir}/{filename_prefix}-{secrets.randbelow(1000 * 1000 * 1000):d}.{filename_suffix}")
-    if _file_exists(filepath_on_device):
-        # Retry if the file already exists
-        print_verbose(f"Tmp File {filepath_on_device} already exists, trying a new random name")
-        return _create_tmp_file(filename_prefix, filename_suffix)
-
-    # Create the file
-    return_code, stdout, stderr = execute_adb_shell_command2(f"touch {filepath_on_device}")
-    if return_code != 0:
-        print_error(f"Failed to create tmp file {filepath_on_device}: (stdout: {stdout}, stderr: {stderr})")
-        return None
-
-    # Make the tmp file world-writable or else, run-as command might fail to write on it.
-    return_code, stdout, stderr = execute_adb_shell_command2(f"chmod 666 {filepath_on_device}")
-    if return_code != 0:
-        print_error(f"Failed to chmod tmp file {filepath_on_device}: (stdout: {stdout}, stderr: {stderr})")
-        return None
-
-    return filepath_on_device
-
-
 # Returns true if the file_path exists on the device, false if it does not exists or is inaccessible.
 def _file_exists(file_path: str) -> bool:
     exists_cmd = f'"ls {file_path} 1>/dev/null 2>/dev/null && echo exists"'
@@ -1292,6 +1344,20 @@ def list_directory(file_path: str, *, long_format: bool, recursive: bool, includ
     print_message(execute_file_related_adb_shell_command(cmd, file_path))
 
 
+# Prints file_path and the files under it as newline-delimited JSON, one object per file.
+def list_directory_as_json(file_path: str, *, max_depth: int | None = None, name_glob: str | None = None,
+                           min_size: int | None = None, max_size: int | None = None) -> None:
+    entry_count = 0
+    for entry in listing_helper.iter_file_entries(file_path, max_depth=max_depth, name_glob=name_glob,
+                                                  min_size=min_size, max_size=max_size):
+        print_message(json.dumps(dataclasses.asdict(entry), ensure_ascii=False))
+        entry_count += 1
+    # The filters might have excluded everything
+    if entry_count == 0 and not _file_exists(file_path):
+        print_error_and_exit(f"File {file_path} does not exist")
+    print_verbose(f"Listed {entry_count:d} files")
+
+
 def delete_file(file_path: str, force: bool, recursive: bool) -> None:
     cmd_prefix = "rm"
     if force:
@@ -1327,7 +1393,9 @@ def move_file(src_path: str, dest_path: str, force: bool) -> None:
 
 # Copies from remote_file_path on Android to local_file_path on the disk
 # local_file_path can be None
-def pull_file(remote_file_path: str, local_file_path: str, *, copy_ancillary: bool = False) -> None:
+# With resume, the file is pulled in verified chunks and an interrupted pull continues where it stopped.
+def pull_file(remote_file_path: str, local_file_path: str, *, copy_ancillary: bool = False,
+              resume: bool = False) -> None:
     if not _file_exists(remote_file_path):
         print_error_and_exit(f"File {remote_file_path} does not exist")
 
@@ -1336,19 +1404,22 @@ def pull_file(remote_file_path: str, local_file_path: str, *, copy_ancillary: bo
         print_verbose(f'Local file path not provided, using "{local_file_path}" for that')
 
     remote_file_path_package = get_package(remote_file_path)
-    if remote_file_path_package is None and not root_required_to_access_file(remote_file_path):
+    if resume:
+        transfer_helper.pull_file_resumable(remote_file_path, local_file_path)
+    elif is_compression_enabled() and transfer_helper.pull_file_streamed(remote_file_path, local_file_path):
+        print_verbose(f"Pulled {remote_file_path} with compression")
+    elif remote_file_path_package is None and not root_required_to_access_file(remote_file_path):
         print_verbose(f"File {remote_file_path_package} is not inside a package, no temporary file required")
         pull_cmd = f"pull {remote_file_path} {local_file_path}"
         execute_adb_command2(pull_cmd)
     else:
-        # First copy the files to sdcard, then pull them out, and then delete them from sdcard.
-        tmp_file = _create_tmp_file()
+        # First copy the files to the scratch directory and then pull them out.
+        # The scratch directory is deleted when adbe exits.
+        tmp_file = scratch_helper.get_scratch_directory().create_file()
         cp_cmd = f"cp -r {remote_file_path} {tmp_file}"
         execute_file_related_adb_shell_command(cp_cmd, remote_file_path)
         pull_cmd = f"pull {tmp_file} {local_file_path}"
         execute_adb_command2(pull_cmd)
-        del_cmd = f"rm -r {tmp_file}"
-        execute_adb_shell_command(del_cmd)
 
     if Path(local_file_path).exists():
         print_message(
@@ -1365,7 +1436,7 @@ def pull_file(remote_file_path: str, local_file_path: str, *, copy_ancillary: bo
             if not _file_exists(tmp_db_file):
                 continue
             if copy_ancillary:
-                pull_file(tmp_db_file, f"{local_file_path}-{suffix}", copy_ancillary=True)
+                pull_file(tmp_db_file, f"{local_file_path}-{suffix}", copy_ancillary=True, resume=resume)
             else:
                 print_error(f'File "{remote_file_path}" has an ancillary file "{tmp_db_file}" which should be copied.\n'
                             'See "https://ashishb.net/all/android-the-right-way-to-pull-sqlite-database-from-the-device/'
@@ -1374,36 +1445,113 @@ def pull_file(remote_file_path: str, local_file_path: str, *, copy_ancillary: bo
 
 # Limitation: It seems that pushing to a directory on some versions of Android fail silently.
 # It is safer to push to a full path containing the filename.
-def push_file(local_file_path: str, remote_file_path: str) -> None:
+# With resume, the file is pushed in verified chunks and an interrupted push continues where it stopped.
+def push_file(local_file_path: str, remote_file_path: str, *, resume: bool = False) -> None:
     if not Path(local_file_path).exists():
         print_error_and_exit(f"Local file {local_file_path} does not exist")
     if Path(local_file_path).is_dir():
         print_error_and_exit(f"This tool does not support pushing a directory yet: {local_file_path}")
 
-    # First push to tmp file in /data/local/tmp and then move that
-    tmp_file = _create_tmp_file()
-    push_cmd = f"push {local_file_path} {tmp_file}"
+    # First push to tmp file in the scratch directory and then move that
+    if resume:
+        tmp_file = transfer_helper.push_file_resumable(local_file_path)
+    else:
+        tmp_file = scratch_helper.get_scratch_directory().new_file_path()
+        push_cmd = f"push {local_file_path} {tmp_file}"
+        return_code, _, stderr = execute_adb_command2(push_cmd)
+        if return_code != 0:
+            print_error_and_exit(f"Failed to push file, error: {stderr}")
+            return
+
     # "mv" from /data/local/tmp with run-as <app_id> does not always work even when the underlying
-    # dir has mode set to 777. Therefore, do a two-step cp and rm.
+    # dir has mode set to 777. Therefore, do a cp, the scratch directory is deleted when adbe exits.
     cp_cmd = f"cp {tmp_file} {remote_file_path}"
-    rm_cmd = f"rm {tmp_file}"
-
-    return_code, _, stderr = execute_adb_command2(push_cmd)
-    if return_code != 0:
-        print_error_and_exit(f"Failed to push file, error: {stderr}")
+    execute_file_related_adb_shell_command(cp_cmd, remote_file_path)
+    if resume:
+        # The partial file of a resumable push outlives the scratch directory
+        execute_adb_shell_command(f"rm {tmp_file}")
+
+
+# Streams the raw bytes of the file to stdout, the file is read only once and never fully held in the memory.
+# byte_range is "<start>-<end>" or "<start>-", both inclusive and zero-based, like HTTP range requests.
+# With follow, the data appended to the file is printed until Ctrl+C is pressed.
+def cat_file(file_path: str, *, byte_range: str | None = None, tail_bytes: int | None = None,
+             follow: bool = False) -> None:
+    quoted_file_path = shlex.quote(file_path)
+    follow_arg = " -f" if follow else ""
+    if byte_range is not None and tail_bytes is not None:
+        print_error_and_exit("Only one of --range and --tail can be provided")
+    if tail_bytes is not None:
+        cmd = f"tail -c {tail_bytes:d}{follow_arg} {quoted_file_path}"
+    elif byte_range is not None:
+        start, end = _parse_byte_range(byte_range)
+        cmd = f"tail -c +{start + 1:d}{follow_arg} {quoted_file_path}"
+        if end is not None:
+            if follow:
+                print_error_and_exit("--follow cannot be used with a --range that has an end")
+            cmd += f" | head -c {end - start + 1:d}"
+    elif follow:
+        cmd = f"tail -c +1 -f {quoted_file_path}"
+    else:
+        cmd = f"cat {quoted_file_path}"
+
+    # Errors are not distinguishable from the file data in the stream, so, they are held back and sent after the data,
+    # following a marker which the data can't contain by chance, and the exit code
+    status_marker = f"adbe-cat-status-{secrets.token_hex(8)}"
+    shell_cmd = (f"{{ error=$({get_file_related_shell_command(cmd, file_path)} 2>&1 >&3); status=$?; }} 3>&1; "
+                 f'printf "%s %d\\n%s" {status_marker} "$status" "$error"')
+    encoded_status_marker = status_marker.encode()
+    pending_data = b""
+    status = b""
+    try:
+        # gzip buffers its output, which would stall --follow
+        with stream_adb_shell_command(shell_cmd, allow_compression=not follow) as stream:
+            for data in iter(lambda: stream.read1(_CAT_BUFFER_SIZE), b""):
+                pending_data += data
+                marker_index = pending_data.find(encoded_status_marker)
+                if marker_index != -1:
+                    status = pending_data[marker_index + len(encoded_status_marker):] + stream.read()
+                    pending_data = pending_data[:marker_index]
+                # Only the bytes which might be the start of the marker are held back, so, --follow is not delayed
+                held_back_size = 0 if status else _get_partial_marker_size(pending_data, encoded_status_marker)
+                sys.stdout.buffer.write(pending_data[:len(pending_data) - held_back_size])
+                pending_data = pending_data[len(pending_data) - held_back_size:]
+                if follow:
+                    sys.stdout.buffer.flush()
+                if status:
+                    break
+    except KeyboardInterrupt:
+        print_verbose(f"Stopped following {file_path}")
+        sys.stdout.buffer.write(pending_data)
+        sys.stdout.buffer.flush()
         return
+    sys.stdout.buffer.flush()
 
-    execute_file_related_adb_shell_command(cp_cmd, remote_file_path)
-    execute_adb_shell_command(rm_cmd)
+    if not status:
+        print_error_and_exit(f"Failed to read {file_path}, is the device still connected?")
+    exit_code, _, error = status.decode("utf-8", errors="replace").strip().partition("\n")
+    if exit_code.strip() != "0":
+        print_error_and_exit(f"Failed to read {file_path}: {error.strip()}")
 
 
-def cat_file(file_path: str) -> None:
-    cmd_prefix = "cat"
-    cmd = f"{cmd_prefix} {file_path}"
-    cat_stdout = execute_file_related_adb_shell_command(cmd, file_path)
-    # Don't print "None" for an empty file
-    if cat_stdout:
-        print_message(execute_file_related_adb_shell_command(cmd, file_path))
+# Returns the length of the longest end of data which is the start of the marker
+def _get_partial_marker_size(data: bytes, marker: bytes) -> int:
+    for size in range(min(len(marker) - 1, len(data)), 0, -1):
+        if data.endswith(marker[:size]):
+            return size
+    return 0
+
+
+def _parse_byte_range(byte_range: str) -> tuple[int, int | None]:
+    regex_result = re.fullmatch(r"(\d+)-(\d*)", byte_range.strip())
+    if regex_result is None:
+        print_error_and_exit(f'Invalid range "{byte_range}", expected "<start>-<end>" or "<start>-"')
+        return 0, None
+    start = int(regex_result.group(1))
+    end = int(regex_result.group(2)) if regex_result.group(2) else None
+    if end is not None and end < start:
+        print_error_and_exit(f'Invalid range "{byte_range}", end is before the start')
+    return start, end
 
 
 # Source: https://stackoverflow.com/a/25398877
@@ -1411,6 +1559,9 @@ def cat_file(file_path: str) -> None:
 def launch_app(app_name: str) -> None:
     adb_shell_cmd = f"monkey -p {app_name} -c android.intent.category.LAUNCHER 1"
     execute_adb_shell_command(adb_shell_cmd)
+    # monkey returns as soon as the intent is sent, and not when the app is up
+    if not wait_for_activity(f"{app_name}/", _APP_LAUNCH_TIMEOUT_SECONDS):
+        print_error(f"{app_name} did not come to the foreground in {_APP_LAUNCH_TIMEOUT_SECONDS:d} seconds")
 
 
 @ensure_package_exists
@@ -1573,7 +1724,8 @@ def _extract_install_time_permissions_above_api_23(app_info_dump: str) -> list[s
 def _get_apk_path(app_name: str) -> str:
     adb_shell_cmd = f"pm path {app_name}"
     result = execute_adb_shell_command(adb_shell_cmd)
-    return result.split(":", 2)[1]
+    # Apps with split APKs have one line per APK, the base APK comes first
+    return result.split("\n")[0].split(":", 2)[1]
 
 
 @ensure_package_exists
@@ -1586,92 +1738,96 @@ def print_app_path(app_name: str) -> None:
 @ensure_package_exists
 def print_app_signature(app_name: str) -> None:
     apk_path = _get_apk_path(app_name)
-    # Copy apk to a temp file on the disk
-    with tempfile.NamedTemporaryFile(prefix=app_name, suffix=".apk") as tmp_apk_file:
-        tmp_apk_file_name = tmp_apk_file.name
-        adb_cmd = f"pull {apk_path} {tmp_apk_file_name}"
-        return_code, _, stderr = execute_adb_command2(adb_cmd)
-        if return_code != 0:
-            print_error_and_exit(f"Failed to pull file {apk_path}, stderr: {stderr}")
-            return
+    try:
+        signatures = apk_signature_helper.read_remote_apk_signatures(apk_path)
+    except ValueError as e:
+        print_error_and_exit(f"Failed to read the signature of {apk_path}: {e}")
+        return
+    _print_signatures(signatures)
 
-        dir_of_this_script = os.path.split(__file__)[0]
-        apk_signer_jar_path = Path(dir_of_this_script) / "apksigner.jar"
-        if not Path(apk_signer_jar_path).exists():
-            print_error_and_exit("apksigner.jar is missing, your adb-enhanced installation is corrupted")
 
-        print_signature_cmd = f"java -jar {apk_signer_jar_path} verify --print-certs {tmp_apk_file_name}"
-        print_verbose(f"Executing command {print_signature_cmd}")
-        with subprocess.Popen(print_signature_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps1:
-            for line in ps1.stdout:
-                print_message(line.decode("utf-8").strip())
-            for line in ps1.stderr:
-                print_error(line.decode("utf-8").strip())
+# Same as print_app_signature but for an APK file on this machine, e.g. to compare a build with the installed app
+def print_apk_signature(apk_file_path: str) -> None:
+    try:
+        signatures = apk_signature_helper.read_local_apk_signatures(apk_file_path)
+    except (OSError, ValueError) as e:
+        print_error_and_exit(f"Failed to read the signature of {apk_file_path}: {e}")
+        return
+    _print_signatures(signatures)
+
+
+def _print_signatures(signatures: apk_signature_helper.ApkSignatures) -> None:
+    print_message(f"Signature schemes: {', '.join(signatures.schemes)}")
+    print_message(f"Number of signers: {len(signatures.certificates):d}")
+    for index, certificate in enumerate(signatures.certificates, start=1):
+        certificate_summary = apk_signature_helper.get_certificate_summary(certificate)
+        print_message(f"Signer #{index:d} certificate DN: {certificate_summary.distinguished_name}")
+        print_message(f"Signer #{index:d} certificate SHA-256 digest: {certificate_summary.sha256_digest}")
+        print_message(f"Signer #{index:d} certificate SHA-1 digest: {certificate_summary.sha1_digest}")
+        print_message(f"Signer #{index:d} certificate MD5 digest: {certificate_summary.md5_digest}")
 
 
-# Uses abe.jar taken from https://sourceforge.net/projects/adbextractor/
 @ensure_package_exists
 def perform_app_backup(app_name: str, backup_tar_file: str) -> None:
     # TODO: Add a check to ensure that the screen is unlocked
-    password = "00"
-    print_verbose("Performing backup to backup.ab file")
-    print_message(
-        f'you might have to confirm the backup manually on your device\'s screen, enter "{password}" as password...')
+    print_message("you might have to confirm the backup manually on your device's screen, "
+                  "leave the password empty unless the device requires one...")
+    # "bu" is what "adb backup" runs on the device, it writes the backup to stdout, which is converted to tar on the fly
+    partial_tar_file_path = Path(f"{backup_tar_file}.partial")
+    with start_adb_command(f"exec-out bu backup -noapk {shlex.quote(app_name)}") as process:
+        # A small backup can be over by the time the confirmation is seen, its output is still in the pipe
+        if (not wait_for_activity("com.android.backupconfirm", _BACKUP_CONFIRMATION_TIMEOUT_SECONDS,
+                                  should_stop_waiting=lambda: process.poll() is not None)
+                and process.poll() is None):
+            process.kill()
+            print_error_and_exit(f"Backup confirmation did not show up in {_BACKUP_CONFIRMATION_TIMEOUT_SECONDS:d} "
+                                 "seconds")
+
+        # Commented out since this does not always work and can sometimes lead to random clicks on some devices
+        # making backups impossible.
+        # # Tap the backup button
+        # # Get the location of "backup data" button and tap it.
+        # window_size_x, window_size_y = _get_window_size()
+        # # These numbers are purely derived from heuristics and can be improved.
+        # _perform_tap(window_size_x - 200, window_size_y - 100)
 
-    def backup_func() -> None:
-        # Create backup.ab
-        adb_backup_cmd = f"backup -noapk {app_name}"
-        execute_adb_command2(adb_backup_cmd)
+        try:
+            # The data arrives only after the backup is confirmed on the device
+            with partial_tar_file_path.open("wb") as tar_file:
+                tar_size = backup_helper.convert_backup_to_tar(
+                    process.stdout, tar_file, lambda: getpass.getpass("Backup password: "))
+            process.wait()
+            partial_tar_file_path.replace(backup_tar_file)
+        finally:
+            partial_tar_file_path.unlink(missing_ok=True)
+            if process.poll() is None:
+                process.kill()
+    print_message(f"Successfully backed up data of app {app_name} to {backup_tar_file} ({tar_size:d} bytes)")
 
-    backup_thread = threading.Thread(target=backup_func)
-    backup_thread.start()
-    while _get_top_activity_data()[1].find("com.android.backupconfirm") == -1:
-        print_verbose("Waiting for the backup activity to start")
-        time.sleep(1)
-    time.sleep(1)
-
-    # Commented out since this does not always work and can sometimes lead to random clicks on some devices
-    # making backups impossible.
-    # # Tap the backup button
-    # # Get the location of "backup data" button and tap it.
-    # window_size_x, window_size_y = _get_window_size()
-    # # These numbers are purely derived from heuristics and can be improved.
-    # _perform_tap(window_size_x - 200, window_size_y - 100)
-
-    backup_thread.join(timeout=10)
-    if backup_thread.is_alive():
-        print_error("Backup failed in first attempt, trying again...")
-        # _perform_tap(window_size_x - 200, window_size_y - 100)
-        backup_thread.join(timeout=10)
-        if backup_thread.is_alive():
-            print_error_and_exit("Backup failed")
 
-    # Convert ".ab" to ".tar" using Android Backup Extractor (ABE)
-    try:
-        dir_of_this_script = os.path.split(__file__)[0]
-        abe_jar_path = Path(dir_of_this_script) / "abe.jar"
-        if not Path(abe_jar_path).exists():
-            print_error_and_exit("Abe.jar is missing, your adb-enhanced installation is corrupted")
-        abe_cmd = f"java -jar {abe_jar_path} unpack backup.ab {backup_tar_file} {password}"
-        print_verbose(f"Executing command {abe_cmd}")
-        with subprocess.Popen(abe_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps:
-            ps.communicate()
-            if ps.returncode == 0:
-                print_message(f"Successfully backed up data of app {app_name} to {backup_tar_file}")
-            else:
-                print_error("Failed to convert backup.ab to tar file. Please ensure that it is not password protected")
-    finally:
-        print_verbose("Deleting backup.ab")
-        with subprocess.Popen("rm backup.ab", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps2:
-            ps2.communicate()
+@ensure_package_exists
+def save_app_snapshot(app_name: str, snapshot_name: str) -> None:
+    snapshot_helper.save_snapshot(app_name, snapshot_name)
 
 
-def perform_install(file_path: str) -> None:
-    print_verbose(f"Installing {file_path}")
-    # -r: replace existing application
-    return_code, _, stderr = execute_adb_command2(f"install -r {file_path}")
-    if return_code != 0:
-        print_error(f"Failed to install {file_path}, stderr: {stderr}")
+@ensure_package_exists
+def restore_app_snapshot(app_name: str, snapshot_name: str) -> None:
+    snapshot_helper.restore_snapshot(app_name, snapshot_name)
+
+
+@ensure_package_exists
+def query_app_database(app_name: str, db_name: str, sql: str, *, json_output: bool = False) -> None:
+    sqlite_helper.query_database(app_name, db_name, sql, json_output=json_output)
+
+
+# Every package is an APK, a directory of split APKs of a single app, or a bundletool ".apks" archive.
+def perform_install(package_paths: list[str], max_megabytes_per_second: float | None = None,
+                    skip_identical: bool = False) -> None:
+    print_verbose(f"Installing {', '.join(package_paths)}")
+    if install_helper.install_on_devices(
+            [None], package_paths, max_megabytes_per_second=max_megabytes_per_second,
+            skip_identical=skip_identical) != 0:
+        print_error_and_exit(f"Failed to install {', '.join(package_paths)}")
 
 
 @ensure_package_exists
@@ -1785,7 +1941,7 @@ def enable_wireless_debug() -> bool:
 
 
 def disable_wireless_debug() -> None:
-    device_serials = _get_device_serials()
+    device_serials = [device.serial for device in device_tracker_helper.get_device_list()]
 
     if not device_serials:
         print_error_and_exit("No connected device found")
@@ -1804,13 +1960,18 @@ def disable_wireless_debug() -> None:
 
     result = True
 
-    for ip in ip_list:
-        code, _, stderr = execute_adb_command2(f"disconnect {ip}")
-        if code != 0:
-            print_error(f"Failed to disconnect {ip}: {stderr}")
-            result = False
-        else:
-            print_message(f"Disconnected {ip}")
+    with device_tracker_helper.track_devices() as device_tracker:
+        for ip in ip_list:
+            code, _, stderr = execute_adb_command2(f"disconnect {ip}")
+            if code != 0:
+                print_error(f"Failed to disconnect {ip}: {stderr}")
+                result = False
+            # The adb server drops the device asynchronously
+            elif not device_tracker.wait_for_state(ip, None, _WIRELESS_DISCONNECT_TIMEOUT_SECONDS):
+                print_error(f"{ip} is still connected")
+                result = False
+            else:
+                print_message(f"Disconnected {ip}")
 
     if not result:
         print_error_and_exit("")
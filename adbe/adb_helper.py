@@ -1,6 +1,17 @@
+import contextlib
+import contextvars
 import dataclasses
-import functools
+import gzip
+import os
+import re
+import secrets
+import shlex
 import subprocess
+import threading
+import time
+import zlib
+from collections.abc import Callable, Iterator
+from typing import Any, BinaryIO, TypeVar
 
 try:
     # This fails when the code is executed directly and not as a part of python package installation,
@@ -11,28 +22,167 @@ except ImportError:
     from output_helper import print_error, print_error_and_exit, print_verbose
 
 
+T = TypeVar("T")
+
+
+class Device:
+    """
+    An Android device or emulator that adb commands are sent to, along with what is known about it.
+    Either serial or transport selects the device, without both, adb picks the only connected device or the one in
+    ANDROID_SERIAL.
+    The commands go to the current device, which is the default device unless another one is activated in the
+    current thread, so, different threads can drive different devices at the same time, e.g.
+    >>> Device("emulator-5554").run(adb_enhanced.toggle_animations, turn_on=False)
+    """
+
+    # "usb" for the only device connected via USB (adb -d) or "emulator" for the only running emulator (adb -e)
+    TRANSPORTS = ("usb", "emulator")
+
+    def __init__(self, serial: str | None = None, *, transport: str | None = None, adb_path: str = "adb") -> None:
+        if transport is not None and transport not in Device.TRANSPORTS:
+            print_error_and_exit(f'Unexpected transport "{transport}", expected one of {Device.TRANSPORTS}')
+        self._serial = serial
+        self._transport = transport
+        self._adb_path = adb_path
+        # Reentrant since computing a cached value might need another cached value
+        self._cache_lock = threading.RLock()
+        self._cache: dict[str, Any] = {}
+
+    def __repr__(self) -> str:
+        return f"Device(serial={self._serial!r}, transport={self._transport!r})"
+
+    @property
+    def serial(self) -> str | None:
+        return self._serial
+
+    @property
+    def transport(self) -> str | None:
+        return self._transport
+
+    @property
+    def adb_path(self) -> str:
+        return self._adb_path
+
+    @property
+    def adb_prefix(self) -> str:
+        if self._serial:
+            return f"{self._adb_path} -s {shlex.quote(self._serial)}"
+        if self._transport == "usb":
+            return f"{self._adb_path} -d"
+        if self._transport == "emulator":
+            return f"{self._adb_path} -e"
+        return self._adb_path
+
+    @contextlib.contextmanager
+    def activate(self) -> Iterator["Device"]:
+        """Makes this the current device in the current thread, or asyncio task, till the end of the block."""
+        token = _current_device.set(self)
+        try:
+            yield self
+        finally:
+            _current_device.reset(token)
+
+    def run(self, function: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Calls the function, e.g. any of the adb_enhanced functions, with this as the current device."""
+        with self.activate():
+            return function(*args, **kwargs)
+
+    def get_cached(self, key: str, compute: Callable[[], T]) -> T:
+        """
+        Returns the value of a device property or capability which does not change while the device is connected,
+        compute is called, with this as the current device, only the first time.
+        """
+        with self._cache_lock:
+            if key not in self._cache:
+                self._cache[key] = self.run(compute)
+            return self._cache[key]
+
+    def get_api_version(self) -> int:
+        return self.get_cached("api_version", _get_android_api_version)
+
+    # Returns the serial of the device, None if the device can't be determined, e.g. when more than one is connected.
+    def get_resolved_serial(self) -> str | None:
+        if self._serial:
+            return self._serial
+        return self.get_cached("resolved_serial", _get_resolved_serial)
+
+    # Devices connected via "adb connect <ip>:<port>" or via mDNS for Android 11+ wireless debugging
+    def is_connected_over_tcp_ip(self) -> bool:
+        serial = self.get_resolved_serial()
+        return serial is not None and re.search(_TCP_IP_SERIAL_REGEX, serial) is not None
+
+    def is_compression_supported(self) -> bool:
+        # Probed once per device since this depends on the device's shell and toybox versions.
+        return self.get_cached("compression_supported", _is_compression_supported)
+
+
 @dataclasses.dataclass
 class _Settings:
-    adb_prefix: str = "adb"
+    default_device: Device = dataclasses.field(default_factory=Device)
+    # One of COMPRESSION_MODES
+    compression_mode: str = "auto"
 
 
 __settings = _Settings()
 
-_adb_prefix = "adb"
+# Set by Device.activate, the default device is used when it is not set
+_current_device: contextvars.ContextVar[Device | None] = contextvars.ContextVar("current_device", default=None)
+# Devices selected by their serial, so that the cached properties survive across calls
+_devices_by_serial: dict[str, Device] = {}
+_devices_by_serial_lock = threading.Lock()
+
 _IGNORED_LINES = [
     "WARNING: linker: libdvm.so has text relocations. This is wasting memory and is a security risk. Please fix.",
 ]
 
 # Below version 24, if an adb shell command fails, then it still has an incorrect exit code of 0.
 _MIN_VERSION_ABOVE_WHICH_ADB_SHELL_RETURNS_CORRECT_EXIT_CODE = 24
-
-
-def get_adb_prefix() -> str:
-    return __settings.adb_prefix
-
-
-def set_adb_prefix(adb_prefix: str) -> None:
-    __settings.adb_prefix = adb_prefix
+# Below version 24, there is no shell protocol and "adb shell" output goes through a pty, which mangles binary data.
+_MIN_VERSION_FOR_COMPRESSION = 24
+
+# "auto" compresses only for devices connected over TCP/IP, where the bandwidth is the bottleneck.
+COMPRESSION_MODES = ("auto", "on", "off")
+# Verifies that the device has gzip and a shell with pipefail, which is required to keep the exit code of the
+# compressed command.
+_COMPRESSION_PROBE_CMD = "set -o pipefail; echo adbe | gzip -c"
+_COMPRESSION_PROBE_OUTPUT = b"adbe\n"
+# Serials of devices connected via "adb connect <ip>:<port>" or via mDNS for Android 11+ wireless debugging.
+_TCP_IP_SERIAL_REGEX = r"^\S+:\d+$|\._adb-tls-connect\._tcp"
+_STREAM_BUFFER_SIZE = 1024 * 1024
+_SHELL_SESSION_EXIT_TIMEOUT_SECONDS = 5
+
+
+def set_default_device(device: Device) -> None:
+    print_verbose(f"Setting the default device to {device}")
+    __settings.default_device = device
+
+
+# Returns the device with the given serial or, without a serial, the current device.
+def get_device(device_serial: str | None = None) -> Device:
+    if not device_serial:
+        current_device = _current_device.get()
+        return current_device if current_device is not None else __settings.default_device
+    with _devices_by_serial_lock:
+        if device_serial not in _devices_by_serial:
+            _devices_by_serial[device_serial] = Device(device_serial)
+        return _devices_by_serial[device_serial]
+
+
+def set_compression_mode(compression_mode: str) -> None:
+    if compression_mode not in COMPRESSION_MODES:
+        print_error_and_exit(f'Unexpected compression mode "{compression_mode}", expected one of {COMPRESSION_MODES}')
+    __settings.compression_mode = compression_mode
+
+
+# Returns true if the output of the shell commands and the pulled files are gzip-compressed on the wire.
+def is_compression_enabled(device_serial: str | None = None) -> bool:
+    compression_mode = __settings.compression_mode
+    if compression_mode == "off":
+        return False
+    device = get_device(device_serial)
+    if compression_mode == "auto" and not device.is_connected_over_tcp_ip():
+        return False
+    return device.is_compression_supported()
 
 
 def get_adb_shell_property(property_name: str, device_serial: str | None = None) -> str | None:
@@ -57,18 +207,18 @@ def execute_adb_command2(
     :param device_serial: device serial to send this command to (in case of multiple devices)
     :return: (return_code, stdout, stderr)
     """
-    adb_prefix = _adb_prefix
-    if device_serial:
-        adb_prefix = f"{adb_prefix} -s {device_serial}"
-
-    final_cmd = f"{adb_prefix} {adb_cmd}"
-    if piped_into_cmd:
-        final_cmd = f"{final_cmd} | {piped_into_cmd}"
-
-    print_verbose(f'Executing "{final_cmd}"')
-    with subprocess.Popen(final_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps1:
-        stdout_data, stderr_data = ps1.communicate()
-        return_code = ps1.returncode
+    if not piped_into_cmd and adb_cmd.startswith("shell ") and is_compression_enabled(device_serial):
+        return_code, stdout_data, stderr_data = _execute_compressed_adb_shell_command(
+            adb_cmd.removeprefix("shell "), device_serial)
+    else:
+        final_cmd = _get_final_adb_cmd(adb_cmd, device_serial)
+        if piped_into_cmd:
+            final_cmd = f"{final_cmd} | {piped_into_cmd}"
+
+        print_verbose(f'Executing "{final_cmd}"')
+        with subprocess.Popen(final_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps1:
+            stdout_data, stderr_data = ps1.communicate()
+            return_code = ps1.returncode
     try:
         stdout_data = stdout_data.decode("utf-8")
     except UnicodeDecodeError:
@@ -109,6 +259,210 @@ def execute_adb_command2(
     return None
 
 
+def start_adb_command(adb_cmd: str, device_serial: str | None = None, *,
+                      write_stdin: bool = False) -> subprocess.Popen:
+    """
+    Starts an adb command without waiting for it, the caller owns the returned process.
+    Unlike execute_adb_command2, stdout is left as raw bytes, so this is safe for binary streams.
+    :param adb_cmd: command to run (so, don't prefix it with "adb")
+    :param device_serial: device serial to send this command to (in case of multiple devices)
+    :param write_stdin: if true, the process stdin is a pipe which the caller can write to
+    """
+    final_cmd = _get_final_adb_cmd(adb_cmd, device_serial)
+    print_verbose(f'Executing "{final_cmd}"')
+    return subprocess.Popen(final_cmd, shell=True, stdin=subprocess.PIPE if write_stdin else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+@contextlib.contextmanager
+def stream_adb_shell_command(adb_shell_cmd: str, device_serial: str | None = None, *,
+                             allow_compression: bool = True) -> Iterator[BinaryIO]:
+    """
+    Runs a command on the device and yields its stdout as a binary stream, which is decompressed on the fly
+    if compression is enabled.
+    Note: the command is passed as-is to the device shell, so, quote its arguments with shlex.quote.
+    Note: stderr of the command is mixed into the stream, redirect it on the device if that's not desired.
+    :param allow_compression: set it to false for long-running commands whose output is needed as soon as it is
+    produced, gzip buffers its output
+    """
+    compress = allow_compression and is_compression_enabled(device_serial)
+    if compress:
+        adb_cmd = f"shell {shlex.quote(f'set -o pipefail; ( {adb_shell_cmd} ) 2>&1 | gzip -c')}"
+    else:
+        # exec-out, unlike shell, never mangles line endings of binary data on old devices
+        adb_cmd = f"exec-out {shlex.quote(adb_shell_cmd)}"
+
+    start_time = time.monotonic()
+    with start_adb_command(adb_cmd, device_serial) as process:
+        if not compress:
+            try:
+                yield process.stdout
+            finally:
+                if process.poll() is None:
+                    process.kill()
+            return
+
+        compressed_stream = _CountingReader(process.stdout)
+        with gzip.GzipFile(fileobj=compressed_stream, mode="rb") as stream:
+            counting_stream = _CountingReader(stream)
+            try:
+                yield counting_stream
+            finally:
+                if process.poll() is None:
+                    process.kill()
+    if compress:
+        _print_compression_trace(adb_shell_cmd, compressed_stream.bytes_read, counting_stream.bytes_read, start_time)
+
+
+# Wraps a binary stream and counts the bytes read from it.
+class _CountingReader:
+    def __init__(self, stream: BinaryIO) -> None:
+        self._stream = stream
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def read1(self, size: int = -1) -> bytes:
+        data = self._stream.read1(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer: memoryview) -> int:
+        num_read = self._stream.readinto(buffer)
+        self.bytes_read += num_read
+        return num_read
+
+    def readline(self, size: int = -1) -> bytes:
+        line = self._stream.readline(size)
+        self.bytes_read += len(line)
+        return line
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self.readline, b"")
+
+
+@contextlib.contextmanager
+def open_shell_session(device_serial: str | None = None) -> Iterator["ShellSession"]:
+    """
+    Opens a shell on the device which runs the commands one after another, without starting an adb process for each
+    one. For the commands which run repeatedly, and which the tens of milliseconds to start adb would slow down or
+    add noise to, e.g.
+    >>> with open_shell_session() as shell_session:
+    ...     return_code, output = shell_session.run("am start -W -n com.example/.MainActivity")
+    """
+    # Without a command, adb runs a shell which reads the commands from stdin
+    with start_adb_command("shell", device_serial, write_stdin=True) as process:
+        try:
+            yield ShellSession(process)
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+            try:
+                process.wait(timeout=_SHELL_SESSION_EXIT_TIMEOUT_SECONDS)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+# pylint: disable=too-few-public-methods
+class ShellSession:
+    def __init__(self, process: subprocess.Popen) -> None:
+        self._process = process
+        # Follows the output of every command, along with its exit code
+        self._end_marker = f"adbe-end-{secrets.token_hex(8)}"
+
+    # Returns the exit code and the output, stdout and stderr combined, of the command
+    def run(self, shell_cmd: str) -> tuple[int, str]:
+        print_verbose(f'Running "{shell_cmd}" in the shell session')
+        # The command must not read stdin, that's where the next commands come from. The marker is printed on a new
+        # line, even if the output does not end with one.
+        session_cmd = f"{{ {shell_cmd}; }} </dev/null 2>&1; printf '\\n{self._end_marker} %d\\n' $?\n"
+        with contextlib.suppress(BrokenPipeError):
+            self._process.stdin.write(session_cmd.encode())
+            self._process.stdin.flush()
+        output_lines = []
+        for line in iter(self._process.stdout.readline, b""):
+            decoded_line = line.decode("utf-8", errors="replace")
+            if decoded_line.startswith(self._end_marker):
+                # Without the newline printed before the marker
+                return int(decoded_line[len(self._end_marker):]), "".join(output_lines)[:-1]
+            output_lines.append(decoded_line)
+        stderr = self._process.stderr.read().decode("utf-8", errors="replace").strip()
+        print_error_and_exit(f'The shell session ended while running "{shell_cmd}": {stderr}')
+        return 1, ""
+
+
+def _execute_compressed_adb_shell_command(adb_shell_cmd: str, device_serial: str | None) -> tuple[int, bytes, bytes]:
+    # adb_shell_cmd is meant to be interpreted by the local shell first, just like in execute_adb_command2,
+    # so, only the device-side wrapper around it is escaped here.
+    adb_cmd = f"shell set -o pipefail\\; \\( {adb_shell_cmd} \\) \\| gzip -c"
+    start_time = time.monotonic()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    stdout_chunks = []
+    stderr_chunks = []
+    compressed_size = 0
+    with start_adb_command(adb_cmd, device_serial) as process:
+        # Drain stderr in parallel, so that the command never blocks on a full stderr pipe.
+        stderr_thread = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()))
+        stderr_thread.start()
+        for compressed_chunk in iter(lambda: process.stdout.read1(_STREAM_BUFFER_SIZE), b""):
+            compressed_size += len(compressed_chunk)
+            try:
+                stdout_chunks.append(decompressor.decompress(compressed_chunk))
+            except zlib.error as e:
+                print_error(f"Failed to decompress output of {adb_shell_cmd}: {e}")
+                break
+        stderr_thread.join()
+        return_code = process.wait()
+
+    stdout_data = b"".join(stdout_chunks)
+    _print_compression_trace(adb_shell_cmd, compressed_size, len(stdout_data), start_time)
+    return return_code, stdout_data, b"".join(stderr_chunks)
+
+
+def _print_compression_trace(adb_shell_cmd: str, compressed_size: int, size: int, start_time: float) -> None:
+    ratio = size / compressed_size if compressed_size else 0
+    print_verbose(f'Compressed output of "{adb_shell_cmd}": {compressed_size:d} bytes on the wire, '
+                  f"{size:d} bytes decompressed ({ratio:.1f}x) in {(time.monotonic() - start_time) * 1000:.0f} ms")
+
+
+# Returns the serial of the current device, None if that is ambiguous.
+def _get_resolved_serial() -> str | None:
+    if not get_device().transport and os.environ.get("ANDROID_SERIAL"):
+        return os.environ["ANDROID_SERIAL"]
+    with start_adb_command("get-serialno") as process:
+        stdout_data, _ = process.communicate()
+    serial = stdout_data.decode("utf-8", errors="replace").strip()
+    if process.returncode != 0 or not serial or serial == "unknown":
+        return None
+    return serial
+
+
+def _is_compression_supported() -> bool:
+    # Cannot use get_device_android_api_version here since that would execute a (compressed) command
+    with start_adb_command("shell getprop ro.build.version.sdk") as process:
+        stdout_data, _ = process.communicate()
+    api_version = stdout_data.decode("utf-8", errors="replace").strip()
+    if not api_version.isdigit() or int(api_version) < _MIN_VERSION_FOR_COMPRESSION:
+        print_verbose(f"Compression is not supported on API {api_version}")
+        return False
+
+    with start_adb_command(f"shell {shlex.quote(_COMPRESSION_PROBE_CMD)}") as process:
+        stdout_data, _ = process.communicate()
+    try:
+        supported = gzip.decompress(stdout_data) == _COMPRESSION_PROBE_OUTPUT
+    except (OSError, EOFError, zlib.error):
+        supported = False
+    print_verbose(f"Compression is {'supported' if supported else 'not supported'} on the device")
+    return supported
+
+
+def _get_final_adb_cmd(adb_cmd: str, device_serial: str | None) -> str:
+    return f"{get_device(device_serial).adb_prefix} {adb_cmd}"
+
+
 def execute_adb_shell_command(adb_cmd: str, piped_into_cmd: str | None = None, ignore_stderr: bool = False,
                               device_serial: str | None = None) -> str:
     _, stdout, _ = execute_adb_command2(
@@ -122,14 +476,7 @@ def execute_file_related_adb_shell_command(
     file_not_found_message = "No such file or directory"
     is_a_directory_message = "Is a directory"  # Error when someone tries to delete a dir without "-r"
 
-    adb_cmds_prefix = []
-    run_as_package = get_package(file_path)
-    if run_as_package:
-        adb_cmds_prefix.append(f"shell run-as {run_as_package}")
-    if root_required_to_access_file(file_path):
-        adb_cmds_prefix.append("shell su root")
-    # As a backup, still try with a plain-old access, if run-as is not possible and root is not available.
-    adb_cmds_prefix.append("shell")
+    adb_cmds_prefix = [f"shell {access_prefix}".strip() for access_prefix in get_file_access_prefixes(file_path)]
 
     stdout = None
     attempt_count = 1
@@ -154,6 +501,31 @@ def execute_file_related_adb_shell_command(
     return stdout
 
 
+# Returns the prefixes, in the order of preference, with which a shell command can access the file.
+def get_file_access_prefixes(file_path: str) -> list[str]:
+    access_prefixes = []
+    run_as_package = get_package(file_path)
+    if run_as_package:
+        access_prefixes.append(f"run-as {run_as_package}")
+    if root_required_to_access_file(file_path):
+        access_prefixes.append("su root")
+    # As a backup, still try with a plain-old access, if run-as is not possible and root is not available.
+    access_prefixes.append("")
+    return access_prefixes
+
+
+# Returns a single device shell command which runs shell_cmd with the first access prefix that can read the file.
+# Unlike execute_file_related_adb_shell_command, this never runs shell_cmd more than once.
+def get_file_related_shell_command(shell_cmd: str, file_path: str) -> str:
+    quoted_file_path = shlex.quote(file_path)
+    # The last prefix is the plain-old access
+    branches = [f"{access_prefix} test -r {quoted_file_path} 2>/dev/null; then {access_prefix} {shell_cmd}"
+                for access_prefix in get_file_access_prefixes(file_path)[:-1]]
+    if not branches:
+        return shell_cmd
+    return f"if {'; elif '.join(branches)}; else {shell_cmd}; fi"
+
+
 # Gets the package name given a file path.
 # E.g. if the file is in /data/data/com.foo/.../file1 then package is com.foo
 # Or if the file is in /data/user/0/com.foo/.../file1 then package is com.foo
@@ -174,10 +546,13 @@ def get_package(file_path: str) -> str | None:
     return None
 
 
-# adb shell getprop ro.build.version.sdk
-@functools.lru_cache(maxsize=10)
 def get_device_android_api_version(device_serial: str | None = None) -> int:
-    version_string = get_adb_shell_property("ro.build.version.sdk", device_serial=device_serial)
+    return get_device(device_serial).get_api_version()
+
+
+# adb shell getprop ro.build.version.sdk
+def _get_android_api_version() -> int:
+    version_string = get_adb_shell_property("ro.build.version.sdk")
     if version_string is None:
         print_error_and_exit("Unable to get Android device version, is it still connected?")
     return int(version_string)
@@ -191,7 +566,7 @@ def _check_for_adb_not_found_error(stderr_data: str) -> None:
     if not stderr_data:
         return
     stderr_data = stderr_data.strip()
-    if stderr_data.endswith(f"{_adb_prefix}: command not found"):
+    if stderr_data.endswith(f"{get_device().adb_path}: command not found"):
         message = "ADB (Android debug bridge) command not found.\n"
         message += "Install ADB via https://developer.android.com/studio/releases/platform-tools.html"
         print_error_and_exit(message)
@@ -234,15 +609,7 @@ def set_device_id(device_id: str) -> None:
     Make :param device_id: as main device to use
     Primary use-case: scripting
     Command line equivalent: "-s :param device_id:"
+    Note: this changes the default device of all the threads, use Device.activate or Device.run to drive
+    different devices from different threads.
     """
-    old_adb_prefix = get_adb_prefix()
-    if "-s" in old_adb_prefix:
-        old_device = old_adb_prefix.split("-s ")[1]
-        if " " in old_device:
-            # Case: device ID is not the last argument
-            old_device = old_adb_prefix.split("-s")[1].split(" ")[0]
-        print_verbose(f"Switching from {old_device} to {device_id}")
-        old_adb_prefix.replace(old_device, device_id)
-
-    print_verbose(f"Setting device ID to {device_id}")
-    set_adb_prefix(f"{old_adb_prefix} -s {device_id}")
+    set_default_device(get_device(device_id))
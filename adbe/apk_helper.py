@@ -0,0 +1,202 @@
+import dataclasses
+import struct
+import zipfile
+from collections.abc import Iterator
+from pathlib import Path
+from typing import BinaryIO
+
+_MANIFEST_FILE_NAME = "AndroidManifest.xml"
+# The base APK of a bundletool ".apks" archive is one of these
+_APKS_BASE_APK_NAMES = ("universal.apk", "splits/base-master.apk")
+# Both declare a permission, the latter only on API 23 and above
+_USES_PERMISSION_ELEMENT_NAMES = ("uses-permission", "uses-permission-sdk-23")
+# Binary XML chunk types, from frameworks/base/libs/androidfw/include/androidfw/ResourceTypes.h
+_CHUNK_HEADER_FORMAT = "<HHI"
+_CHUNK_TYPE_STRING_POOL = 0x0001
+_CHUNK_TYPE_XML = 0x0003
+_CHUNK_TYPE_XML_START_ELEMENT = 0x0102
+_CHUNK_TYPE_XML_RESOURCE_MAP = 0x0180
+_STRING_POOL_UTF8_FLAG = 0x100
+_NO_STRING = 0xFFFFFFFF
+# Attribute value types
+_VALUE_TYPE_STRING = 0x03
+_VALUE_TYPE_INT_DEC = 0x10
+_VALUE_TYPE_INT_HEX = 0x11
+_VALUE_TYPE_INT_BOOLEAN = 0x12
+# Shrunk APKs often strip the names of the "android:" attributes, their resource IDs are always there though
+_ANDROID_ATTRIBUTE_NAMES = {
+    0x01010003: "name",
+    0x0101000F: "debuggable",
+    0x0101020C: "minSdkVersion",
+    0x0101021B: "versionCode",
+    0x0101021C: "versionName",
+    0x01010272: "testOnly",
+    0x01010280: "allowBackup",
+}
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclasses.dataclass(frozen=True)
+class ApkManifest:
+    package: str
+    version_code: int
+    version_name: str | None
+    # Set for the split APKs, None for the base APK
+    split: str | None
+    min_sdk_version: int
+    # The requested permissions, in the manifest's order
+    permissions: tuple[str, ...]
+    debuggable: bool
+    allow_backup: bool
+    # Such APKs are only installed by "pm install -t"
+    test_only: bool
+
+
+# Reads the manifest of a local APK. zipfile locates the manifest via the zip's central directory at the end of the
+# file, so, only the manifest is read and decompressed, however large the rest of the APK is.
+def read_manifest(apk_file: str | BinaryIO) -> ApkManifest:
+    with zipfile.ZipFile(apk_file) as apk_zip:
+        manifest_data = apk_zip.read(_MANIFEST_FILE_NAME)
+    manifest_attributes: dict[str, str | int | bool] | None = None
+    application_attributes: dict[str, str | int | bool] = {}
+    min_sdk_version = 1
+    permissions: list[str] = []
+    for element_name, attributes in iter_xml_elements(manifest_data):
+        if element_name == "manifest":
+            manifest_attributes = attributes
+        elif element_name == "uses-sdk":
+            # A string, e.g. "R", for the preview SDKs
+            min_sdk_version = _get_int(attributes.get("minSdkVersion"), min_sdk_version)
+        elif element_name in _USES_PERMISSION_ELEMENT_NAMES and "name" in attributes:
+            permissions.append(str(attributes["name"]))
+        elif element_name == "application":
+            application_attributes = attributes
+    if manifest_attributes is None:
+        raise ValueError("No <manifest> element in the manifest")
+    return ApkManifest(
+        package=str(manifest_attributes.get("package", "")),
+        # The version code is an int, but some build tools write it as a string
+        version_code=_get_int(manifest_attributes.get("versionCode"), 0),
+        version_name=_get_optional_str(manifest_attributes.get("versionName")),
+        split=_get_optional_str(manifest_attributes.get("split")),
+        min_sdk_version=min_sdk_version,
+        permissions=tuple(permissions),
+        debuggable=application_attributes.get("debuggable") is True,
+        # Backups are allowed unless the app opts out
+        allow_backup=application_attributes.get("allowBackup", True) is not False,
+        test_only=application_attributes.get("testOnly") is True)
+
+
+# Reads the manifest of the base APK of a package, which is either an APK, a directory of split APKs of a single app,
+# or a bundletool ".apks" archive.
+def read_package_manifest(package_path: str) -> ApkManifest:
+    path = Path(package_path)
+    if path.suffix.lower() == ".apks":
+        with zipfile.ZipFile(path) as apks_file:
+            base_apk_name = next((name for name in _APKS_BASE_APK_NAMES if name in apks_file.namelist()), None)
+            if base_apk_name is None:
+                raise KeyError(f"None of {', '.join(_APKS_BASE_APK_NAMES)} found")
+            with apks_file.open(base_apk_name) as base_apk_file:
+                return read_manifest(base_apk_file)
+    if not path.is_dir():
+        return read_manifest(package_path)
+    apk_paths = sorted(path.glob("*.apk"))
+    if not apk_paths:
+        raise ValueError("No APKs found")
+    manifests = [read_manifest(str(apk_path)) for apk_path in apk_paths]
+    # Split APKs carry the package name and the version code as well, but only the base one has no split name
+    return next((manifest for manifest in manifests if manifest.split is None), manifests[0])
+
+
+# Yields the name and the attributes of every element of Android's binary XML, in document order.
+# The attribute values are str, int, or bool.
+def iter_xml_elements(data: bytes) -> Iterator[tuple[str, dict[str, str | int | bool]]]:
+    chunk_type, header_size, _ = struct.unpack_from(_CHUNK_HEADER_FORMAT, data)
+    if chunk_type != _CHUNK_TYPE_XML:
+        raise ValueError(f"Not a binary XML file, chunk type: {chunk_type:#x}")
+    strings: list[str] = []
+    resource_ids: list[int] = []
+    offset = header_size
+    while offset + 8 <= len(data):
+        chunk_type, header_size, chunk_size = struct.unpack_from(_CHUNK_HEADER_FORMAT, data, offset)
+        if chunk_size < 8:
+            raise ValueError(f"Malformed chunk at offset {offset:d}")
+        if chunk_type == _CHUNK_TYPE_STRING_POOL:
+            strings = _read_string_pool(data, offset)
+        elif chunk_type == _CHUNK_TYPE_XML_RESOURCE_MAP:
+            resource_ids = list(struct.unpack_from(f"<{(chunk_size - header_size) // 4:d}I", data,
+                                                   offset + header_size))
+        elif chunk_type == _CHUNK_TYPE_XML_START_ELEMENT:
+            yield _read_start_element(data, offset + header_size, strings, resource_ids)
+        offset += chunk_size
+
+
+def _read_start_element(data: bytes, offset: int, strings: list[str],
+                        resource_ids: list[int]) -> tuple[str, dict[str, str | int | bool]]:
+    _, name_index, attribute_start, attribute_size, attribute_count = struct.unpack_from("<IIHHH", data, offset)
+    attributes: dict[str, str | int | bool] = {}
+    for attribute_offset in range(offset + attribute_start,
+                                  offset + attribute_start + attribute_count * attribute_size, attribute_size):
+        _, attribute_name_index, raw_value_index, _, value_type, value = struct.unpack_from(
+            "<IIIHxBI", data, attribute_offset)
+        if attribute_name_index < len(resource_ids) and resource_ids[attribute_name_index] in _ANDROID_ATTRIBUTE_NAMES:
+            attribute_name = _ANDROID_ATTRIBUTE_NAMES[resource_ids[attribute_name_index]]
+        else:
+            attribute_name = strings[attribute_name_index]
+        if raw_value_index != _NO_STRING:
+            attributes[attribute_name] = strings[raw_value_index]
+        elif value_type == _VALUE_TYPE_STRING:
+            attributes[attribute_name] = strings[value]
+        elif value_type == _VALUE_TYPE_INT_BOOLEAN:
+            attributes[attribute_name] = value != 0
+        elif value_type in (_VALUE_TYPE_INT_DEC, _VALUE_TYPE_INT_HEX):
+            attributes[attribute_name] = value
+        else:
+            # e.g. a resource reference, which can't be resolved without resources.arsc
+            attributes[attribute_name] = value
+    return strings[name_index], attributes
+
+
+def _read_string_pool(data: bytes, offset: int) -> list[str]:
+    _, header_size, _, string_count, _, flags, strings_start, _ = struct.unpack_from("<HHIIIIII", data, offset)
+    string_offsets = struct.unpack_from(f"<{string_count:d}I", data, offset + header_size)
+    strings_offset = offset + strings_start
+    is_utf8 = flags & _STRING_POOL_UTF8_FLAG != 0
+    return [_read_utf8_string(data, strings_offset + string_offset) if is_utf8
+            else _read_utf16_string(data, strings_offset + string_offset)
+            for string_offset in string_offsets]
+
+
+def _read_utf8_string(data: bytes, offset: int) -> str:
+    # The length in characters, and then in bytes, each of them is one or two bytes long
+    _, offset = _read_utf8_length(data, offset)
+    byte_length, offset = _read_utf8_length(data, offset)
+    return data[offset:offset + byte_length].decode("utf-8", errors="replace")
+
+
+def _read_utf8_length(data: bytes, offset: int) -> tuple[int, int]:
+    length = data[offset]
+    if length & 0x80:
+        return ((length & 0x7F) << 8) | data[offset + 1], offset + 2
+    return length, offset + 1
+
+
+def _read_utf16_string(data: bytes, offset: int) -> str:
+    # The length in UTF-16 code units, either one or two of them long
+    length = struct.unpack_from("<H", data, offset)[0]
+    offset += 2
+    if length & 0x8000:
+        length = ((length & 0x7FFF) << 16) | struct.unpack_from("<H", data, offset)[0]
+        offset += 2
+    return data[offset:offset + length * 2].decode("utf-16-le", errors="replace")
+
+
+def _get_optional_str(value: str | int | bool | None) -> str | None:
+    return None if value is None else str(value)
+
+
+def _get_int(value: str | int | bool | None, default: int) -> int:
+    try:
+        return int(value) if value is not None else default
+    except ValueError:
+        return default
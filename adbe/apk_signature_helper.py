@@ -0,0 +1,337 @@
+import dataclasses
+import hashlib
+import re
+import shlex
+import struct
+import zlib
+from collections.abc import Callable, Iterator
+
+try:
+    from adbe.adb_helper import stream_adb_shell_command
+except ImportError:
+    from adb_helper import stream_adb_shell_command
+
+# Reads size bytes from offset of the APK
+RangeReader = Callable[[int, int], bytes]
+
+# Zip and APK Signing Block layout, see https://source.android.com/docs/security/features/apksigning/v2
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_EOCD_SIZE = 22
+_MAX_ZIP_COMMENT_SIZE = 0xFFFF
+_ZIP64_MARKER = 0xFFFFFFFF
+_CENTRAL_DIRECTORY_ENTRY_SIGNATURE = b"PK\x01\x02"
+_CENTRAL_DIRECTORY_ENTRY_SIZE = 46
+_LOCAL_FILE_HEADER_SIZE = 30
+_COMPRESSION_METHOD_DEFLATE = 8
+_SIGNING_BLOCK_MAGIC = b"APK Sig Block 42"
+# The block size and the magic
+_SIGNING_BLOCK_FOOTER_SIZE = 24
+_SIGNING_BLOCK_IDS = {
+    0x1B93AD61: "v3.1",
+    0xF05368C0: "v3",
+    0x7109871A: "v2",
+}
+# v1 is the JAR signing scheme, the signer's certificates are in a PKCS #7 file
+_V1_SIGNATURE_FILE_REGEX = re.compile(r"^META-INF/[^/]+\.(RSA|DSA|EC)$", re.IGNORECASE)
+# Most APKs fit in this, and then a single read gets the central directory and the signing block together
+_REMOTE_TAIL_SIZE = 256 * 1024
+_REMOTE_BLOCK_SIZE = 4096
+
+# DER tags
+_DER_TAG_SET = 0x31
+_DER_TAG_CONTEXT_0 = 0xA0
+_DER_STRING_ENCODINGS = {
+    0x0C: "utf-8",  # UTF8String
+    0x13: "ascii",  # PrintableString
+    0x14: "latin-1",  # TeletexString
+    0x16: "ascii",  # IA5String
+    0x1C: "utf-32-be",  # UniversalString
+    0x1E: "utf-16-be",  # BMPString
+}
+# Attribute types of the distinguished names, in the same notation as apksigner
+_DN_ATTRIBUTE_NAMES = {
+    "2.5.4.3": "CN",
+    "2.5.4.6": "C",
+    "2.5.4.7": "L",
+    "2.5.4.8": "ST",
+    "2.5.4.9": "STREET",
+    "2.5.4.10": "O",
+    "2.5.4.11": "OU",
+    "1.2.840.113549.1.9.1": "EMAILADDRESS",
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class ApkSignatures:
+    # e.g. ("v1", "v2", "v3")
+    schemes: tuple[str, ...]
+    # The DER-encoded certificate of every signer, as per the newest scheme the APK is signed with
+    certificates: tuple[bytes, ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class CertificateSummary:
+    # e.g. "C=US, O=Android, CN=Android Debug"
+    distinguished_name: str
+    sha256_digest: str
+    sha1_digest: str
+    md5_digest: str
+
+
+# Reads the signer certificates of an APK on the device, only the end of the APK is read, which has the central
+# directory and the APK Signing Block, and not the whole APK.
+# The signatures are not verified, Android did that when the APK was installed.
+def read_remote_apk_signatures(apk_path: str) -> ApkSignatures:
+    apk_file_size, tail = _read_remote_tail(apk_path)
+    tail_offset = apk_file_size - len(tail)
+
+    def _read_range(offset: int, size: int) -> bytes:
+        if offset >= tail_offset:
+            return tail[offset - tail_offset:offset - tail_offset + size]
+        return _read_remote_range(apk_path, offset, size)
+
+    return read_apk_signatures(_read_range, apk_file_size)
+
+
+def read_local_apk_signatures(apk_path: str) -> ApkSignatures:
+    with open(apk_path, "rb") as apk_file:
+        def _read_range(offset: int, size: int) -> bytes:
+            apk_file.seek(offset)
+            return apk_file.read(size)
+
+        apk_file.seek(0, 2)
+        return read_apk_signatures(_read_range, apk_file.tell())
+
+
+def read_apk_signatures(read_range: RangeReader, apk_file_size: int) -> ApkSignatures:
+    central_directory_offset, central_directory_size = _read_end_of_central_directory(read_range, apk_file_size)
+    signing_block_signatures = _read_signing_block(read_range, central_directory_offset)
+    # The v1 signature is read only when there is no newer one, it needs the whole central directory
+    if signing_block_signatures:
+        newest_scheme = max(signing_block_signatures)
+        schemes = [scheme for scheme, _ in sorted(signing_block_signatures.items())]
+        if _has_v1_signature_file(read_range(central_directory_offset, central_directory_size)):
+            schemes.insert(0, "v1")
+        return ApkSignatures(schemes=tuple(schemes), certificates=signing_block_signatures[newest_scheme])
+    certificates = _read_v1_certificates(read_range, read_range(central_directory_offset, central_directory_size))
+    if not certificates:
+        raise ValueError("The APK is not signed")
+    return ApkSignatures(schemes=("v1",), certificates=certificates)
+
+
+def get_certificate_summary(certificate: bytes) -> CertificateSummary:
+    return CertificateSummary(
+        distinguished_name=_get_subject_distinguished_name(certificate),
+        sha256_digest=hashlib.sha256(certificate).hexdigest(),
+        # These identify the certificate, like apksigner prints them, they do not secure anything
+        sha1_digest=hashlib.sha1(certificate, usedforsecurity=False).hexdigest(),
+        md5_digest=hashlib.md5(certificate, usedforsecurity=False).hexdigest())
+
+
+def _read_remote_tail(apk_path: str) -> tuple[int, bytes]:
+    # The size and the tail are read together, to save a round trip
+    tail_cmd = (f"stat -c %s {shlex.quote(apk_path)} && "
+                f"tail -c {_REMOTE_TAIL_SIZE:d} {shlex.quote(apk_path)} 2>/dev/null")
+    with stream_adb_shell_command(tail_cmd) as stream:
+        size_line = stream.readline()
+        tail = stream.read()
+    if not size_line.strip().isdigit():
+        raise ValueError(f"Unable to read {apk_path}: {size_line.decode('utf-8', errors='replace').strip()}")
+    return int(size_line), tail
+
+
+def _read_remote_range(apk_path: str, offset: int, size: int) -> bytes:
+    # dd reads whole blocks, skip_bytes and count_bytes are not available on the older devices
+    first_block = offset // _REMOTE_BLOCK_SIZE
+    block_count = (offset + size + _REMOTE_BLOCK_SIZE - 1) // _REMOTE_BLOCK_SIZE - first_block
+    dd_cmd = (f"dd if={shlex.quote(apk_path)} bs={_REMOTE_BLOCK_SIZE:d} skip={first_block:d} "
+              f"count={block_count:d} 2>/dev/null")
+    with stream_adb_shell_command(dd_cmd) as stream:
+        data = stream.read()
+    start = offset - first_block * _REMOTE_BLOCK_SIZE
+    return data[start:start + size]
+
+
+# Returns the offset and the size of the central directory
+def _read_end_of_central_directory(read_range: RangeReader, apk_file_size: int) -> tuple[int, int]:
+    search_size = min(apk_file_size, _EOCD_SIZE + _MAX_ZIP_COMMENT_SIZE)
+    data = read_range(apk_file_size - search_size, search_size)
+    eocd_offset = data.rfind(_EOCD_SIGNATURE)
+    while eocd_offset >= 0:
+        comment_size = struct.unpack_from("<H", data, eocd_offset + 20)[0]
+        if eocd_offset + _EOCD_SIZE + comment_size == len(data):
+            central_directory_size, central_directory_offset = struct.unpack_from("<II", data, eocd_offset + 12)
+            if central_directory_offset == _ZIP64_MARKER:
+                raise ValueError("ZIP64 APKs are not supported")
+            return central_directory_offset, central_directory_size
+        eocd_offset = data.rfind(_EOCD_SIGNATURE, 0, eocd_offset)
+    raise ValueError("Not a zip file, no end of central directory record found")
+
+
+# Returns the signer certificates of every scheme in the APK Signing Block, which sits right before the central
+# directory, empty if there is no such block
+def _read_signing_block(read_range: RangeReader, central_directory_offset: int) -> dict[str, tuple[bytes, ...]]:
+    if central_directory_offset < _SIGNING_BLOCK_FOOTER_SIZE:
+        return {}
+    footer = read_range(central_directory_offset - _SIGNING_BLOCK_FOOTER_SIZE, _SIGNING_BLOCK_FOOTER_SIZE)
+    if footer[8:] != _SIGNING_BLOCK_MAGIC:
+        return {}
+    # The size excludes the leading size field itself
+    block_size = struct.unpack_from("<Q", footer)[0]
+    if block_size + 8 > central_directory_offset:
+        raise ValueError(f"Invalid APK Signing Block size {block_size:d}")
+    block = read_range(central_directory_offset - block_size - 8, block_size - _SIGNING_BLOCK_FOOTER_SIZE + 8)
+    signatures = {}
+    offset = 8
+    while offset + 12 <= len(block):
+        pair_size, block_id = struct.unpack_from("<QI", block, offset)
+        if block_id in _SIGNING_BLOCK_IDS:
+            signatures[_SIGNING_BLOCK_IDS[block_id]] = _read_signers(block[offset + 12:offset + 8 + pair_size])
+        offset += 8 + pair_size
+    return signatures
+
+
+# Both v2 and v3 signatures are a sequence of signers, the signed data of each starts with the digests followed by
+# the certificates, all of them are prefixed with their uint32 length
+def _read_signers(signature: bytes) -> tuple[bytes, ...]:
+    certificates = []
+    for signer in _iter_length_prefixed(_read_length_prefixed(signature, 0)):
+        signed_data = _read_length_prefixed(signer, 0)
+        digests_size = struct.unpack_from("<I", signed_data)[0]
+        signer_certificates = list(_iter_length_prefixed(_read_length_prefixed(signed_data, 4 + digests_size)))
+        if signer_certificates:
+            # The first one is the signer's, the rest, if any, are the intermediate ones
+            certificates.append(signer_certificates[0])
+    return tuple(certificates)
+
+
+def _read_length_prefixed(data: bytes, offset: int) -> bytes:
+    size = struct.unpack_from("<I", data, offset)[0]
+    if offset + 4 + size > len(data):
+        raise ValueError("Truncated APK Signing Block")
+    return data[offset + 4:offset + 4 + size]
+
+
+def _iter_length_prefixed(data: bytes) -> Iterator[bytes]:
+    offset = 0
+    while offset + 4 <= len(data):
+        item = _read_length_prefixed(data, offset)
+        yield item
+        offset += 4 + len(item)
+
+
+# Returns the name, and the local header offset, compressed size, and compression method of every file
+def _iter_central_directory(central_directory: bytes) -> Iterator[tuple[str, int, int, int]]:
+    offset = 0
+    while central_directory.startswith(_CENTRAL_DIRECTORY_ENTRY_SIGNATURE, offset):
+        (compression_method, compressed_size, name_size, extra_size, comment_size,
+         local_header_offset) = struct.unpack_from("<10xH8xI4xHHH8xI", central_directory, offset)
+        name_offset = offset + _CENTRAL_DIRECTORY_ENTRY_SIZE
+        name = central_directory[name_offset:name_offset + name_size].decode("utf-8", errors="replace")
+        yield name, local_header_offset, compressed_size, compression_method
+        offset = name_offset + name_size + extra_size + comment_size
+
+
+def _has_v1_signature_file(central_directory: bytes) -> bool:
+    return any(_V1_SIGNATURE_FILE_REGEX.match(name) for name, _, _, _ in _iter_central_directory(central_directory))
+
+
+def _read_v1_certificates(read_range: RangeReader, central_directory: bytes) -> tuple[bytes, ...]:
+    certificates = []
+    for name, local_header_offset, compressed_size, compression_method in _iter_central_directory(central_directory):
+        if not _V1_SIGNATURE_FILE_REGEX.match(name):
+            continue
+        # The extra field of the local header can differ from the one in the central directory
+        local_header = read_range(local_header_offset, _LOCAL_FILE_HEADER_SIZE)
+        name_size, extra_size = struct.unpack_from("<HH", local_header, 26)
+        data = read_range(local_header_offset + _LOCAL_FILE_HEADER_SIZE + name_size + extra_size, compressed_size)
+        if compression_method == _COMPRESSION_METHOD_DEFLATE:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        certificates.extend(_read_pkcs7_certificates(data)[:1])
+    return tuple(certificates)
+
+
+# Returns the certificates of a PKCS #7 SignedData, the first one is the signer's
+def _read_pkcs7_certificates(content_info: bytes) -> list[bytes]:
+    # ContentInfo ::= SEQUENCE { contentType OID, content [0] EXPLICIT SignedData }
+    content_info_items = _read_der_children(content_info, *_read_der_element(content_info, 0)[1:])
+    _, content_start, content_end = content_info_items[1]
+    _, signed_data_start, signed_data_end = _read_der_element(content_info, content_start)
+    if signed_data_end > content_end:
+        raise ValueError("Truncated PKCS #7 signature")
+    # SignedData ::= SEQUENCE { version, digestAlgorithms, contentInfo, certificates [0] IMPLICIT OPTIONAL, ... }
+    for tag, start, end in _read_der_children(content_info, signed_data_start, signed_data_end):
+        if tag != _DER_TAG_CONTEXT_0:
+            continue
+        certificates = []
+        # Whole elements, with their tags and lengths
+        while start < end:
+            certificate_end = _read_der_element(content_info, start)[2]
+            certificates.append(content_info[start:certificate_end])
+            start = certificate_end
+        return certificates
+    return []
+
+
+def _get_subject_distinguished_name(certificate: bytes) -> str:
+    # Certificate ::= SEQUENCE { tbsCertificate, signatureAlgorithm, signature }
+    certificate_items = _read_der_children(certificate, *_read_der_element(certificate, 0)[1:])
+    tbs_certificate_items = _read_der_children(certificate, *certificate_items[0][1:])
+    # TBSCertificate ::= SEQUENCE { version [0] EXPLICIT OPTIONAL, serialNumber, signature, issuer, validity,
+    # subject, ... }
+    if tbs_certificate_items[0][0] == _DER_TAG_CONTEXT_0:
+        tbs_certificate_items = tbs_certificate_items[1:]
+    _, subject_start, subject_end = tbs_certificate_items[4]
+    attributes = []
+    # Name ::= SEQUENCE OF SET OF SEQUENCE { type OID, value }
+    for tag, rdn_start, rdn_end in _read_der_children(certificate, subject_start, subject_end):
+        if tag != _DER_TAG_SET:
+            continue
+        for _, attribute_start, attribute_end in _read_der_children(certificate, rdn_start, rdn_end):
+            attribute_items = _read_der_children(certificate, attribute_start, attribute_end)
+            _, oid_start, oid_end = attribute_items[0]
+            value_tag, value_start, value_end = attribute_items[1]
+            oid = _decode_oid(certificate[oid_start:oid_end])
+            value = certificate[value_start:value_end].decode(_DER_STRING_ENCODINGS.get(value_tag, "utf-8"),
+                                                              errors="replace")
+            attributes.append(f"{_DN_ATTRIBUTE_NAMES.get(oid, oid)}={value}")
+    # Like RFC 2253, and apksigner, in the reverse order of the encoding
+    return ", ".join(reversed(attributes))
+
+
+# Returns the tag, and the start and the end of the contents of the DER element at offset
+def _read_der_element(data: bytes, offset: int) -> tuple[int, int, int]:
+    if offset + 2 > len(data):
+        raise ValueError("Truncated DER element")
+    tag, length = data[offset], data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        num_length_bytes = length & 0x7F
+        if num_length_bytes == 0 or num_length_bytes > 4:
+            raise ValueError("Indefinite or oversized DER lengths are not supported")
+        length = int.from_bytes(data[offset:offset + num_length_bytes], "big")
+        offset += num_length_bytes
+    if offset + length > len(data):
+        raise ValueError("Truncated DER element")
+    return tag, offset, offset + length
+
+
+def _read_der_children(data: bytes, start: int, end: int) -> list[tuple[int, int, int]]:
+    children = []
+    while start < end:
+        child = _read_der_element(data, start)
+        children.append(child)
+        start = child[2]
+    return children
+
+
+def _decode_oid(data: bytes) -> str:
+    first_arc = data[0] // 40 if data[0] < 80 else 2
+    arcs = [first_arc, data[0] - first_arc * 40]
+    value = 0
+    for byte in data[1:]:
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(value)
+            value = 0
+    return ".".join(str(arc) for arc in arcs)
@@ -1,5 +1,6 @@
 import asyncio
 import concurrent.futures
+import contextvars
 from collections.abc import Callable
 from typing import Any, TypeVar
 
@@ -7,6 +8,7 @@ T = TypeVar("T")
 
 
 # Executes method method_to_call for each argument in params_list and returns the result_list
+# Every call runs in a copy of the caller's context, so, it goes to the same device as the caller.
 def execute_in_parallel(method_to_call: Callable[[Any], T], params_list: list[Any]) -> list[T]:
     result_list: list[T] = []
     num_workers = 50
@@ -18,6 +20,7 @@ def execute_in_parallel(method_to_call: Callable[[Any], T], params_list: list[An
             futures = [
                 loop.run_in_executor(
                     executor,
+                    contextvars.copy_context().run,
                     method_to_call,
                     param) for param in params_list2
             ]
@@ -0,0 +1,127 @@
+import hashlib
+import zlib
+from collections.abc import Callable, Iterator
+from typing import BinaryIO
+
+try:
+    from adbe.output_helper import print_error_and_exit, print_verbose
+except ImportError:
+    from output_helper import print_error_and_exit, print_verbose
+
+# The format is written by BackupManagerService, see
+# https://android.googlesource.com/platform/frameworks/base/+/refs/heads/main/services/backup/java/com/android/server/backup/fullbackup/PerformAdbBackupTask.java
+_BACKUP_FILE_MAGIC = b"ANDROID BACKUP"
+_MAX_BACKUP_FILE_VERSION = 5
+_ENCRYPTION_NONE = "none"
+_ENCRYPTION_AES_256 = "AES-256"
+_AES_KEY_SIZE = 32
+_AES_BLOCK_SIZE = 16
+# Version 1 backups derived the master key checksum from the raw bytes of the key, and not from their UTF-8 encoding
+_FIRST_UTF8_CHECKSUM_VERSION = 2
+_STREAM_BUFFER_SIZE = 64 * 1024
+
+
+# Converts an Android backup (.ab) stream, e.g. the output of "bu backup", to a tar stream. Nothing is held in memory
+# or written to the disk beyond a buffer at a time. get_password is called only if the backup is encrypted.
+# Returns the size of the tar.
+def convert_backup_to_tar(backup_stream: BinaryIO, tar_file: BinaryIO, get_password: Callable[[], str]) -> int:
+    magic = _read_header_line(backup_stream)
+    if magic != _BACKUP_FILE_MAGIC.decode():
+        print_error_and_exit(f"Not an Android backup, the backup starts with {magic!r}")
+    version = int(_read_header_line(backup_stream))
+    if version > _MAX_BACKUP_FILE_VERSION:
+        print_error_and_exit(f"Unsupported Android backup version {version:d}")
+    is_compressed = _read_header_line(backup_stream) == "1"
+    encryption = _read_header_line(backup_stream)
+    print_verbose(f"Android backup version {version:d}, compressed: {is_compressed}, encryption: {encryption}")
+
+    chunks = iter(lambda: backup_stream.read(_STREAM_BUFFER_SIZE), b"")
+    if encryption == _ENCRYPTION_AES_256:
+        chunks = _decrypt_chunks(backup_stream, chunks, version, get_password)
+    elif encryption != _ENCRYPTION_NONE:
+        print_error_and_exit(f"Unsupported Android backup encryption {encryption}")
+    if is_compressed:
+        chunks = _decompress_chunks(chunks)
+
+    tar_size = 0
+    for chunk in chunks:
+        tar_file.write(chunk)
+        tar_size += len(chunk)
+    return tar_size
+
+
+def _read_header_line(backup_stream: BinaryIO) -> str:
+    line = backup_stream.readline()
+    if not line.endswith(b"\n"):
+        print_error_and_exit("The backup is empty or truncated, was it confirmed on the device?")
+    return line.rstrip(b"\n").decode("utf-8", errors="replace")
+
+
+def _decompress_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+    if not decompressor.eof:
+        print_error_and_exit("The backup is truncated")
+
+
+# The encrypted payload is AES-256-CBC with a random master key, which is itself encrypted with a key derived from
+# the password with PBKDF2
+def _decrypt_chunks(backup_stream: BinaryIO, chunks: Iterator[bytes], version: int,
+                    get_password: Callable[[], str]) -> Iterator[bytes]:
+    try:
+        # cryptography is an optional dependency, it is only required for encrypted backups
+        from cryptography.hazmat.primitives import padding  # pylint: disable=import-outside-toplevel
+        from cryptography.hazmat.primitives.ciphers import (  # pylint: disable=import-outside-toplevel
+            Cipher,
+            algorithms,
+            modes,
+        )
+    except ImportError:
+        print_error_and_exit('Encrypted backups require cryptography, install it with "pip install cryptography" '
+                             "or leave the backup password empty on the device")
+        return
+
+    user_salt = bytes.fromhex(_read_header_line(backup_stream))
+    checksum_salt = bytes.fromhex(_read_header_line(backup_stream))
+    rounds = int(_read_header_line(backup_stream))
+    user_iv = bytes.fromhex(_read_header_line(backup_stream))
+    encrypted_master_key_blob = bytes.fromhex(_read_header_line(backup_stream))
+
+    user_key = hashlib.pbkdf2_hmac("sha1", get_password().encode(), user_salt, rounds, _AES_KEY_SIZE)
+    decryptor = Cipher(algorithms.AES(user_key), modes.CBC(user_iv)).decryptor()
+    master_key_blob = decryptor.update(encrypted_master_key_blob) + decryptor.finalize()
+    # The blob is the length-prefixed IV, master key, and master key checksum, followed by the padding
+    master_iv, offset = _read_length_prefixed(master_key_blob, 0)
+    master_key, offset = _read_length_prefixed(master_key_blob, offset)
+    master_key_checksum, _ = _read_length_prefixed(master_key_blob, offset)
+    if _get_master_key_checksum(master_key, checksum_salt, rounds, version) != master_key_checksum:
+        print_error_and_exit("Wrong backup password")
+
+    decryptor = Cipher(algorithms.AES(master_key), modes.CBC(master_iv)).decryptor()
+    unpadder = padding.PKCS7(_AES_BLOCK_SIZE * 8).unpadder()
+    for chunk in chunks:
+        yield unpadder.update(decryptor.update(chunk))
+    try:
+        yield unpadder.update(decryptor.finalize()) + unpadder.finalize()
+    except ValueError:
+        print_error_and_exit("The backup is truncated")
+
+
+def _read_length_prefixed(data: bytes, offset: int) -> tuple[bytes, int]:
+    if offset >= len(data) or offset + 1 + data[offset] > len(data):
+        # A wrong password decrypts the blob to garbage
+        print_error_and_exit("Wrong backup password")
+    end = offset + 1 + data[offset]
+    return data[offset + 1:end], end
+
+
+def _get_master_key_checksum(master_key: bytes, checksum_salt: bytes, rounds: int, version: int) -> bytes:
+    if version >= _FIRST_UTF8_CHECKSUM_VERSION:
+        # Java widens every signed byte of the key to a char, and PBKDF2 then encodes the chars as UTF-8
+        key_chars = "".join(chr(byte if byte < 0x80 else 0xFF00 | byte) for byte in master_key)
+        key_bytes = key_chars.encode()
+    else:
+        key_bytes = master_key
+    return hashlib.pbkdf2_hmac("sha1", key_bytes, checksum_salt, rounds, _AES_KEY_SIZE)
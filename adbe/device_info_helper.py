@@ -0,0 +1,128 @@
+import dataclasses
+import re
+import shlex
+
+try:
+    from adbe.adb_helper import execute_adb_shell_command2, get_device
+    from adbe.output_helper import print_error
+except ImportError:
+    from adb_helper import execute_adb_shell_command2, get_device
+    from output_helper import print_error
+
+# Every value is printed after a marker line, so that all of them are fetched with a single shell command.
+# Commands which are not available on older devices, e.g. "settings" below API 17, just print nothing.
+_SECTION_COMMANDS = {
+    "manufacturer": "getprop ro.product.manufacturer",
+    "model": "getprop ro.product.model",
+    # This worked on 4.4.3 API 19 Moto E
+    "display_name": "getprop ro.product.display",
+    # First fallback: undocumented, works on 4.4.4 API 19 Galaxy Grand Prime
+    "system_device_name": "settings get system device_name",
+    # Second fallback, documented to work on API 25 and above
+    # Source: https://developer.android.com/reference/android/provider/Settings.Global.html#DEVICE_NAME
+    "global_device_name": "settings get global device_name",
+    "cpu": "getprop ro.product.cpu.abi",
+    "release": "getprop ro.build.version.release",
+    "sdk": "getprop ro.build.version.sdk",
+    "battery": "dumpsys battery",
+    "storage": "df -k /data",
+    "screen": "dumpsys power | grep -E 'mWakefulness=|Display Power: state='",
+}
+_SECTION_MARKER_PREFIX = "<<adbe:"
+_SECTION_MARKER_SUFFIX = ">>"
+_SECTION_MARKER_REGEX = re.compile(r"^<<adbe:(\w+)>>$")
+_BATTERY_LEVEL_REGEX = re.compile(r"^\s*level:\s*(\d+)", re.MULTILINE)
+_WAKEFULNESS_REGEX = re.compile(r"mWakefulness=(\w+)")
+_DISPLAY_POWER_STATE_REGEX = re.compile(r"Display Power: state=(\w+)")
+# Dreaming is the screen saver, so, the screen is still on
+_SCREEN_STATES = {"Awake": "on", "Dreaming": "on", "Dozing": "doze", "Asleep": "off", "ON": "on", "OFF": "off"}
+_BYTES_PER_KB = 1024
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclasses.dataclass(frozen=True)
+class DeviceSummary:
+    serial: str
+    manufacturer: str | None
+    model: str | None
+    display_name: str | None
+    release: str | None
+    sdk: str | None
+    cpu: str | None
+    # In percent
+    battery_level: int | None
+    # Free space on the data partition, where apps and their data live
+    storage_free_bytes: int | None
+    # "on", "off", or "doze"
+    screen: str | None
+    # "usb", "tcpip", or "emulator"
+    transport: str
+
+
+# Collects the device info with a single shell command, instead of one per property.
+def get_device_summary(device_serial: str) -> DeviceSummary:
+    script = "; ".join(f"echo '{_SECTION_MARKER_PREFIX}{name}{_SECTION_MARKER_SUFFIX}'; {cmd} 2>/dev/null"
+                       for name, cmd in _SECTION_COMMANDS.items())
+    return_code, stdout, stderr = execute_adb_shell_command2(shlex.quote(script), device_serial=device_serial)
+    if return_code != 0 and not stdout:
+        print_error(f"Failed to get the info of device {device_serial}: {stderr}")
+    sections = _split_sections(stdout or "")
+    display_name = next((name for name in (sections.get("display_name"), sections.get("system_device_name"),
+                                           sections.get("global_device_name")) if name and name != "null"), None)
+    return DeviceSummary(
+        serial=device_serial,
+        manufacturer=sections.get("manufacturer"),
+        model=sections.get("model"),
+        display_name=display_name,
+        release=sections.get("release"),
+        sdk=sections.get("sdk"),
+        cpu=sections.get("cpu"),
+        battery_level=_parse_battery_level(sections.get("battery", "")),
+        storage_free_bytes=_parse_storage_free_bytes(sections.get("storage", "")),
+        screen=_parse_screen_state(sections.get("screen", "")),
+        transport=_get_transport(device_serial))
+
+
+def _split_sections(output: str) -> dict[str, str]:
+    sections: dict[str, list[str]] = {}
+    section_lines: list[str] = []
+    for line in output.splitlines():
+        marker_match = _SECTION_MARKER_REGEX.match(line.strip())
+        if marker_match is not None:
+            section_lines = sections.setdefault(marker_match.group(1), [])
+        else:
+            section_lines.append(line)
+    return {name: "\n".join(lines).strip() for name, lines in sections.items() if "".join(lines).strip()}
+
+
+def _parse_battery_level(battery_dump: str) -> int | None:
+    level_match = _BATTERY_LEVEL_REGEX.search(battery_dump)
+    return int(level_match.group(1)) if level_match is not None else None
+
+
+# Parses the output of "df -k", e.g.
+# Filesystem       1K-blocks    Used Available Use% Mounted on
+# /dev/block/dm-5   57225328 9432104  47662152  17% /data
+def _parse_storage_free_bytes(df_output: str) -> int | None:
+    lines = df_output.splitlines()
+    if len(lines) < 2 or "Available" not in lines[0].split():
+        return None
+    # Long file system names make busybox wrap the rest of the row to the next line
+    values = " ".join(lines[1:]).split()
+    available_index = lines[0].split().index("Available")
+    if available_index >= len(values) or not values[available_index].isdigit():
+        return None
+    return int(values[available_index]) * _BYTES_PER_KB
+
+
+def _parse_screen_state(power_dump: str) -> str | None:
+    state_match = _WAKEFULNESS_REGEX.search(power_dump) or _DISPLAY_POWER_STATE_REGEX.search(power_dump)
+    return _SCREEN_STATES.get(state_match.group(1)) if state_match is not None else None
+
+
+def _get_transport(device_serial: str) -> str:
+    if device_serial.startswith("emulator-"):
+        return "emulator"
+    if get_device(device_serial).is_connected_over_tcp_ip():
+        return "tcpip"
+    return "usb"
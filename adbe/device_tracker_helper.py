@@ -0,0 +1,231 @@
+import contextlib
+import dataclasses
+import os
+import re
+import socket
+import threading
+from collections.abc import Callable, Iterator
+
+try:
+    from adbe.adb_helper import execute_adb_command2
+    from adbe.output_helper import print_error_and_exit, print_verbose
+except ImportError:
+    from adb_helper import execute_adb_command2
+    from output_helper import print_error_and_exit, print_verbose
+
+DEVICE_STATE_ONLINE = "device"
+DEVICE_STATE_OFFLINE = "offline"
+DEVICE_STATE_UNAUTHORIZED = "unauthorized"
+
+# Same as adb, the adb server listens on this address unless these environment variables say otherwise
+_ADB_SERVER_HOST_ENV_VAR = "ANDROID_ADB_SERVER_ADDRESS"
+_ADB_SERVER_PORT_ENV_VAR = "ANDROID_ADB_SERVER_PORT"
+_ADB_SERVER_DEFAULT_HOST = "localhost"
+_ADB_SERVER_DEFAULT_PORT = 5037
+_ADB_SERVER_CONNECT_TIMEOUT_SECONDS = 5
+# The server sends the whole device list, in the "adb devices -l" format, right away and then whenever it changes
+_TRACK_DEVICES_REQUEST = "host:track-devices-l"
+# Every message from the adb server is prefixed with its length as 4 hex digits
+_MESSAGE_LENGTH_SIZE = 4
+# The first token of a device line is the serial, the device properties, e.g. "model:Pixel_7", follow the state
+_DEVICE_PROPERTY_REGEX = re.compile(r"^(product|model|device|transport_id|usb|features):(.*)$")
+
+
+@dataclasses.dataclass(frozen=True)
+class DeviceInfo:
+    serial: str
+    # One of the DEVICE_STATE_* constants, or another state reported by adb, e.g. "recovery" or "no permissions"
+    state: str
+    # e.g. product, model, device, and transport_id
+    properties: dict[str, str] = dataclasses.field(default_factory=dict, compare=False, hash=False)
+
+
+@dataclasses.dataclass(frozen=True)
+class DeviceEvent:
+    serial: str
+    # None if the device was just attached
+    old_state: str | None
+    # None if the device was detached
+    new_state: str | None
+
+
+class DeviceTracker:
+    """
+    A live registry of the devices known to the adb server, kept up to date by a single "track-devices" connection,
+    so, nothing has to poll "adb devices".
+    Listeners are called, on the tracker's thread, whenever a device is attached, detached, or changes its state, e.g.
+    >>> with track_devices() as tracker:
+    ...     tracker.add_listener(lambda event: print(event.serial, event.new_state))
+    ...     tracker.wait_for_state("emulator-5554", DEVICE_STATE_ONLINE, timeout_seconds=60)
+    """
+
+    def __init__(self) -> None:
+        self._devices: dict[str, DeviceInfo] = {}
+        self._listeners: list[Callable[[DeviceEvent], None]] = []
+        self._devices_changed = threading.Condition()
+        self._connection: socket.socket | None = None
+
+    def start(self) -> None:
+        """
+        Connects to the adb server and returns once the current device list is known. If the adb server can't be
+        reached directly, the device list is read once with "adb devices -l" instead, and is never updated.
+        """
+        try:
+            self._connection = _open_track_devices_connection()
+            self._update(_read_message(self._connection))
+        except OSError as e:
+            self.close()
+            print_verbose(f"Failed to track the devices via the adb server, falling back to \"adb devices -l\": {e}")
+            self._update(_read_device_list_via_adb())
+            return
+        threading.Thread(target=self._track, args=(self._connection,), name="device-tracker", daemon=True).start()
+
+    def close(self) -> None:
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            # Unblocks the tracker's thread
+            with contextlib.suppress(OSError):
+                connection.shutdown(socket.SHUT_RDWR)
+            connection.close()
+
+    def get_devices(self) -> list[DeviceInfo]:
+        with self._devices_changed:
+            return list(self._devices.values())
+
+    # Returns None if the device is not attached
+    def get_state(self, serial: str) -> str | None:
+        with self._devices_changed:
+            device = self._devices.get(serial)
+            return device.state if device is not None else None
+
+    def add_listener(self, listener: Callable[[DeviceEvent], None]) -> None:
+        with self._devices_changed:
+            self._listeners.append(listener)
+
+    # Waits till the device is in the given state, None for detached, and returns False if it timed out.
+    # Without a connection to the adb server, the state can't change, so, this returns right away.
+    def wait_for_state(self, serial: str, state: str | None, timeout_seconds: float | None = None) -> bool:
+        with self._devices_changed:
+            if self._connection is None:
+                return self.get_state(serial) == state
+            return self._devices_changed.wait_for(lambda: self.get_state(serial) == state, timeout_seconds)
+
+    def _track(self, connection: socket.socket) -> None:
+        try:
+            while True:
+                self._update(_read_message(connection))
+        except OSError as e:
+            if self._connection is connection:
+                print_verbose(f"Lost the connection to the adb server: {e}")
+                # Without the adb server, none of the devices are reachable
+                self._update("")
+
+    def _update(self, device_list: str) -> None:
+        devices = {device.serial: device for device in _parse_device_list(device_list)}
+        with self._devices_changed:
+            old_devices, self._devices = self._devices, devices
+            listeners = list(self._listeners)
+            self._devices_changed.notify_all()
+        for serial in [*old_devices, *(serial for serial in devices if serial not in old_devices)]:
+            old_state = old_devices[serial].state if serial in old_devices else None
+            new_state = devices[serial].state if serial in devices else None
+            if old_state == new_state:
+                continue
+            print_verbose(f"Device {serial}: {old_state} -> {new_state}")
+            for listener in listeners:
+                listener(DeviceEvent(serial=serial, old_state=old_state, new_state=new_state))
+
+
+@contextlib.contextmanager
+def track_devices() -> Iterator[DeviceTracker]:
+    device_tracker = DeviceTracker()
+    device_tracker.start()
+    try:
+        yield device_tracker
+    finally:
+        device_tracker.close()
+
+
+# Returns the devices known to the adb server, with a single request to the server instead of spawning
+# "adb devices -l". Falls back to "adb devices -l" if the adb server can't be reached directly.
+def get_device_list() -> list[DeviceInfo]:
+    try:
+        with _open_track_devices_connection() as connection:
+            return _parse_device_list(_read_message(connection))
+    except OSError as e:
+        print_verbose(f"Failed to query the adb server directly, falling back to \"adb devices -l\": {e}")
+    return _parse_device_list(_read_device_list_via_adb())
+
+
+# Returns the device lines of "adb devices -l"
+def _read_device_list_via_adb() -> str:
+    cmd = "devices -l"
+    return_code, stdout, stderr = execute_adb_command2(cmd)
+    if return_code != 0:
+        print_error_and_exit(f"Failed to execute command {cmd}, error: {stderr} ")
+    # Skip the first line, it says "List of devices attached"
+    return "\n".join((stdout or "").split("\n")[1:])
+
+
+def _open_track_devices_connection() -> socket.socket:
+    try:
+        return _send_request(_TRACK_DEVICES_REQUEST)
+    except ConnectionRefusedError:
+        # Same as adb itself, start the server on demand
+        print_verbose("adb server is not running, starting it")
+        execute_adb_command2("start-server")
+        return _send_request(_TRACK_DEVICES_REQUEST)
+
+
+# Returns the connection over which the server responds to the request
+def _send_request(request: str) -> socket.socket:
+    host = os.environ.get(_ADB_SERVER_HOST_ENV_VAR) or _ADB_SERVER_DEFAULT_HOST
+    port = int(os.environ.get(_ADB_SERVER_PORT_ENV_VAR) or _ADB_SERVER_DEFAULT_PORT)
+    connection = socket.create_connection((host, port), timeout=_ADB_SERVER_CONNECT_TIMEOUT_SECONDS)
+    try:
+        connection.sendall(f"{len(request):04x}{request}".encode())
+        status = _read_exactly(connection, 4)
+        if status != b"OKAY":
+            raise OSError(f"adb server rejected {request}: {status.decode('utf-8', errors='replace')} "
+                          f"{_read_message(connection)}")
+        # Messages are only sent when the devices change, which can take arbitrarily long
+        connection.settimeout(None)
+    except BaseException:
+        connection.close()
+        raise
+    return connection
+
+
+def _read_message(connection: socket.socket) -> str:
+    length = int(_read_exactly(connection, _MESSAGE_LENGTH_SIZE), 16)
+    return _read_exactly(connection, length).decode("utf-8", errors="replace")
+
+
+def _read_exactly(connection: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("adb server closed the connection")
+        data.extend(chunk)
+    return bytes(data)
+
+
+# Parses the lines of "adb devices -l", e.g.
+# "emulator-5554          device product:sdk_gphone64_x86_64 model:sdk_gphone64_x86_64 device:emu64xa transport_id:1"
+def _parse_device_list(device_list: str) -> list[DeviceInfo]:
+    devices = []
+    for line in device_list.splitlines():
+        tokens = line.split()
+        if len(tokens) < 2:
+            continue
+        state_tokens = []
+        properties = {}
+        for token in tokens[1:]:
+            property_match = _DEVICE_PROPERTY_REGEX.match(token)
+            if property_match is not None:
+                properties[property_match.group(1)] = property_match.group(2)
+            elif not properties:
+                state_tokens.append(token)
+        devices.append(DeviceInfo(serial=tokens[0], state=" ".join(state_tokens), properties=properties))
+    return devices
@@ -0,0 +1,275 @@
+import asyncio
+import contextlib
+import dataclasses
+import heapq
+import itertools
+import json
+import shlex
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+import psutil
+
+try:
+    from adbe.adb_helper import get_device
+    from adbe.device_tracker_helper import (
+        DEVICE_STATE_ONLINE,
+        DeviceTracker,
+        get_device_list,
+        track_devices,
+    )
+    from adbe.multi_device_helper import get_adbe_cmd
+    from adbe.output_helper import print_error, print_error_and_exit, print_message
+except ImportError:
+    from adb_helper import get_device
+    from device_tracker_helper import (
+        DEVICE_STATE_ONLINE,
+        DeviceTracker,
+        get_device_list,
+        track_devices,
+    )
+    from multi_device_helper import get_adbe_cmd
+    from output_helper import print_error, print_error_and_exit, print_message
+
+JOB_STATUS_PASSED = "passed"
+JOB_STATUS_FAILED = "failed"
+JOB_STATUS_TIMED_OUT = "timed_out"
+# The device disconnected and the job could not be retried on another one
+JOB_STATUS_DEVICE_LOST = "device_lost"
+
+# Keeps the jobs of the same priority in the order of submission
+_job_sequence_numbers = itertools.count()
+
+
+@dataclasses.dataclass(frozen=True)
+class FarmJob:
+    """
+    A job is either an adbe command, e.g. "install app.apk", or a device shell command, e.g. "am instrument -w ...".
+    A job pinned to a device only runs on that device, any other job runs on whichever device is free first.
+    Higher priority jobs run first.
+    max_retries is how many times a job is retried on another device after its device disconnects.
+    """
+    name: str
+    adbe_args: list[str] | None = None
+    shell_cmd: str | None = None
+    priority: int = 0
+    device_serial: str | None = None
+    max_retries: int = 1
+    timeout_seconds: float | None = None
+
+
+@dataclasses.dataclass(frozen=True)
+class FarmJobResult:
+    name: str
+    # The device of the last attempt
+    serial: str | None
+    # One of the JOB_STATUS_* constants
+    status: str
+    attempts: int
+    # From the start of the run till the start of the last attempt
+    wait_seconds: float
+    # Of the last attempt
+    duration_seconds: float
+    output: str
+
+
+class FarmScheduler:
+    """
+    Runs jobs on a pool of devices, with at most max_jobs_per_device jobs running on a device at a time.
+    Every device picks its next job as soon as it is free, so, the devices which finish early take over the
+    remaining jobs instead of sitting idle.
+    """
+
+    def __init__(self, device_serials: list[str], device_tracker: DeviceTracker, *, max_jobs_per_device: int = 1,
+                 on_result: Callable[[FarmJobResult], None] | None = None) -> None:
+        self._max_jobs_per_device = max(max_jobs_per_device, 1)
+        # Heaps of (-priority, sequence number, job, attempts so far)
+        self._shared_queue: list[tuple[int, int, FarmJob, int]] = []
+        self._pinned_queues: dict[str, list[tuple[int, int, FarmJob, int]]] = {
+            device_serial: [] for device_serial in device_serials}
+        self._device_tracker = device_tracker
+        self._results: list[FarmJobResult] = []
+        self._on_result = on_result
+        self._unfinished_job_count = 0
+
+    def submit(self, job: FarmJob) -> None:
+        if job.device_serial is not None and job.device_serial not in self._pinned_queues:
+            print_error_and_exit(f'Job "{job.name}" is pinned to {job.device_serial}, which is not in the device pool')
+        self._enqueue(job, 0)
+        self._unfinished_job_count += 1
+
+    def run(self) -> list[FarmJobResult]:
+        """Runs all the submitted jobs and returns their results in the order of completion."""
+        return asyncio.run(self._run())
+
+    async def _run(self) -> list[FarmJobResult]:
+        start_time = time.monotonic()
+        job_queue_changed = asyncio.Condition()
+        await asyncio.gather(*(
+            self._run_device_slot(device_serial, job_queue_changed, start_time)
+            for device_serial in list(self._pinned_queues) for _ in range(self._max_jobs_per_device)))
+        # Jobs left over when all the devices are gone
+        self._fail_queued_jobs(self._shared_queue, start_time)
+        return self._results
+
+    async def _run_device_slot(self, device_serial: str, job_queue_changed: asyncio.Condition,
+                               start_time: float) -> None:
+        # Lost devices are removed from the pool
+        while device_serial in self._pinned_queues:
+            queued_job = self._dequeue(device_serial)
+            if queued_job is None:
+                if self._unfinished_job_count == 0:
+                    return
+                # A running job might still be put back in the queue if its device disconnects
+                async with job_queue_changed:
+                    await job_queue_changed.wait()
+                continue
+
+            job, attempts = queued_job
+            result = await _run_job(job, device_serial, attempts + 1, start_time)
+            if (result.status != JOB_STATUS_PASSED
+                    and self._device_tracker.get_state(device_serial) != DEVICE_STATE_ONLINE):
+                print_error(f"Device {device_serial} disconnected, removing it from the pool")
+                self._fail_queued_jobs(self._pinned_queues.pop(device_serial, []), start_time)
+                if job.device_serial is None and result.attempts <= job.max_retries:
+                    self._enqueue(job, result.attempts)
+                    result = None
+                else:
+                    result = dataclasses.replace(result, status=JOB_STATUS_DEVICE_LOST)
+            if result is not None:
+                self._add_result(result)
+                self._unfinished_job_count -= 1
+            async with job_queue_changed:
+                job_queue_changed.notify_all()
+
+    def _fail_queued_jobs(self, queue: list[tuple[int, int, FarmJob, int]], start_time: float) -> None:
+        while queue:
+            _, _, job, attempts = heapq.heappop(queue)
+            self._add_result(FarmJobResult(
+                name=job.name, serial=job.device_serial, status=JOB_STATUS_DEVICE_LOST, attempts=attempts,
+                wait_seconds=time.monotonic() - start_time, duration_seconds=0, output=""))
+            self._unfinished_job_count -= 1
+
+    def _enqueue(self, job: FarmJob, attempts: int) -> None:
+        queue = self._shared_queue if job.device_serial is None else self._pinned_queues[job.device_serial]
+        heapq.heappush(queue, (-job.priority, next(_job_sequence_numbers), job, attempts))
+
+    # Returns the highest priority job that can run on the device, along with its attempts so far
+    def _dequeue(self, device_serial: str) -> tuple[FarmJob, int] | None:
+        pinned_queue = self._pinned_queues[device_serial]
+        candidate_queues = [queue for queue in (pinned_queue, self._shared_queue) if queue]
+        if not candidate_queues:
+            return None
+        _, _, job, attempts = heapq.heappop(min(candidate_queues, key=lambda queue: queue[0][:2]))
+        return job, attempts
+
+    def _add_result(self, result: FarmJobResult) -> None:
+        self._results.append(result)
+        if self._on_result is not None:
+            self._on_result(result)
+
+
+# Reads the jobs file, which is JSON or, if PyYAML is installed, YAML, e.g.
+# {"devices": ["emulator-5554"], "max_jobs_per_device": 1,
+#  "jobs": [{"name": "install", "adbe": "install app.apk", "all_devices": true, "priority": 10},
+#           {"name": "test", "shell": "am instrument -w com.example.test/androidx.test.runner.AndroidJUnitRunner",
+#            "retries": 2, "timeout": 600}]}
+# Without "devices", all the connected devices are used. Jobs with "all_devices" run once on every device and jobs
+# with "device" only run on that device.
+# Returns the exit code, 0 if all the jobs passed, 1 otherwise.
+def run_farm(jobs_file_path: str, *, json_output: bool) -> int:
+    farm_config = _read_farm_config(jobs_file_path)
+    device_serials = farm_config.get("devices") or [
+        device.serial for device in get_device_list() if device.state == DEVICE_STATE_ONLINE]
+    if not device_serials:
+        print_error_and_exit("No devices found")
+    with track_devices() as device_tracker:
+        scheduler = FarmScheduler(
+            device_serials, device_tracker, max_jobs_per_device=int(farm_config.get("max_jobs_per_device", 1)),
+            on_result=_print_json_result if json_output else _print_result)
+        for job_config in farm_config.get("jobs", []):
+            if job_config.get("all_devices"):
+                for device_serial in device_serials:
+                    scheduler.submit(_get_job(job_config, device_serial))
+            else:
+                scheduler.submit(_get_job(job_config, job_config.get("device")))
+        results = scheduler.run()
+
+    failed_results = [result for result in results if result.status != JOB_STATUS_PASSED]
+    for result in failed_results:
+        print_error(f'[{result.serial}] {result.name}: {result.status}\n{result.output}')
+    print_message(f"{len(results) - len(failed_results):d} of {len(results):d} jobs passed")
+    return 1 if failed_results else 0
+
+
+def _print_result(result: FarmJobResult) -> None:
+    print_message(f"[{result.serial}] {result.name}: {result.status} in {result.duration_seconds:.1f} seconds "
+                  f"(waited {result.wait_seconds:.1f} seconds, attempt {result.attempts:d})")
+
+
+def _print_json_result(result: FarmJobResult) -> None:
+    print_message(json.dumps(dataclasses.asdict(result)))
+
+
+def _read_farm_config(jobs_file_path: str) -> dict[str, Any]:
+    if not Path(jobs_file_path).exists():
+        print_error_and_exit(f"Jobs file {jobs_file_path} does not exist")
+    content = Path(jobs_file_path).read_text(encoding="utf-8")
+    if Path(jobs_file_path).suffix.lower() not in (".yaml", ".yml"):
+        return json.loads(content)
+    try:
+        # PyYAML is an optional dependency, it is only required for YAML jobs files
+        import yaml  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        print_error_and_exit('YAML jobs files require PyYAML, install it with "pip install PyYAML" or use JSON')
+        return {}
+    return yaml.safe_load(content)
+
+
+def _get_job(job_config: dict[str, Any], device_serial: str | None) -> FarmJob:
+    adbe_cmd = job_config.get("adbe")
+    shell_cmd = job_config.get("shell")
+    if (adbe_cmd is None) == (shell_cmd is None):
+        print_error_and_exit(f'Every job needs exactly one of "adbe" or "shell", this one does not: {job_config}')
+    if isinstance(adbe_cmd, str):
+        adbe_cmd = shlex.split(adbe_cmd)
+    return FarmJob(
+        name=job_config.get("name") or adbe_cmd and " ".join(adbe_cmd) or shell_cmd,
+        adbe_args=adbe_cmd, shell_cmd=shell_cmd, priority=int(job_config.get("priority", 0)),
+        device_serial=device_serial, max_retries=int(job_config.get("retries", 1)),
+        timeout_seconds=job_config.get("timeout"))
+
+
+async def _run_job(job: FarmJob, device_serial: str, attempt: int, run_start_time: float) -> FarmJobResult:
+    start_time = time.monotonic()
+    if job.adbe_args is not None:
+        process = await asyncio.create_subprocess_exec(
+            *get_adbe_cmd(device_serial, job.adbe_args), stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    else:
+        process = await asyncio.create_subprocess_shell(
+            f"{get_device(device_serial).adb_prefix} shell {shlex.quote(job.shell_cmd)}",
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), job.timeout_seconds)
+        status = JOB_STATUS_PASSED if process.returncode == 0 else JOB_STATUS_FAILED
+    except asyncio.TimeoutError:
+        _kill_process_tree(process.pid)
+        output, _ = await process.communicate()
+        status = JOB_STATUS_TIMED_OUT
+    return FarmJobResult(
+        name=job.name, serial=device_serial, status=status, attempts=attempt,
+        wait_seconds=start_time - run_start_time, duration_seconds=time.monotonic() - start_time,
+        output=output.decode("utf-8", errors="replace").strip())
+
+
+# The job's adb processes hold on to its output pipe, so, they have to be killed along with the job
+def _kill_process_tree(pid: int) -> None:
+    with contextlib.suppress(psutil.NoSuchProcess):
+        process = psutil.Process(pid)
+        for child in process.children(recursive=True):
+            with contextlib.suppress(psutil.NoSuchProcess):
+                child.kill()
+        process.kill()
@@ -0,0 +1,144 @@
+import bisect
+import csv
+import dataclasses
+import shlex
+import statistics
+import time
+from collections.abc import Iterator
+
+try:
+    from adbe.adb_helper import execute_adb_shell_command2
+    from adbe.output_helper import print_error_and_exit, print_message, print_verbose
+except ImportError:
+    from adb_helper import execute_adb_shell_command2
+    from output_helper import print_error_and_exit, print_message, print_verbose
+
+# The format is documented at https://developer.android.com/training/testing/performance
+_PROFILE_DATA_MARKER = "---PROFILEDATA---"
+_FLAGS_COLUMN = "Flags"
+_INTENDED_VSYNC_COLUMN = "IntendedVsync"
+_FRAME_COMPLETED_COLUMN = "FrameCompleted"
+# Only on API 31 and above
+_FRAME_DEADLINE_COLUMN = "FrameDeadline"
+_FRAME_DURATION_COLUMN = "FrameDurationNs"
+_JANKY_COLUMN = "Janky"
+# The deadline at 60 Hz, for the devices which do not report it
+_DEFAULT_FRAME_DEADLINE_NS = 16_666_667
+# Frames slower than this are frozen frames, as defined by Android vitals
+_FROZEN_FRAME_DURATION_NS = 700_000_000
+# The device keeps the last 120 frames only, which are rendered in a second at 120 Hz
+_POLL_INTERVAL_SECONDS = 0.5
+# Every bucket counts the frames which took at most as many milliseconds, and more than the previous bucket
+_HISTOGRAM_BUCKET_LIMITS_MS = (8, 16, 24, 32, 50, 100, 200, 700)
+
+
+@dataclasses.dataclass(frozen=True)
+class FrameSummary:
+    frame_count: int
+    janky_frame_count: int
+    frozen_frame_count: int
+    p50_frame_duration_ms: float
+    p90_frame_duration_ms: float
+    p99_frame_duration_ms: float
+    # The frame counts of _HISTOGRAM_BUCKET_LIMITS_MS, followed by the count of the slower frames
+    histogram: tuple[int, ...]
+
+
+# Returns the timings of every frame that the app renders in the next duration_seconds seconds, in the order of
+# rendering. Every frame is a dict of the "framestats" columns, e.g. "IntendedVsync", to their values.
+def sample_frames(app_name: str, duration_seconds: float) -> list[dict[str, int]]:
+    quoted_app_name = shlex.quote(app_name)
+    execute_adb_shell_command2(f"dumpsys gfxinfo {quoted_app_name} reset")
+    # Only the frame timings are transferred, and not the rest of the dump
+    framestats_cmd = (f"dumpsys gfxinfo {quoted_app_name} framestats | "
+                      f"sed -n '/{_PROFILE_DATA_MARKER}/,/{_PROFILE_DATA_MARKER}/p'")
+    # The consecutive samples overlap, the frames are identified by their timings
+    frames: dict[tuple[int, int], dict[str, int]] = {}
+    deadline = time.monotonic() + duration_seconds
+    while True:
+        remaining_seconds = deadline - time.monotonic()
+        time.sleep(max(0.0, min(_POLL_INTERVAL_SECONDS, remaining_seconds)))
+        return_code, stdout, stderr = execute_adb_shell_command2(shlex.quote(framestats_cmd))
+        if return_code != 0:
+            print_error_and_exit(f"Failed to get the frame timings of {app_name}: {stderr}")
+        frame_count = len(frames)
+        for frame in _parse_framestats(stdout or ""):
+            frames[frame[_INTENDED_VSYNC_COLUMN], frame[_FRAME_COMPLETED_COLUMN]] = frame
+        print_verbose(f"Sampled {len(frames) - frame_count:d} new frames of {app_name}")
+        if remaining_seconds <= _POLL_INTERVAL_SECONDS:
+            break
+    return [frames[key] for key in sorted(frames)]
+
+
+def get_frame_summary(frames: list[dict[str, int]]) -> FrameSummary:
+    frame_durations_ms = [_get_frame_duration_ns(frame) / 1_000_000 for frame in frames]
+    if len(frame_durations_ms) > 1:
+        percentiles = statistics.quantiles(frame_durations_ms, n=100, method="inclusive")
+        p50, p90, p99 = percentiles[49], percentiles[89], percentiles[98]
+    else:
+        p50 = p90 = p99 = frame_durations_ms[0]
+    histogram = [0] * (len(_HISTOGRAM_BUCKET_LIMITS_MS) + 1)
+    for frame_duration_ms in frame_durations_ms:
+        histogram[bisect.bisect_left(_HISTOGRAM_BUCKET_LIMITS_MS, frame_duration_ms)] += 1
+    return FrameSummary(
+        frame_count=len(frames),
+        janky_frame_count=sum(_is_janky(frame) for frame in frames),
+        frozen_frame_count=sum(_get_frame_duration_ns(frame) > _FROZEN_FRAME_DURATION_NS for frame in frames),
+        p50_frame_duration_ms=p50, p90_frame_duration_ms=p90, p99_frame_duration_ms=p99,
+        histogram=tuple(histogram))
+
+
+def print_frame_summary(app_name: str, summary: FrameSummary) -> None:
+    print_message(f"{app_name}: {summary.frame_count:d} frames, {summary.janky_frame_count:d} janky "
+                  f"({_get_percentage(summary.janky_frame_count, summary.frame_count)}), "
+                  f"{summary.frozen_frame_count:d} frozen")
+    print_message(f"Frame time p50: {summary.p50_frame_duration_ms:.2f} ms, "
+                  f"p90: {summary.p90_frame_duration_ms:.2f} ms, p99: {summary.p99_frame_duration_ms:.2f} ms")
+    bucket_labels = [f"<={limit_ms:d} ms" for limit_ms in _HISTOGRAM_BUCKET_LIMITS_MS]
+    bucket_labels.append(f">{_HISTOGRAM_BUCKET_LIMITS_MS[-1]:d} ms")
+    for bucket_label, frame_count in zip(bucket_labels, summary.histogram, strict=True):
+        print_message(f"{bucket_label:>9}: {frame_count:d} ({_get_percentage(frame_count, summary.frame_count)})")
+
+
+# Writes a row per frame with the "framestats" columns, the frame's duration, and whether it was janky
+def write_frames_csv(frames: list[dict[str, int]], csv_file_path: str) -> None:
+    columns = list(dict.fromkeys(column for frame in frames for column in frame))
+    with open(csv_file_path, "w", encoding="utf-8", newline="") as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=[*columns, _FRAME_DURATION_COLUMN, _JANKY_COLUMN])
+        csv_writer.writeheader()
+        for frame in frames:
+            csv_writer.writerow({**frame, _FRAME_DURATION_COLUMN: _get_frame_duration_ns(frame),
+                                 _JANKY_COLUMN: int(_is_janky(frame))})
+
+
+# Yields the frames of every window of the app, the column names are read from the header of each window's table
+def _parse_framestats(framestats: str) -> Iterator[dict[str, int]]:
+    columns: list[str] | None = None
+    for line in framestats.splitlines():
+        line = line.strip()
+        if line == _PROFILE_DATA_MARKER:
+            columns = None
+        elif line.startswith(f"{_FLAGS_COLUMN},"):
+            columns = [column for column in line.split(",") if column]
+        elif columns is not None and line:
+            try:
+                frame = dict(zip(columns, (int(value) for value in line.rstrip(",").split(",")), strict=False))
+            except ValueError:
+                continue
+            # The frames with any flags set, e.g. the first frame of a window, are outliers which must be ignored
+            if frame.get(_FLAGS_COLUMN) == 0 and frame.get(_INTENDED_VSYNC_COLUMN, 0) > 0:
+                yield frame
+
+
+def _get_frame_duration_ns(frame: dict[str, int]) -> int:
+    return frame[_FRAME_COMPLETED_COLUMN] - frame[_INTENDED_VSYNC_COLUMN]
+
+
+def _is_janky(frame: dict[str, int]) -> bool:
+    if _FRAME_DEADLINE_COLUMN in frame:
+        return frame[_FRAME_COMPLETED_COLUMN] > frame[_FRAME_DEADLINE_COLUMN]
+    return _get_frame_duration_ns(frame) > _DEFAULT_FRAME_DEADLINE_NS
+
+
+def _get_percentage(count: int, total_count: int) -> str:
+    return f"{100 * count / max(total_count, 1):.2f}%"
@@ -0,0 +1,132 @@
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import re
+import shlex
+import struct
+import tempfile
+import threading
+import zipfile
+from pathlib import Path
+
+try:
+    from adbe import apk_helper
+    from adbe.adb_helper import execute_adb_shell_command2, get_device
+    from adbe.output_helper import print_error, print_verbose
+except ImportError:
+    import apk_helper
+    from adb_helper import execute_adb_shell_command2, get_device
+    from output_helper import print_error, print_verbose
+
+# Records the hash of the last build installed on every device, per host, so that it survives across invocations
+_CACHE_DIR_ENV_VAR = "XDG_CACHE_HOME"
+_CACHE_FILE_NAME = "install-cache.json"
+_HASH_BUFFER_SIZE = 1024 * 1024
+_VERSION_CODE_REGEX = re.compile(r"versionCode=(\d+)")
+_LAST_UPDATE_TIME_REGEX = re.compile(r"lastUpdateTime=(.+)")
+
+# Hashing a large APK takes a while, so, it is done once per package, however many devices it is installed on
+_fingerprint_lock = threading.Lock()
+# Reads and writes of the cache file by the install threads of this process
+_cache_file_lock = threading.Lock()
+
+
+@dataclasses.dataclass(frozen=True)
+class PackageFingerprint:
+    package: str
+    version_code: int
+    # Of all the APKs of the package
+    sha256: str
+
+
+# Returns None if the package's manifest can't be read, such packages are always installed
+def get_package_fingerprint(package_path: str) -> PackageFingerprint | None:
+    path = Path(package_path).resolve()
+    apk_paths = sorted(path.glob("*.apk")) if path.is_dir() else [path]
+    # Keyed by the modification times and the sizes as well, so that a rebuilt package is hashed again
+    apk_stats = tuple((str(apk_path), apk_path.stat().st_mtime_ns, apk_path.stat().st_size) for apk_path in apk_paths)
+    try:
+        with _fingerprint_lock:
+            return _get_package_fingerprint(str(path), apk_stats)
+    except (zipfile.BadZipFile, KeyError, ValueError, struct.error) as e:
+        print_error(f"Failed to read the manifest of {package_path}, it will be installed anyway: {e}")
+        return None
+
+
+# Returns True if the package, as identified by the fingerprint, was installed on the current device by adbe and
+# neither the device's version code nor its update time have changed since then, e.g. because of another install.
+def is_installed(fingerprint: PackageFingerprint) -> bool:
+    device_serial = get_device().get_resolved_serial()
+    if device_serial is None:
+        return False
+    installed_version = _get_installed_version(fingerprint.package)
+    if installed_version is None or installed_version[0] != fingerprint.version_code:
+        return False
+    install_record = _read_cache().get(device_serial, {}).get(fingerprint.package)
+    return install_record == {"sha256": fingerprint.sha256, "version_code": fingerprint.version_code,
+                              "last_update_time": installed_version[1]}
+
+
+def record_install(fingerprint: PackageFingerprint) -> None:
+    device_serial = get_device().get_resolved_serial()
+    installed_version = _get_installed_version(fingerprint.package)
+    if device_serial is None or installed_version is None:
+        return
+    with _cache_file_lock:
+        cache = _read_cache()
+        cache.setdefault(device_serial, {})[fingerprint.package] = {
+            "sha256": fingerprint.sha256, "version_code": fingerprint.version_code,
+            "last_update_time": installed_version[1]}
+        _write_cache(cache)
+
+
+@functools.lru_cache
+def _get_package_fingerprint(package_path: str, apk_stats: tuple[tuple[str, int, int], ...]) -> PackageFingerprint:
+    apk_paths = [Path(apk_path) for apk_path, _, _ in apk_stats]
+    sha256 = hashlib.sha256()
+    for apk_path in apk_paths:
+        with apk_path.open("rb") as apk_file:
+            while data := apk_file.read(_HASH_BUFFER_SIZE):
+                sha256.update(data)
+    manifest = apk_helper.read_package_manifest(package_path)
+    print_verbose(f"{package_path} is {manifest.package} version {manifest.version_code:d}, "
+                  f"SHA-256 {sha256.hexdigest()}")
+    return PackageFingerprint(package=manifest.package, version_code=manifest.version_code,
+                              sha256=sha256.hexdigest())
+
+
+# Returns the version code and the last update time of the package on the current device, None if it is not installed
+def _get_installed_version(package: str) -> tuple[int, str] | None:
+    dumpsys_cmd = f"dumpsys package {shlex.quote(package)} | grep -E 'versionCode=|lastUpdateTime='"
+    _, stdout, _ = execute_adb_shell_command2(shlex.quote(dumpsys_cmd), ignore_stderr=True)
+    version_code_match = _VERSION_CODE_REGEX.search(stdout or "")
+    last_update_time_match = _LAST_UPDATE_TIME_REGEX.search(stdout or "")
+    if version_code_match is None or last_update_time_match is None:
+        return None
+    return int(version_code_match.group(1)), last_update_time_match.group(1).strip()
+
+
+def _get_cache_file_path() -> Path:
+    cache_dir = os.environ.get(_CACHE_DIR_ENV_VAR) or Path.home() / ".cache"
+    return Path(cache_dir) / "adbe" / _CACHE_FILE_NAME
+
+
+def _read_cache() -> dict[str, dict[str, dict]]:
+    try:
+        return json.loads(_get_cache_file_path().read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print_error(f"Ignoring the corrupt install cache {_get_cache_file_path()}: {e}")
+        return {}
+
+
+def _write_cache(cache: dict[str, dict[str, dict]]) -> None:
+    cache_file_path = _get_cache_file_path()
+    cache_file_path.parent.mkdir(parents=True, exist_ok=True)
+    # Replaced atomically, so that a concurrent adbe process never reads a partially written cache
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=cache_file_path.parent, delete=False) as tmp_file:
+        json.dump(cache, tmp_file)
+    os.replace(tmp_file.name, cache_file_path)
@@ -0,0 +1,281 @@
+import concurrent.futures
+import contextlib
+import dataclasses
+import functools
+import re
+import shlex
+import struct
+import threading
+import time
+import zipfile
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import BinaryIO
+
+try:
+    from adbe import apk_helper, install_cache_helper
+    from adbe.adb_helper import (
+        execute_adb_command2,
+        execute_adb_shell_command2,
+        get_adb_shell_property,
+        get_device,
+        start_adb_command,
+    )
+    from adbe.output_helper import (
+        print_error,
+        print_error_and_exit,
+        print_message,
+        print_verbose,
+    )
+except ImportError:
+    import apk_helper
+    import install_cache_helper
+    from adb_helper import (
+        execute_adb_command2,
+        execute_adb_shell_command2,
+        get_adb_shell_property,
+        get_device,
+        start_adb_command,
+    )
+    from output_helper import (
+        print_error,
+        print_error_and_exit,
+        print_message,
+        print_verbose,
+    )
+
+# Install sessions, which accept the APKs over stdin, are available from API 21 onwards
+_MIN_API_FOR_INSTALL_SESSIONS = 21
+# Only this much of an APK is held in memory at a time, however many devices it is installed on
+_STREAM_BUFFER_SIZE = 256 * 1024
+_INSTALL_SESSION_ID_REGEX = re.compile(r"\[(\d+)]")
+_UNIVERSAL_APK_NAME = "universal.apk"
+# bundletool names the base module's splits, e.g. "splits/base-master.apk" or "splits/base-arm64_v8a.apk"
+_BASE_SPLIT_REGEX = re.compile(r"^splits/base-(\w+)\.apk$")
+_ABI_SPLIT_NAMES = {"armeabi", "armeabi_v7a", "arm64_v8a", "x86", "x86_64", "mips", "mips64"}
+_DENSITY_SPLIT_DPIS = {"ldpi": 120, "mdpi": 160, "tvdpi": 213, "hdpi": 240, "xhdpi": 320, "xxhdpi": 480,
+                       "xxxhdpi": 640}
+_BYTES_PER_MEGABYTE = 1024 * 1024
+
+
+@dataclasses.dataclass(frozen=True)
+class ApkSource:
+    name: str
+    size: int
+    # Opens the APK for reading, either a file or a member of a zip file
+    open: Callable[[], BinaryIO]
+
+
+# pylint: disable=too-few-public-methods
+class BandwidthLimiter:
+    """Paces the writes of all the threads sharing it, so that together they stay under bytes_per_second."""
+
+    def __init__(self, bytes_per_second: float) -> None:
+        self._bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next_write_time = time.monotonic()
+
+    # Blocks till size more bytes can be written
+    def wait(self, size: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            write_time = max(self._next_write_time, now)
+            self._next_write_time = write_time + size / self._bytes_per_second
+        if write_time > now:
+            time.sleep(write_time - now)
+
+
+# Installs the packages on all the devices concurrently, at most max_parallel devices at a time, and returns 0 if
+# all of them were installed on all the devices, 1 otherwise. None stands for the default device.
+# Every package is either an APK, a directory of split APKs of a single app, or a bundletool ".apks" archive.
+# The APKs are streamed from the disk to every device, nothing is copied to the device's storage first.
+# With skip_identical, a package is not installed again on a device on which adbe already installed the same build.
+def install_on_devices(device_serials: list[str | None], package_paths: list[str], *, max_parallel: int = 8,
+                       max_megabytes_per_second: float | None = None, skip_identical: bool = False) -> int:
+    for package_path in package_paths:
+        if not Path(package_path).exists():
+            print_error_and_exit(f"{package_path} does not exist")
+    bandwidth_limiter = (BandwidthLimiter(max_megabytes_per_second * _BYTES_PER_MEGABYTE)
+                         if max_megabytes_per_second else None)
+    # Read once, and not once per device
+    manifests = {package_path: _read_package_manifest(package_path) for package_path in package_paths}
+
+    def _install_on_device(device_serial: str | None) -> bool:
+        device = get_device(device_serial)
+        # A failed package does not stop the subsequent ones
+        results = [device.run(_install_package, package_path, manifests[package_path], bandwidth_limiter,
+                              skip_identical=skip_identical)
+                   for package_path in package_paths]
+        return all(results)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(max_parallel, 1)) as executor:
+        results = list(executor.map(_install_on_device, device_serials))
+    return 0 if all(results) else 1
+
+
+# Returns None if the manifest can't be read, the package is still installed, the device will report what is wrong
+def _read_package_manifest(package_path: str) -> apk_helper.ApkManifest | None:
+    try:
+        manifest = apk_helper.read_package_manifest(package_path)
+    except (zipfile.BadZipFile, KeyError, ValueError, struct.error) as e:
+        print_verbose(f"Failed to read the manifest of {package_path}: {e}")
+        return None
+    print_verbose(f"{package_path} is {manifest.package} version {manifest.version_code:d}, min SDK "
+                  f"{manifest.min_sdk_version:d}, debuggable: {manifest.debuggable}, allow backup: "
+                  f"{manifest.allow_backup}, requested permissions: {', '.join(manifest.permissions) or 'none'}")
+    return manifest
+
+
+def _install_package(package_path: str, manifest: apk_helper.ApkManifest | None,
+                     bandwidth_limiter: BandwidthLimiter | None, *, skip_identical: bool) -> bool:
+    device = get_device()
+    device_name = device.get_resolved_serial() or "device"
+    start_time = time.monotonic()
+    # Fail before uploading anything
+    if manifest is not None and device.get_api_version() < manifest.min_sdk_version:
+        print_error(f"Failed to install {package_path} on {device_name}, it requires API "
+                    f"{manifest.min_sdk_version:d} but the device is on API {device.get_api_version():d}")
+        return False
+    fingerprint = install_cache_helper.get_package_fingerprint(package_path) if skip_identical else None
+    if fingerprint is not None and install_cache_helper.is_installed(fingerprint):
+        print_message(f"Skipped {package_path} on {device_name}, {fingerprint.package} version "
+                      f"{fingerprint.version_code:d} is already installed")
+        return True
+    if device.get_api_version() < _MIN_API_FOR_INSTALL_SESSIONS:
+        if not package_path.lower().endswith(".apk"):
+            print_error(f"Split APKs can't be installed on {device_name}, it is below API "
+                        f"{_MIN_API_FOR_INSTALL_SESSIONS:d}")
+            return False
+        return_code, _, stderr = execute_adb_command2(
+            f"install {_get_install_flags(manifest)} {shlex.quote(package_path)}")
+        succeeded = return_code == 0
+        error_message = stderr
+    else:
+        with _open_apk_sources(package_path) as apk_sources:
+            succeeded, error_message = _install_in_session(apk_sources, _get_install_flags(manifest),
+                                                           bandwidth_limiter)
+
+    if not succeeded:
+        print_error(f"Failed to install {package_path} on {device_name}: {error_message}")
+        return False
+    if fingerprint is not None:
+        install_cache_helper.record_install(fingerprint)
+    print_message(f"Installed {package_path} on {device_name} in {time.monotonic() - start_time:.1f} seconds")
+    return True
+
+
+def _get_install_flags(manifest: apk_helper.ApkManifest | None) -> str:
+    # -r: replace existing application
+    # -t: allow test packages, which Android Studio builds when an app is run from the IDE
+    return "-r -t" if manifest is not None and manifest.test_only else "-r"
+
+
+# Returns whether the install succeeded, and the error message if it did not
+def _install_in_session(apk_sources: list[ApkSource], install_flags: str,
+                        bandwidth_limiter: BandwidthLimiter | None) -> tuple[bool, str | None]:
+    total_size = sum(apk_source.size for apk_source in apk_sources)
+    _, stdout, stderr = execute_adb_shell_command2(f"pm install-create {install_flags} -S {total_size:d}")
+    session_id_match = _INSTALL_SESSION_ID_REGEX.search(stdout or "")
+    if session_id_match is None:
+        return False, f"failed to create an install session: {stdout} {stderr}"
+    session_id = session_id_match.group(1)
+    print_verbose(f"Created install session {session_id} for {len(apk_sources):d} APKs of {total_size:d} bytes")
+
+    for index, apk_source in enumerate(apk_sources):
+        # The names only have to be unique within the session
+        error_message = _write_to_session(session_id, f"{index:d}.apk", apk_source, bandwidth_limiter)
+        if error_message is not None:
+            execute_adb_shell_command2(f"pm install-abandon {session_id}", ignore_stderr=True)
+            return False, error_message
+
+    _, stdout, stderr = execute_adb_shell_command2(f"pm install-commit {session_id}")
+    if not stdout or "Success" not in stdout:
+        return False, f"{stdout} {stderr}"
+    return True, None
+
+
+# Returns the error message if the write failed
+def _write_to_session(session_id: str, name: str, apk_source: ApkSource,
+                      bandwidth_limiter: BandwidthLimiter | None) -> str | None:
+    write_cmd = f"pm install-write -S {apk_source.size:d} {session_id} {name} -"
+    with apk_source.open() as apk_file, start_adb_command(f"exec-in {shlex.quote(write_cmd)}",
+                                                          write_stdin=True) as process:
+        try:
+            while data := apk_file.read(_STREAM_BUFFER_SIZE):
+                if bandwidth_limiter is not None:
+                    bandwidth_limiter.wait(len(data))
+                process.stdin.write(data)
+            process.stdin.close()
+        except BrokenPipeError:
+            print_verbose(f"Connection closed while writing {apk_source.name}")
+            # The unsent data left in the buffer will fail to flush again
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+        # communicate() can't be used since stdin is already closed
+        stdout, stderr = process.stdout.read(), process.stderr.read()
+        process.wait()
+    output = stdout.decode("utf-8", errors="replace").strip()
+    if process.returncode != 0 or "Success" not in output:
+        return f"failed to write {apk_source.name}: {output} {stderr.decode('utf-8', errors='replace').strip()}"
+    print_verbose(f"Wrote {apk_source.name} ({apk_source.size:d} bytes) to install session {session_id}")
+    return None
+
+
+@contextlib.contextmanager
+def _open_apk_sources(package_path: str) -> Iterator[list[ApkSource]]:
+    path = Path(package_path)
+    if path.is_dir():
+        apk_paths = sorted(path.glob("*.apk"))
+        if not apk_paths:
+            print_error_and_exit(f"No APKs found in {package_path}")
+        yield [_get_file_apk_source(apk_path) for apk_path in apk_paths]
+    elif path.suffix.lower() == ".apks":
+        with zipfile.ZipFile(path) as apks_file:
+            yield [ApkSource(name=f"{package_path}!{member.filename}", size=member.file_size,
+                             open=functools.partial(apks_file.open, member))
+                   for member in _get_apks_members_for_device(apks_file)]
+    else:
+        yield [_get_file_apk_source(path)]
+
+
+def _get_file_apk_source(apk_path: Path) -> ApkSource:
+    return ApkSource(name=str(apk_path), size=apk_path.stat().st_size, open=functools.partial(apk_path.open, "rb"))
+
+
+# Returns the APKs of a bundletool ".apks" archive which the current device needs, the universal APK if there is one,
+# otherwise, the base module's splits for the device's ABI and screen density along with the other base splits,
+# e.g. the master and the language splits.
+def _get_apks_members_for_device(apks_file: zipfile.ZipFile) -> list[zipfile.ZipInfo]:
+    members = {member.filename: member for member in apks_file.infolist()}
+    if _UNIVERSAL_APK_NAME in members:
+        return [members[_UNIVERSAL_APK_NAME]]
+    base_splits = {split_match.group(1): member for name, member in members.items()
+                   if (split_match := _BASE_SPLIT_REGEX.match(name)) is not None}
+    if not base_splits:
+        print_error_and_exit(f"No universal APK or base splits found in {apks_file.filename}")
+
+    abi_splits = [split_name for split_name in base_splits if split_name in _ABI_SPLIT_NAMES]
+    density_splits = [split_name for split_name in base_splits if split_name in _DENSITY_SPLIT_DPIS]
+    selected_split_names = [split_name for split_name in base_splits
+                            if split_name not in _ABI_SPLIT_NAMES and split_name not in _DENSITY_SPLIT_DPIS]
+    if abi_splits:
+        device_abis = [abi.replace("-", "_") for abi in get_device().get_cached(
+            "abis", lambda: (get_adb_shell_property("ro.product.cpu.abilist")
+                             or get_adb_shell_property("ro.product.cpu.abi") or "").split(","))]
+        matching_abi_splits = [abi for abi in device_abis if abi in abi_splits]
+        # Without the native libraries, the app would crash as soon as it loads them
+        if not matching_abi_splits:
+            print_error_and_exit(f"No ABI split in {apks_file.filename} matches the device's ABIs "
+                                 f"({', '.join(filter(None, device_abis)) or 'unknown'}), the available ABI "
+                                 f"splits are: {', '.join(abi_splits)}")
+        selected_split_names.append(matching_abi_splits[0])
+    if density_splits:
+        device_dpi = int(get_device().get_cached("density", lambda: get_adb_shell_property("ro.sf.lcd_density"))
+                         or _DENSITY_SPLIT_DPIS["xxhdpi"])
+        # The smallest density at least as high as the device's, scaling down looks better than scaling up
+        density_splits.sort(key=lambda split_name: _DENSITY_SPLIT_DPIS[split_name])
+        selected_split_names.append(next(
+            (split_name for split_name in density_splits if _DENSITY_SPLIT_DPIS[split_name] >= device_dpi),
+            density_splits[-1]))
+    print_verbose(f"Selected splits {selected_split_names} from {apks_file.filename}")
+    return [base_splits[split_name] for split_name in selected_split_names]
@@ -0,0 +1,88 @@
+import dataclasses
+import shlex
+from collections.abc import Iterator
+
+try:
+    from adbe.adb_helper import get_file_related_shell_command, stream_adb_shell_command
+    from adbe.output_helper import print_verbose
+except ImportError:
+    from adb_helper import get_file_related_shell_command, stream_adb_shell_command
+    from output_helper import print_verbose
+
+# The path is the last field, so, a "|" in a file name does not break the parsing.
+_STAT_FORMAT = "%F|%s|%a|%Y|%U|%G|%n"
+_STAT_FIELD_COUNT = 7
+# stat reports the file type as a description, e.g. "regular empty file"
+_FILE_TYPES = (
+    ("directory", "directory"),
+    ("symbolic link", "symlink"),
+    ("regular", "file"),
+    ("fifo", "fifo"),
+    ("socket", "socket"),
+    ("block", "block_device"),
+    ("character", "character_device"),
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class FileEntry:
+    path: str
+    type: str
+    size: int
+    # Permission bits in octal, e.g. "755"
+    mode: str
+    # Seconds since the epoch
+    mtime: int
+    owner: str
+    group: str
+
+
+# Lists file_path and, up to max_depth levels, the files under it with a single find invocation on the device.
+# All the filters are evaluated on the device, the entries are yielded as soon as they are received.
+# Nothing is yielded if file_path does not exist.
+# Limitation: file names containing a newline are not supported.
+def iter_file_entries(file_path: str, *, max_depth: int | None = None, name_glob: str | None = None,
+                      min_size: int | None = None, max_size: int | None = None) -> Iterator[FileEntry]:
+    find_cmd = _get_find_cmd(file_path, max_depth=max_depth, name_glob=name_glob, min_size=min_size,
+                             max_size=max_size)
+    with stream_adb_shell_command(get_file_related_shell_command(find_cmd, file_path)) as stream:
+        for line in stream:
+            entry = _parse_stat_line(line.decode("utf-8", errors="surrogateescape").rstrip("\r\n"))
+            if entry is not None:
+                yield entry
+
+
+def _get_find_cmd(file_path: str, *, max_depth: int | None, name_glob: str | None, min_size: int | None,
+                  max_size: int | None) -> str:
+    # -H follows file_path itself if it is a symlink, e.g. /sdcard, but not the symlinks under it
+    find_args = ["find", "-H", shlex.quote(file_path)]
+    if max_depth is not None:
+        find_args.append(f"-maxdepth {max_depth:d}")
+    if name_glob is not None:
+        find_args.append(f"-name {shlex.quote(name_glob)}")
+    # "-size +Nc" means strictly more than N bytes
+    if min_size is not None and min_size > 0:
+        find_args.append(f"-size +{min_size - 1:d}c")
+    if max_size is not None:
+        find_args.append(f"-size -{max_size + 1:d}c")
+    find_args.append(f"-exec stat -c {shlex.quote(_STAT_FORMAT)} {{}} + 2>/dev/null")
+    return " ".join(find_args)
+
+
+def _parse_stat_line(line: str) -> FileEntry | None:
+    if not line:
+        return None
+    fields = line.split("|", _STAT_FIELD_COUNT - 1)
+    if len(fields) != _STAT_FIELD_COUNT or not fields[1].isdigit() or not fields[3].isdigit():
+        print_verbose(f'Ignoring unexpected line "{line}" in the file listing')
+        return None
+    file_type, size, mode, mtime, owner, group, path = fields
+    return FileEntry(path=path, type=_get_file_type(file_type), size=int(size), mode=mode, mtime=int(mtime),
+                     owner=owner, group=group)
+
+
+def _get_file_type(stat_file_type: str) -> str:
+    for description, file_type in _FILE_TYPES:
+        if description in stat_file_type:
+            return file_type
+    return "other"
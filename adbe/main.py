@@ -9,13 +9,24 @@ import docopt
 
 try:
     # First try local import for development
-    from adbe import adb_enhanced, adb_helper
+    from adbe import (
+        adb_enhanced,
+        adb_helper,
+        farm_helper,
+        install_helper,
+        multi_device_helper,
+        scratch_helper,
+    )
     from adbe.output_helper import print_error_and_exit, set_verbose
 # Python 3.6 onwards, this throws ModuleNotFoundError
 except ModuleNotFoundError:
     # This works when the code is executed as a part of the module
     import adb_enhanced
     import adb_helper
+    import farm_helper
+    import install_helper
+    import multi_device_helper
+    import scratch_helper
     from output_helper import print_error_and_exit, set_verbose
 
 # List of things which this enhanced adb tool does as of today.
@@ -32,27 +43,32 @@ Usage:
     adbe [options] app info <app_name>
     adbe [options] app path <app_name>
     adbe [options] app signature <app_name>
+    adbe [options] app snapshot (save | restore) <app_name> <snapshot_name>
     adbe [options] apps list (all | system | third-party | debug | backup-enabled)
     adbe [options] battery level <percentage>
     adbe [options] battery reset
     adbe [options] battery saver (on | off)
-    adbe [options] cat <file_path>
+    adbe [options] cat [--range RANGE | --tail BYTES] [--follow] <file_path>
     adbe [options] clear-data <app_name>
     adbe [options] dark mode (on | off)
+    adbe [options] db query [--json] <app_name> <db_name> <sql>
     adbe [options] debug-app (set [-w] [-p] <app_name> | clear)
-    adbe [options] devices
+    adbe [options] devices [--json]
     adbe [options] (enable | disable) wireless debugging
     adbe [options] dont-keep-activities (on | off)
     adbe [options] doze (on | off)
     adbe [options] dump-ui <xml_file>
+    adbe [options] farm run [--json] <jobs_file>
     adbe [options] force-stop <app_name>
     adbe [options] gfx (on | off | lines)
     adbe [options] input-text <text>
-    adbe [options] install <file_path>
-    adbe [options] jank <app_name>
+    adbe [options] install [--skip-identical] [--max-bandwidth MBPS] <package_path>...
+    adbe [options] jank [--framestats [--duration SECONDS] [--csv FILE]] <app_name>
     adbe [options] layout (on | off)
     adbe [options] location (on | off)
+    adbe [options] meminfo [--duration SECONDS] [--period SECONDS] [--csv FILE] [--json] <app_name>
     adbe [options] ls [-a] [-l] [-R|-r] <file_path>
+    adbe [options] ls --json [-R|-r] [--max-depth DEPTH] [--name GLOB] [--min-size BYTES] [--max-size BYTES] <file_path>
     adbe [options] mobile-data (on | off)
     adbe [options] mobile-data saver (on | off)
     adbe [options] mv [-f] <src_path> <dest_path>
@@ -63,9 +79,9 @@ Usage:
     adbe [options] permissions (grant | revoke) <app_name> (calendar | camera | contacts | location | microphone | notifications | phone | sensors | sms | storage)
     adbe [options] permissions list (all | dangerous)
     adbe [options] press back
-    adbe [options] pull [-a] <file_path_on_android>
-    adbe [options] pull [-a] <file_path_on_android> <file_path_on_machine>
-    adbe [options] push <file_path_on_machine> <file_path_on_android>
+    adbe [options] pull [-a] [--resume] <file_path_on_android>
+    adbe [options] pull [-a] [--resume] <file_path_on_android> <file_path_on_machine>
+    adbe [options] push [--resume] <file_path_on_machine> <file_path_on_android>
     adbe [options] restart <app_name>
     adbe [options] restrict-background (true | false) <app_name>
     adbe [options] rm [-f] [-R|-r] <file_path>
@@ -73,15 +89,19 @@ Usage:
     adbe [options] rtl (on | off)
     adbe [options] screen (on | off | toggle)
     adbe [options] screenrecord <filename.mp4>
-    adbe [options] screenshot <filename.png>
+    adbe [options] screenshot [--raw] [--downscale FACTOR] [--burst N [--interval MS]] <filename.png>
+    adbe [options] screenshot diff [--tolerance N] [--ignore REGION]... [--diff-output FILE] [--max-diff PIXELS] <baseline.png>
     adbe [options] show-taps (on | off)
     adbe [options] standby-bucket get <app_name>
     adbe [options] standby-bucket set <app_name> (active | working_set | frequent | rare)
     adbe [options] start <app_name>
+    adbe [options] startup [--runs N] [--mode MODE] [--drop-caches] <app_name>
     adbe [options] stay-awake-while-charging (on | off)
     adbe [options] stop <app_name>
+    adbe [options] tmp gc [--max-age HOURS]
     adbe [options] top-activity
     adbe [options] uninstall [--first-user] <app_name>
+    adbe [options] wait-for-activity [--timeout SECONDS] <activity_name>
     adbe [options] wifi (on | off)
 
 Options:
@@ -89,10 +109,73 @@ Options:
     -d, --device            directs the command to the only connected "USB" device
     -s, --serial SERIAL     directs the command to the device or emulator with the given serial number or qualifier.
                             Overrides ANDROID_SERIAL environment variable.
+    --all-devices           directs the command to all the connected devices and emulators, concurrently
+    --serials SERIALS       directs the command to the devices or emulators with the given comma-separated serial
+                            numbers, concurrently
+    --max-parallel N        Run the command on at most N devices at a time, only valid with "--all-devices" or
+                            "--serials" [default: 8]
+    --fan-out-json          Print one JSON object per device (serial, exit_code and output) once that device is done,
+                            instead of its output lines, only valid with "--all-devices" or "--serials"
     -l                      For long list format, only valid for "ls" command
     -R                      For recursive directory listing, only valid for "ls" and "rm" command
     -r                      For delete file, only valid for "ls" and "rm" command
     -f                      For forced deletion of a file, only valid for "rm" command
+    --json                  Print JSON. For "ls" command, one object per file (path, type, size, mode, mtime, owner and
+                            group). For "devices" command, one object per device (serial, manufacturer, model,
+                            display_name, release, sdk, cpu, battery_level, storage_free_bytes, screen and
+                            transport). For "farm run" command, one object per job (name, serial, status, attempts,
+                            wait_seconds, duration_seconds and output). For "db query" command, one object per
+                            row. For "meminfo" command, one object per sample)
+    --max-depth DEPTH       Only list files up to DEPTH levels below <file_path>, only valid for "ls --json" command
+    --name GLOB             Only list files whose name matches GLOB, e.g. "*.db", only valid for "ls --json" command
+    --min-size BYTES        Only list files of at least BYTES bytes, only valid for "ls --json" command
+    --max-size BYTES        Only list files of at most BYTES bytes, only valid for "ls --json" command
+    --resume                Transfer in verified chunks and resume an interrupted transfer,
+                            only valid for "pull" and "push" command
+    --range RANGE           Only print bytes <start>-<end> (zero-based and inclusive) or <start>- of the file,
+                            only valid for "cat" command
+    --tail BYTES            Only print the last BYTES bytes of the file, only valid for "cat" command
+    --follow                Keep printing the data appended to the file, only valid for "cat" command
+    --burst N               Take N screenshots saved as <filename>-0001.png and so on, only valid for "screenshot" command
+    --interval MS           Milliseconds between the burst screenshots, they are taken as fast as the device allows
+                            if it is too short, only valid for "screenshot" command [default: 0]
+    --raw                   Fetch the uncompressed screen and encode it on the host, which is faster on low-end devices.
+                            A file name ending with ".webp" is saved as WebP, which requires Pillow.
+                            Only valid for "screenshot" command
+    --downscale FACTOR      Keep every FACTOR-th pixel of every FACTOR-th row of the screen, implies --raw,
+                            only valid for "screenshot" command [default: 1]
+    --tolerance N           Pixels whose color channels differ by at most N (0-255) are considered the same,
+                            only valid for "screenshot diff" command [default: 0]
+    --ignore REGION         Do not compare the pixels in REGION, "<x>,<y>,<width>,<height>", can be repeated,
+                            only valid for "screenshot diff" command
+    --diff-output FILE      Save the baseline with the differing pixels highlighted as FILE in PNG format,
+                            only valid for "screenshot diff" command
+    --max-diff PIXELS       Fail only if more than PIXELS pixels differ, only valid for "screenshot diff" command
+                            [default: 0]
+    --max-bandwidth MBPS    Limit the total upload speed of all the installs to MBPS megabytes per second,
+                            only valid for "install" command
+    --skip-identical        Do not install a package on a device on which adbe already installed the same build,
+                            only valid for "install" command
+    --framestats            Sample the timings of every frame rendered while the command runs and print their
+                            percentiles and histogram, only valid for "jank" command
+    --duration SECONDS      Sample for SECONDS seconds, only valid for "jank --framestats" and "meminfo" command
+                            [default: 10]
+    --period SECONDS        Sample the memory usage every SECONDS seconds, only valid for "meminfo" command
+                            [default: 5]
+    --csv FILE              Save the timings of every sampled frame, or every memory usage sample, to FILE,
+                            only valid for "jank --framestats" and "meminfo" command
+    --runs N                Start the app N times, only valid for "startup" command [default: 10]
+    --mode MODE             The state the app is brought to before every start, one of cold (stopped), warm
+                            (running but its activities are destroyed), or hot (in the background),
+                            only valid for "startup" command [default: cold]
+    --drop-caches           Drop the page cache, which requires root, before every cold start, only valid for
+                            "startup" command
+    --compression MODE      gzip shell output and pulled files on the wire, one of auto, on, or off.
+                            "auto" compresses only for devices connected over TCP/IP [default: auto]
+    --max-age HOURS         Only delete scratch files older than HOURS hours, only valid for "tmp gc" command
+                            [default: 24]
+    --timeout SECONDS       Fail if the activity is not in the foreground in SECONDS seconds,
+                            only valid for "wait-for-activity" command [default: 10]
     -v, --verbose           Verbose mode
 
 """
@@ -124,10 +207,19 @@ def main() -> None:
     set_verbose(enabled=args["--verbose"])
 
     _validate_options(args)
-    options = _get_generic_options_from_args(args)
-    if options:
-        adb_prefix = f"{adb_helper.get_adb_prefix()} {options}"
-        adb_helper.set_adb_prefix(adb_prefix)
+    if args["--all-devices"] or args["--serials"]:
+        device_serials = (adb_enhanced.get_device_serials() if args["--all-devices"]
+                          else [serial.strip() for serial in args["--serials"].split(",") if serial.strip()])
+        if args["install"]:
+            # The devices share the bandwidth limit, so, they are all installed from this process
+            sys.exit(install_helper.install_on_devices(
+                device_serials, args["<package_path>"], max_parallel=int(args["--max-parallel"]),
+                max_megabytes_per_second=_get_max_bandwidth(args), skip_identical=args["--skip-identical"]))
+        sys.exit(multi_device_helper.run_on_devices(
+            device_serials, sys.argv[1:], max_parallel=int(args["--max-parallel"]), json_output=args["--fan-out-json"]))
+
+    adb_helper.set_default_device(_get_device_from_args(args))
+    adb_helper.set_compression_mode(args["--compression"])
 
     action_dict = _get_actions(args)
 
@@ -165,7 +257,9 @@ def _get_actions(args: dict[str, typing.Any]) -> dict[tuple[str, str], typing.Ca
         ("app", "backup"): lambda: _perform_backup(app_name, args["<backup_tar_file_path>"]),
         ("app", "info"): lambda: adb_enhanced.print_app_info(app_name),
         ("app", "path"): lambda: adb_enhanced.print_app_path(app_name),
-        ("app", "signature"): lambda: adb_enhanced.print_app_signature(app_name),
+        ("app", "signature"): lambda: _print_app_signature(app_name),
+        ("app", "snapshot", "save"): lambda: adb_enhanced.save_app_snapshot(app_name, args["<snapshot_name>"]),
+        ("app", "snapshot", "restore"): lambda: adb_enhanced.restore_app_snapshot(app_name, args["<snapshot_name>"]),
 
         # App listing
         ("apps", "list", "all"): adb_enhanced.print_list_all_apps,
@@ -184,14 +278,20 @@ def _get_actions(args: dict[str, typing.Any]) -> dict[tuple[str, str], typing.Ca
         ("battery", "reset"): adb_enhanced.handle_battery_reset,
         ("battery", "saver", "on"): lambda: adb_enhanced.handle_battery_saver(turn_on=True),
         ("battery", "saver", "off"): lambda: adb_enhanced.handle_battery_saver(turn_on=False),
-        ("cat",): lambda: adb_enhanced.cat_file(args["<file_path>"]),
+        ("cat",): lambda: adb_enhanced.cat_file(
+            args["<file_path>"], byte_range=args["--range"],
+            tail_bytes=None if args["--tail"] is None else int(args["--tail"]), follow=args["--follow"]),
 
         # Dark mode
         ("dark", "mode", "on"): lambda: adb_enhanced.set_dark_mode(force=True),
         ("dark", "mode", "off"): lambda: adb_enhanced.set_dark_mode(force=False),
 
+        # Databases
+        ("db", "query"): lambda: adb_enhanced.query_app_database(
+            app_name, args["<db_name>"], args["<sql>"], json_output=args["--json"]),
+
         # List devices
-        ("devices",): adb_enhanced.handle_list_devices,
+        ("devices",): lambda: adb_enhanced.handle_list_devices(json_output=args["--json"]),
 
         # GFX
         ("gfx", "on"): lambda: adb_enhanced.handle_gfx("on"),
@@ -199,7 +299,8 @@ def _get_actions(args: dict[str, typing.Any]) -> dict[tuple[str, str], typing.Ca
         ("gfx", "lines"): lambda: adb_enhanced.handle_gfx("lines"),
 
         # Apk install
-        ("install",): lambda: adb_enhanced.perform_install(args["<file_path>"]),
+        ("install",): lambda: adb_enhanced.perform_install(args["<package_path>"], _get_max_bandwidth(args),
+                                                           args["--skip-identical"]),
         # Apk uninstall
         ("uninstall",): lambda: adb_enhanced.perform_uninstall(app_name, args["--first-user"]),
         # Clear data
@@ -220,6 +321,11 @@ def _get_actions(args: dict[str, typing.Any]) -> dict[tuple[str, str], typing.Ca
         ("location", "off"): lambda: adb_enhanced.toggle_location(turn_on=False),
         ("notifications", "list"): adb_enhanced.print_notifications,
 
+        # Memory usage
+        ("meminfo",): lambda: adb_enhanced.handle_meminfo(
+            app_name, duration_seconds=float(args["--duration"]), period_seconds=float(args["--period"]),
+            csv_file_path=args["--csv"], json_output=args["--json"]),
+
         # Overdraw
         ("overdraw", "on"): lambda: adb_enhanced.handle_overdraw("on"),
         ("overdraw", "off"): lambda: adb_enhanced.handle_overdraw("off"),
@@ -234,9 +340,10 @@ def _get_actions(args: dict[str, typing.Any]) -> dict[tuple[str, str], typing.Ca
 
         # Pull files
         ("pull",): lambda: adb_enhanced.pull_file(
-            args["<file_path_on_android>"], args["<file_path_on_machine>"], copy_ancillary=args["-a"]),
+            args["<file_path_on_android>"], args["<file_path_on_machine>"], copy_ancillary=args["-a"],
+            resume=args["--resume"]),
         ("push",): lambda: adb_enhanced.push_file(
-            args["<file_path_on_machine>"], args["<file_path_on_android>"]),
+            args["<file_path_on_machine>"], args["<file_path_on_android>"], resume=args["--resume"]),
         ("restrict-background", "true"): lambda: adb_enhanced.apply_or_remove_background_restriction(app_name, set_restriction=True),
         ("restrict-background", "false"): lambda: adb_enhanced.apply_or_remove_background_restriction(app_name, set_restriction=False),
 
@@ -254,9 +361,7 @@ def _get_actions(args: dict[str, typing.Any]) -> dict[tuple[str, str], typing.Ca
         ("mv",): lambda: adb_enhanced.move_file(args["<src_path>"], args["<dest_path>"], args["-f"]),
         ("rm",): lambda: adb_enhanced.delete_file(args["<file_path>"], args["-f"], args["-R"] or args["-r"]),
         # Always include hidden files, -a is left for backward-compatibility but is a no-op now.
-        ("ls",): lambda: adb_enhanced.list_directory(
-            args["<file_path>"], long_format=args["-l"], recursive=args["-R"] or args["-r"],
-            include_hidden_files=True),
+        ("ls",): lambda: _list_directory(args),
         # Screen
         ("screen", "on"): lambda: adb_enhanced.switch_screen(adb_enhanced.SCREEN_ON),
         ("screen", "off"): lambda: adb_enhanced.switch_screen(adb_enhanced.SCREEN_OFF),
@@ -274,9 +379,17 @@ def _get_actions(args: dict[str, typing.Any]) -> dict[tuple[str, str], typing.Ca
 
         # App start
         ("start",): lambda: adb_enhanced.launch_app(app_name),
+        ("startup",): lambda: adb_enhanced.benchmark_startup(
+            app_name, runs=int(args["--runs"]), mode=args["--mode"], drop_caches=args["--drop-caches"]),
         ("stop",): lambda: adb_enhanced.stop_app(app_name),
         ("restart",): lambda: (adb_enhanced.force_stop(app_name), adb_enhanced.launch_app(app_name)),
 
+        # Device farm
+        ("farm", "run"): lambda: sys.exit(farm_helper.run_farm(args["<jobs_file>"], json_output=args["--json"])),
+
+        # Scratch files on the device
+        ("tmp", "gc"): lambda: scratch_helper.remove_stale_scratch_files(float(args["--max-age"])),
+
         # Wi-Fi
         ("wifi", "on"): lambda: adb_enhanced.set_wifi(turn_on=True),
         ("wifi", "off"): lambda: adb_enhanced.set_wifi(turn_on=False),
@@ -295,9 +408,18 @@ def _get_actions(args: dict[str, typing.Any]) -> dict[tuple[str, str], typing.Ca
 
         # Fetching info from UI
         ("dump-ui",): lambda: adb_enhanced.dump_ui(args["<xml_file>"]),
-        ("jank",): lambda: adb_enhanced.handle_get_jank(app_name),
+        ("jank",): lambda: adb_enhanced.handle_get_jank(
+            app_name, framestats=args["--framestats"], duration_seconds=float(args["--duration"]),
+            csv_file_path=args["--csv"]),
         ("top-activity",): adb_enhanced.print_top_activity,
-        ("screenshot", ): lambda: adb_enhanced.dump_screenshot(args["<filename.png>"]),
+        ("wait-for-activity",): lambda: adb_enhanced.handle_wait_for_activity(
+            args["<activity_name>"], float(args["--timeout"])),
+        ("screenshot", "diff"): lambda: adb_enhanced.diff_screenshot(
+            args["<baseline.png>"], tolerance=int(args["--tolerance"]), ignored_regions=args["--ignore"],
+            diff_file_path=args["--diff-output"], max_different_pixels=int(args["--max-diff"])),
+        ("screenshot", ): lambda: adb_enhanced.dump_screenshot(
+            args["<filename.png>"], burst=None if args["--burst"] is None else int(args["--burst"]),
+            interval_ms=int(args["--interval"]), raw=args["--raw"], downscale=int(args["--downscale"])),
         ("screenrecord",): lambda: adb_enhanced.dump_screenrecord(args["<filename.mp4>"]),
 
         # Debug app
@@ -320,12 +442,42 @@ def _grant_revoke_permissions(app_name: str, args: dict[str, typing.Any]) -> Non
         app_name, action_type="grant" if args["grant"] else "revoke", permissions=permissions)
 
 
+# <app_name> is either an installed app or an APK file on this machine
+def _print_app_signature(app_name: str) -> None:
+    if Path(app_name).is_file():
+        adb_enhanced.print_apk_signature(app_name)
+    else:
+        adb_enhanced.print_app_signature(app_name)
+
+
+def _list_directory(args: dict[str, typing.Any]) -> None:
+    recursive = args["-R"] or args["-r"]
+    if not args["--json"]:
+        # Always include hidden files, -a is left for backward-compatibility but is a no-op now.
+        adb_enhanced.list_directory(
+            args["<file_path>"], long_format=args["-l"], recursive=recursive, include_hidden_files=True)
+        return
+
+    if args["--max-depth"] is not None:
+        max_depth = int(args["--max-depth"])
+    else:
+        max_depth = None if recursive else 1
+    adb_enhanced.list_directory_as_json(
+        args["<file_path>"], max_depth=max_depth, name_glob=args["--name"],
+        min_size=None if args["--min-size"] is None else int(args["--min-size"]),
+        max_size=None if args["--max-size"] is None else int(args["--max-size"]))
+
+
 def _perform_backup(app_name: str, backup_tar_file_path: str | None) -> None:
     if not backup_tar_file_path:
         backup_tar_file_path = f"{app_name}_backup.tar"
     adb_enhanced.perform_app_backup(app_name, backup_tar_file_path)
 
 
+def _get_max_bandwidth(args: dict[str, typing.Any]) -> float | None:
+    return float(args["--max-bandwidth"]) if args["--max-bandwidth"] else None
+
+
 def _validate_options(args: dict[str, typing.Any]) -> None:
     count = 0
     if args["--emulator"]:
@@ -334,19 +486,22 @@ def _validate_options(args: dict[str, typing.Any]) -> None:
         count += 1
     if args["--serial"]:
         count += 1
+    if args["--all-devices"]:
+        count += 1
+    if args["--serials"]:
+        count += 1
     if count > 1:
-        print_error_and_exit("Only one out of -e, -d, or -s can be provided")
+        print_error_and_exit("Only one out of -e, -d, -s, --serials, or --all-devices can be provided")
+    if args["--fan-out-json"] and not (args["--all-devices"] or args["--serials"]):
+        print_error_and_exit('"--fan-out-json" is only valid with "--all-devices" or "--serials"')
 
 
-def _get_generic_options_from_args(args: dict[str, typing.Any]) -> str:
-    options = ""
+def _get_device_from_args(args: dict[str, typing.Any]) -> adb_helper.Device:
     if args["--emulator"]:
-        options += "-e "
+        return adb_helper.Device(transport="emulator")
     if args["--device"]:
-        options += "-d "
-    if args["--serial"]:
-        options += f'-s {args["--serial"]} '
-    return options
+        return adb_helper.Device(transport="usb")
+    return adb_helper.Device(args["--serial"])
 
 
 def _get_version() -> str:
@@ -0,0 +1,176 @@
+import array
+import csv
+import json
+import re
+import shlex
+import statistics
+import time
+
+try:
+    from adbe.adb_helper import open_shell_session
+    from adbe.output_helper import (
+        print_error,
+        print_error_and_exit,
+        print_message,
+        print_verbose,
+    )
+except ImportError:
+    from adb_helper import open_shell_session
+    from output_helper import (
+        print_error,
+        print_error_and_exit,
+        print_message,
+        print_verbose,
+    )
+
+_ELAPSED_SECONDS_COLUMN = "elapsed_seconds"
+# Printed with every sample, and summarized at the end, if the device reports them
+_TREND_COLUMNS = {
+    "total_pss_kb": "Total PSS",
+    "java_heap_pss_kb": "Java heap PSS",
+    "native_heap_pss_kb": "Native heap PSS",
+}
+# The rows of the main table with the heap's size, allocated, and free memory as their last three values
+_HEAP_ROW_REGEX = re.compile(r"^\s*(Native|Dalvik) Heap\s+([\d\s]+)$")
+# e.g. "TOTAL PSS:    31935", or "TOTAL:    31935" before API 30
+_TOTAL_REGEX = re.compile(r"(TOTAL(?: [A-Z]+)*):\s+(\d+)")
+_SUMMARY_ROW_REGEX = re.compile(r"^\s*([A-Za-z][A-Za-z ]*):((?:\s+\d+)+)\s*$")
+_SUMMARY_HEADER_REGEX = re.compile(r"(Pss|Rss)\(KB\)")
+# A steady growth of the memory usage over the whole run, rather than a few jumps, hints at a leak
+_MIN_LEAK_CORRELATION = 0.8
+_MIN_LEAK_SAMPLE_COUNT = 3
+
+
+class MemorySamples:
+    """
+    The samples, stored by column, one array per column, so that every value takes only 8 bytes, however long a soak
+    test runs. The columns are those of the first sample, e.g. "java_heap_pss_kb".
+    """
+
+    def __init__(self) -> None:
+        self.columns: dict[str, array.array] = {}
+
+    def __len__(self) -> int:
+        return len(self.columns[_ELAPSED_SECONDS_COLUMN]) if self.columns else 0
+
+    def append(self, elapsed_seconds: float, values: dict[str, int]) -> None:
+        if not self.columns:
+            self.columns[_ELAPSED_SECONDS_COLUMN] = array.array("d")
+            for column in values:
+                self.columns[column] = array.array("q")
+        self.columns[_ELAPSED_SECONDS_COLUMN].append(elapsed_seconds)
+        for column, column_values in self.columns.items():
+            if column != _ELAPSED_SECONDS_COLUMN:
+                # e.g. a category which is absent when its memory usage is 0
+                column_values.append(values.get(column, 0))
+
+    def get_sample(self, index: int) -> dict[str, float | int]:
+        return {column: column_values[index] for column, column_values in self.columns.items()}
+
+
+# Samples the memory usage of the app every interval_seconds seconds for duration_seconds seconds, or until
+# interrupted, and prints every sample, as JSON with json_output.
+# The samples are taken in a single shell session and only the summary of "dumpsys meminfo" is transferred, so the
+# overhead is low enough for a long soak test.
+def sample_memory(app_name: str, *, duration_seconds: float, interval_seconds: float,
+                  json_output: bool = False) -> MemorySamples:
+    quoted_app_name = shlex.quote(app_name)
+    meminfo_cmd = (f"dumpsys meminfo {quoted_app_name} | "
+                   "sed -n -e '/^ *Native Heap  *[0-9]/p' -e '/^ *Dalvik Heap  *[0-9]/p' -e '/App Summary/,/TOTAL/p'")
+    samples = MemorySamples()
+    start_time = time.monotonic()
+    try:
+        with open_shell_session() as shell_session:
+            sample_index = 0
+            while True:
+                elapsed_seconds = time.monotonic() - start_time
+                _, output = shell_session.run(meminfo_cmd)
+                values = parse_meminfo(output)
+                if values:
+                    samples.append(round(elapsed_seconds, 3), values)
+                    _print_sample(samples.get_sample(len(samples) - 1), json_output=json_output)
+                elif not samples:
+                    print_error_and_exit(f"No memory information found for {app_name}, is it running?")
+                else:
+                    # e.g. the app crashed and is yet to be restarted
+                    print_error(f"No memory information found for {app_name} at {elapsed_seconds:.1f} seconds")
+                sample_index += 1
+                next_sample_time = start_time + sample_index * interval_seconds
+                if next_sample_time > start_time + duration_seconds:
+                    break
+                time.sleep(max(0.0, next_sample_time - time.monotonic()))
+    except KeyboardInterrupt:
+        print_verbose(f"Stopped sampling {app_name}")
+    return samples
+
+
+# Returns the memory usage in KB by category, e.g. "java_heap_pss_kb", from the output of "dumpsys meminfo <app>"
+def parse_meminfo(meminfo: str) -> dict[str, int]:
+    values: dict[str, int] = {}
+    # The values are right-aligned to these headers, a row might have a value for either of them, or for both
+    column_ends: list[tuple[int, str]] = []
+    for line in meminfo.splitlines():
+        heap_row_match = _HEAP_ROW_REGEX.match(line)
+        total_matches = _TOTAL_REGEX.findall(line)
+        summary_row_match = _SUMMARY_ROW_REGEX.match(line)
+        if heap_row_match is not None:
+            heap_values = heap_row_match.group(2).split()
+            if len(heap_values) >= 3:
+                values[f"{heap_row_match.group(1).lower()}_heap_alloc_kb"] = int(heap_values[-2])
+        elif _SUMMARY_HEADER_REGEX.search(line):
+            column_ends = [(header_match.end(), header_match.group(1).lower())
+                           for header_match in _SUMMARY_HEADER_REGEX.finditer(line)]
+        elif total_matches:
+            for name, value in total_matches:
+                # Before API 30, the total PSS was reported as "TOTAL"
+                column = "total_pss_kb" if name == "TOTAL" else f"{_get_column_name(name)}_kb"
+                values[column] = int(value)
+        elif summary_row_match is not None and column_ends:
+            for value_match in re.finditer(r"\d+", line):
+                kind = _get_nearest_column(column_ends, value_match.end())
+                values[f"{_get_column_name(summary_row_match.group(1))}_{kind}_kb"] = int(value_match.group())
+    return values
+
+
+def write_samples_csv(samples: MemorySamples, csv_file_path: str) -> None:
+    with open(csv_file_path, "w", encoding="utf-8", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(samples.columns)
+        csv_writer.writerows(zip(*samples.columns.values(), strict=True))
+
+
+# Prints how the main memory categories changed over the run, and their linear trend
+def print_memory_trend(app_name: str, samples: MemorySamples) -> None:
+    elapsed_seconds = samples.columns[_ELAPSED_SECONDS_COLUMN]
+    print_message(f"{app_name}: {len(samples):d} samples over {elapsed_seconds[-1] - elapsed_seconds[0]:.1f} seconds")
+    for column, label in _TREND_COLUMNS.items():
+        if column not in samples.columns:
+            continue
+        values = samples.columns[column]
+        message = (f"{label}: {values[0]:d} KB -> {values[-1]:d} KB "
+                   f"(min {min(values):d} KB, max {max(values):d} KB)")
+        if len(samples) > 1 and elapsed_seconds[-1] > elapsed_seconds[0]:
+            slope, _ = statistics.linear_regression(elapsed_seconds, values)
+            # The correlation is undefined if the usage never changed
+            correlation = statistics.correlation(elapsed_seconds, values) if len(set(values)) > 1 else 0.0
+            message += f", trend {slope * 60:+.1f} KB/min"
+            if slope > 0 and correlation >= _MIN_LEAK_CORRELATION and len(samples) >= _MIN_LEAK_SAMPLE_COUNT:
+                message += f", growing steadily (r={correlation:.2f}), possible leak"
+        print_message(message)
+
+
+def _print_sample(sample: dict[str, float | int], *, json_output: bool) -> None:
+    if json_output:
+        print_message(json.dumps(sample))
+        return
+    print_message(f"{sample[_ELAPSED_SECONDS_COLUMN]:7.1f} s: " + ", ".join(
+        f"{label} {sample[column]:d} KB" for column, label in _TREND_COLUMNS.items() if column in sample))
+
+
+def _get_nearest_column(column_ends: list[tuple[int, str]], value_end: int) -> str:
+    return min(column_ends, key=lambda column_end: abs(column_end[0] - value_end))[1]
+
+
+# e.g. "Java Heap" to "java_heap"
+def _get_column_name(name: str) -> str:
+    return "_".join(name.lower().split())
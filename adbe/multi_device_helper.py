@@ -0,0 +1,87 @@
+import concurrent.futures
+import dataclasses
+import json
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+try:
+    from adbe.output_helper import print_error, print_message
+except ImportError:
+    from output_helper import print_error, print_message
+
+# Options which select the devices to fan out to, or the output of the fan out, they are not passed on to the
+# per-device invocations
+_FAN_OUT_FLAGS = ("--all-devices", "--fan-out-json")
+_FAN_OUT_OPTIONS_WITH_VALUE = ("--serials", "--max-parallel")
+
+
+@dataclasses.dataclass(frozen=True)
+class DeviceResult:
+    serial: str
+    exit_code: int
+    output: str
+
+
+# Runs adbe with adbe_args on every device concurrently, at most max_parallel at a time, and returns 0 if it
+# succeeded on all of them, 1 otherwise.
+# Every device is driven by its own adbe process, so, the devices don't share any state.
+# The output is printed line by line with a "[<serial>]" prefix or, with json_output, as one JSON object per
+# device once that device is done.
+def run_on_devices(device_serials: list[str], adbe_args: list[str], *, max_parallel: int,
+                   json_output: bool) -> int:
+    if not device_serials:
+        print_error("No devices found")
+        return 1
+    per_device_args = _remove_fan_out_options(adbe_args)
+    output_lock = threading.Lock()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(max_parallel, 1)) as executor:
+        results = list(executor.map(
+            lambda device_serial: _run_on_device(device_serial, per_device_args, output_lock,
+                                                 json_output=json_output),
+            device_serials))
+
+    failed_serials = [result.serial for result in results if result.exit_code != 0]
+    if failed_serials and not json_output:
+        print_error(f"Failed on {len(failed_serials):d} of {len(results):d} devices: {', '.join(failed_serials)}")
+    return 1 if failed_serials else 0
+
+
+def _run_on_device(device_serial: str, adbe_args: list[str], output_lock: threading.Lock, *,
+                   json_output: bool) -> DeviceResult:
+    output_lines = []
+    with subprocess.Popen(get_adbe_cmd(device_serial, adbe_args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          stdin=subprocess.DEVNULL, text=True, errors="replace") as process:
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            output_lines.append(line)
+            if not json_output:
+                with output_lock:
+                    print_message(f"[{device_serial}] {line}")
+    result = DeviceResult(serial=device_serial, exit_code=process.returncode, output="\n".join(output_lines))
+    if json_output:
+        with output_lock:
+            print_message(json.dumps(dataclasses.asdict(result)))
+    return result
+
+
+# Returns the command line which runs adbe with adbe_args on the device with the given serial
+def get_adbe_cmd(device_serial: str, adbe_args: list[str]) -> list[str]:
+    # main.py runs fine as a script as well as a part of the package
+    return [sys.executable, str(Path(__file__).parent / "main.py"), "--serial", device_serial, *adbe_args]
+
+
+def _remove_fan_out_options(adbe_args: list[str]) -> list[str]:
+    remaining_args = []
+    skip_next_arg = False
+    for arg in adbe_args:
+        if skip_next_arg:
+            skip_next_arg = False
+        elif arg in _FAN_OUT_FLAGS or ("=" in arg and arg.split("=", 1)[0] in _FAN_OUT_OPTIONS_WITH_VALUE):
+            continue
+        elif arg in _FAN_OUT_OPTIONS_WITH_VALUE:
+            skip_next_arg = True
+        else:
+            remaining_args.append(arg)
+    return remaining_args
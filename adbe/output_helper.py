@@ -33,7 +33,10 @@ def print_error(error_string: str) -> None:
 
 
 def print_verbose(message: str) -> None:
-    if __settings.verbose and _is_interactive_terminal():
+    # Without this check, verbose messages would end up in the output of commands like "cat"
+    if not __settings.verbose:
+        return
+    if _is_interactive_terminal():
         print(f"{BashColors.WARNING}{message}{BashColors.ENDC}")
     else:
         print(message)
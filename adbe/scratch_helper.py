@@ -0,0 +1,122 @@
+import atexit
+import itertools
+import os
+import secrets
+import shlex
+import threading
+import time
+
+try:
+    from adbe.adb_helper import Device, execute_adb_shell_command2, get_device
+    from adbe.output_helper import (
+        print_error,
+        print_error_and_exit,
+        print_message,
+        print_verbose,
+    )
+except ImportError:
+    from adb_helper import Device, execute_adb_shell_command2, get_device
+    from output_helper import (
+        print_error,
+        print_error_and_exit,
+        print_message,
+        print_verbose,
+    )
+
+# Every adbe invocation gets its own directory under this one, which is deleted when the invocation exits.
+# Partial files of resumable pushes are kept here as well, see transfer_helper.
+SCRATCH_ROOT_DIR = "/data/local/tmp/adbe-scratch"
+
+
+class ScratchDirectory:
+    """
+    A per-invocation scratch directory on the device.
+    The directory is created with the first file in it and all the file names are allocated locally,
+    so, unlike a random name in /data/local/tmp, no existence checks are required.
+    """
+
+    def __init__(self, device: Device) -> None:
+        self._device = device
+        self._dir_path = f"{SCRATCH_ROOT_DIR}/{int(time.time()):d}-{os.getpid():d}-{secrets.token_hex(4)}"
+        self._file_counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._created = False
+
+    # Returns a unique path in the scratch directory, the file itself is not created.
+    def new_file_path(self, filename_prefix: str = "file", filename_suffix: str = "tmp") -> str:
+        file_path = self._allocate_file_path(filename_prefix, filename_suffix)
+        self._run_in_scratch_dir(None)
+        return file_path
+
+    # Returns a unique path of a newly created empty file in the scratch directory.
+    # The file is world-writable or else, run-as command might fail to write on it.
+    def create_file(self, filename_prefix: str = "file", filename_suffix: str = "tmp") -> str | None:
+        file_path = self._allocate_file_path(filename_prefix, filename_suffix)
+        quoted_file_path = shlex.quote(file_path)
+        return_code, stdout, stderr = self._run_in_scratch_dir(
+            f"touch {quoted_file_path} && chmod 666 {quoted_file_path}")
+        if return_code != 0:
+            print_error(f"Failed to create tmp file {file_path}: (stdout: {stdout}, stderr: {stderr})")
+            return None
+        return file_path
+
+    def delete(self) -> None:
+        with self._lock:
+            if not self._created:
+                return
+            self._created = False
+        print_verbose(f"Deleting scratch directory {self._dir_path}")
+        # This runs at exit as well, when the device which created the directory might not be the current one
+        self._device.run(execute_adb_shell_command2, shlex.quote(f"rm -rf {shlex.quote(self._dir_path)}"),
+                         ignore_stderr=True)
+
+    def _allocate_file_path(self, filename_prefix: str, filename_suffix: str) -> str:
+        if filename_prefix.find("/") != -1:
+            print_error_and_exit(f'Filename prefix "{filename_prefix}" contains illegal character: "/"')
+        if filename_suffix.find("/") != -1:
+            print_error_and_exit(f'Filename suffix "{filename_suffix}" contains illegal character: "/"')
+        return f"{self._dir_path}/{filename_prefix}-{next(self._file_counter):d}.{filename_suffix}"
+
+    # Runs the command, if any, and creates the scratch directory first in the same round trip, if required.
+    def _run_in_scratch_dir(self, shell_cmd: str | None) -> tuple[int, str | None, str]:
+        with self._lock:
+            if not self._created:
+                quoted_dir_path = shlex.quote(self._dir_path)
+                # Apps (with run-as) have to be able to traverse to and write in the scratch directory.
+                create_cmd = (f"mkdir -p {quoted_dir_path} && chmod 711 {SCRATCH_ROOT_DIR} && "
+                              f"chmod 777 {quoted_dir_path}")
+                shell_cmd = f"{create_cmd} && {shell_cmd}" if shell_cmd else create_cmd
+            elif not shell_cmd:
+                return 0, None, ""
+            return_code, stdout, stderr = self._device.run(execute_adb_shell_command2, shlex.quote(shell_cmd))
+            if return_code == 0 and not self._created:
+                self._created = True
+                atexit.register(self.delete)
+            return return_code, stdout, stderr
+
+
+_scratch_directories: dict[Device, ScratchDirectory] = {}
+_scratch_directories_lock = threading.Lock()
+
+
+# Returns the scratch directory on the device with the given serial or, without a serial, on the current device.
+def get_scratch_directory(device_serial: str | None = None) -> ScratchDirectory:
+    device = get_device(device_serial)
+    with _scratch_directories_lock:
+        if device not in _scratch_directories:
+            _scratch_directories[device] = ScratchDirectory(device)
+        return _scratch_directories[device]
+
+
+# Deletes scratch directories and partial pushes left behind by adbe invocations which did not exit cleanly.
+def remove_stale_scratch_files(max_age_hours: float, device_serial: str | None = None) -> None:
+    find_cmd = (f"find {SCRATCH_ROOT_DIR} -mindepth 1 -maxdepth 1 -mmin +{int(max_age_hours * 60):d} "
+                "-print -exec rm -rf {} + 2>/dev/null; true")
+    return_code, stdout, stderr = execute_adb_shell_command2(shlex.quote(find_cmd), device_serial=device_serial)
+    if return_code != 0:
+        print_error_and_exit(f"Failed to remove stale scratch files, stderr: {stderr}")
+    if not stdout:
+        print_message(f"No scratch files older than {max_age_hours:g} hours found")
+        return
+    for removed_path in stdout.split("\n"):
+        print_message(f"Removed {removed_path}")
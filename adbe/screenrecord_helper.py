@@ -0,0 +1,117 @@
+import contextlib
+import shutil
+import subprocess
+import time
+from collections.abc import Iterator
+from pathlib import Path
+from typing import BinaryIO
+
+try:
+    from adbe import scratch_helper
+    from adbe.adb_helper import (
+        execute_adb_command2,
+        start_adb_command,
+        stream_adb_shell_command,
+    )
+    from adbe.output_helper import print_error_and_exit, print_message, print_verbose
+except ImportError:
+    import scratch_helper
+    from adb_helper import (
+        execute_adb_command2,
+        start_adb_command,
+        stream_adb_shell_command,
+    )
+    from output_helper import print_error_and_exit, print_message, print_verbose
+
+# screenrecord stops after this long, a new segment is started right after that.
+_SEGMENT_TIME_LIMIT_SECONDS = 180
+_STREAM_BUFFER_SIZE = 64 * 1024
+# screenrecord writes the MP4 index after it is stopped
+_DEVICE_FILE_FINISH_SECONDS = 1
+
+
+# Streams the screen recording to file_path until Ctrl+C is pressed, nothing is written on the device.
+# screenrecord is restarted whenever it hits its time limit, every segment starts with a key frame, so, the
+# segments are simply appended to each other.
+# The device sends a raw H.264 stream, if file_path ends with ".mp4" it is muxed into MP4 with ffmpeg. Without ffmpeg,
+# the raw stream is saved with the ".h264" suffix instead. Returns the path of the saved recording.
+def record_screen(file_path: str) -> str:
+    output_path = Path(file_path)
+    ffmpeg_path = shutil.which("ffmpeg")
+    if output_path.suffix.lower() == ".mp4" and ffmpeg_path is None:
+        output_path = output_path.with_suffix(".h264")
+        print_message(f"ffmpeg is not installed, saving the raw H.264 stream to {output_path} instead")
+    elif output_path.suffix.lower() != ".mp4":
+        ffmpeg_path = None
+
+    print_message("Recording video, press Ctrl+C to end...")
+    start_time = time.monotonic()
+    with _open_video_sink(output_path, ffmpeg_path) as video_sink:
+        segment_count = 0
+        try:
+            while True:
+                segment_count += 1
+                if _record_segment(video_sink) == 0:
+                    print_error_and_exit("Failed to record the screen, screenrecord produced no data")
+                print_verbose(f"Segment {segment_count:d} of the recording ended, starting the next one")
+        except KeyboardInterrupt:
+            print_message("Finishing...")
+    print_message(f"Saved {time.monotonic() - start_time:.0f} seconds of recording in {segment_count:d} segments "
+                  f"to {output_path}")
+    return str(output_path)
+
+
+# Records the screen into a file on the device until Ctrl+C is pressed, or until screenrecord hits its time limit, and
+# pulls it to file_path. This is for the devices below API 21, whose screenrecord can't write to stdout.
+def record_screen_to_device_file(file_path: str) -> str:
+    device_file_path = scratch_helper.get_scratch_directory().new_file_path("screenrecord", "mp4")
+    print_message("Recording video, press Ctrl+C to end...")
+    with start_adb_command(f"shell screenrecord --verbose {device_file_path}") as process:
+        try:
+            process.communicate()
+        except KeyboardInterrupt:
+            print_message("Finishing...")
+            # screenrecord finishes the file once the shell it runs in is gone
+            process.terminate()
+            process.communicate()
+            time.sleep(_DEVICE_FILE_FINISH_SECONDS)
+    return_code, _, stderr = execute_adb_command2(f"pull {device_file_path} {file_path}")
+    if return_code != 0:
+        print_error_and_exit(f"Failed to pull the recording {device_file_path}: {stderr}")
+    print_message(f"Saved the recording to {file_path}")
+    return file_path
+
+
+# Returns the number of bytes received
+def _record_segment(video_sink: BinaryIO) -> int:
+    # stderr is mixed into the stream, so, it has to be dropped to keep the video intact.
+    # The video is already compressed, compressing it on the wire again only adds latency.
+    screenrecord_cmd = f"screenrecord --output-format=h264 --time-limit {_SEGMENT_TIME_LIMIT_SECONDS:d} - 2>/dev/null"
+    received_size = 0
+    with stream_adb_shell_command(screenrecord_cmd, allow_compression=False) as stream:
+        # read1 returns whatever is available, so, the data reaches the sink as soon as it is produced
+        while data := stream.read1(_STREAM_BUFFER_SIZE):
+            video_sink.write(data)
+            received_size += len(data)
+    return received_size
+
+
+@contextlib.contextmanager
+def _open_video_sink(output_path: Path, ffmpeg_path: str | None) -> Iterator[BinaryIO]:
+    if ffmpeg_path is None:
+        with output_path.open("wb") as output_file:
+            yield output_file
+        return
+
+    # The raw stream has no timestamps, so, frames are stamped as they arrive.
+    ffmpeg_cmd = [ffmpeg_path, "-loglevel", "error", "-y", "-use_wallclock_as_timestamps", "1", "-f", "h264",
+                  "-i", "-", "-c", "copy", str(output_path)]
+    # In a new session, so that Ctrl+C ends the recording, but not ffmpeg, which still has to write the MP4 index
+    with subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, start_new_session=True) as ffmpeg_process:
+        try:
+            yield ffmpeg_process.stdin
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                ffmpeg_process.stdin.close()
+            if ffmpeg_process.wait() != 0:
+                print_error_and_exit(f"ffmpeg failed to save the recording to {output_path}")
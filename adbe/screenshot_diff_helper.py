@@ -0,0 +1,151 @@
+import dataclasses
+import struct
+import time
+import typing
+import zlib
+from pathlib import Path
+
+if typing.TYPE_CHECKING:
+    import numpy
+
+try:
+    from adbe import screenshot_helper
+    from adbe.output_helper import print_error_and_exit, print_message, print_verbose
+except ImportError:
+    import screenshot_helper
+    from output_helper import print_error_and_exit, print_message, print_verbose
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Color type to channel count, only 8-bit RGB and RGBA images are decoded without Pillow.
+_PNG_CHANNEL_COUNTS = {2: 3, 6: 4}
+_PNG_FILTER_NONE = 0
+_PNG_FILTER_SUB = 1
+_PNG_FILTER_UP = 2
+# Differing pixels are painted in this color on a dimmed copy of the baseline
+_DIFF_HIGHLIGHT_COLOR = (255, 0, 0)
+_DIFF_BACKGROUND_DIM_FACTOR = 3
+
+
+@dataclasses.dataclass(frozen=True)
+class Region:
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+@dataclasses.dataclass(frozen=True)
+class DiffResult:
+    width: int
+    height: int
+    compared_pixel_count: int
+    different_pixel_count: int
+
+
+# Compares the current screen with the baseline image. A pixel differs if any of its color channels differs
+# by more than tolerance, the pixels in ignored_regions are never compared.
+# Prints the result, optionally writes a diff image, and exits with an error if more than max_different_pixels
+# pixels differ.
+def compare_screen_with_baseline(baseline_file_path: str, *, tolerance: int = 0,
+                                 ignored_regions: list[Region] | None = None, diff_file_path: str | None = None,
+                                 max_different_pixels: int = 0) -> DiffResult | None:
+    try:
+        # NumPy is an optional dependency, it is only required for comparing screenshots. It takes a while to import,
+        # so, it is imported here, and not at the top, to keep it from slowing down every other command.
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        print_error_and_exit('Comparing screenshots requires NumPy, install it with "pip install numpy"')
+        return None
+    baseline = _read_png_as_rgb(baseline_file_path)
+    width, height, rgba_pixels = screenshot_helper.get_rgba_pixels(screenshot_helper.capture_raw_frame())
+    screen = numpy.frombuffer(rgba_pixels, dtype=numpy.uint8).reshape(height, width, 4)[:, :, :3]
+    if baseline.shape != screen.shape:
+        print_error_and_exit(f"Screen is {width:d}x{height:d} but the baseline {baseline_file_path} is "
+                             f"{baseline.shape[1]:d}x{baseline.shape[0]:d}")
+
+    start_time = time.monotonic()
+    different_pixels, compared_pixels = _get_different_pixels(baseline, screen, tolerance, ignored_regions or [])
+    result = DiffResult(width=width, height=height, compared_pixel_count=int(numpy.count_nonzero(compared_pixels)),
+                        different_pixel_count=int(numpy.count_nonzero(different_pixels)))
+    print_verbose(f"Compared {width:d}x{height:d} pixels in {(time.monotonic() - start_time) * 1000:.1f} ms")
+
+    if diff_file_path is not None:
+        _save_diff_image(baseline, different_pixels, diff_file_path)
+        print_verbose(f"Saved the diff image to {diff_file_path}")
+    different_percentage = 100 * result.different_pixel_count / max(result.compared_pixel_count, 1)
+    message = (f"{result.different_pixel_count:d} of {result.compared_pixel_count:d} compared pixels "
+               f"({different_percentage:.2f}%) differ from {baseline_file_path}")
+    if result.different_pixel_count > max_different_pixels:
+        print_error_and_exit(message)
+    print_message(message)
+    return result
+
+
+# Returns a boolean mask of the differing pixels and a boolean mask of the compared pixels
+def _get_different_pixels(baseline: "numpy.ndarray", screen: "numpy.ndarray", tolerance: int,
+                          ignored_regions: list[Region]) -> tuple["numpy.ndarray", "numpy.ndarray"]:
+    import numpy  # pylint: disable=import-outside-toplevel
+    # Absolute difference without widening the type, uint8 subtraction of the smaller value never wraps around
+    channel_differences = numpy.maximum(baseline, screen) - numpy.minimum(baseline, screen)
+    different_pixels = channel_differences.max(axis=2) > tolerance
+    compared_pixels = numpy.ones(different_pixels.shape, dtype=bool)
+    for region in ignored_regions:
+        compared_pixels[region.y:region.y + region.height, region.x:region.x + region.width] = False
+    different_pixels &= compared_pixels
+    return different_pixels, compared_pixels
+
+
+def _save_diff_image(baseline: "numpy.ndarray", different_pixels: "numpy.ndarray", diff_file_path: str) -> None:
+    import numpy  # pylint: disable=import-outside-toplevel
+    height, width, _ = baseline.shape
+    diff_image = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    diff_image[:, :, :3] = baseline // _DIFF_BACKGROUND_DIM_FACTOR
+    diff_image[different_pixels, :3] = _DIFF_HIGHLIGHT_COLOR
+    diff_image[:, :, 3] = 255
+    Path(diff_file_path).write_bytes(screenshot_helper.encode_png(width, height, diff_image.tobytes()))
+
+
+# Returns the image as a height x width x 3 array
+def _read_png_as_rgb(file_path: str) -> "numpy.ndarray":
+    import numpy  # pylint: disable=import-outside-toplevel
+    if not Path(file_path).exists():
+        print_error_and_exit(f"Baseline {file_path} does not exist")
+    try:
+        # Pillow is optional, without it only the PNG files saved by "screenshot --raw" and similar ones are supported
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return _decode_png(Path(file_path).read_bytes(), file_path)
+    with Image.open(file_path) as image:
+        return numpy.asarray(image.convert("RGB"))
+
+
+# Decodes a non-interlaced 8-bit RGB or RGBA PNG image whose rows use no filter, the Sub filter or the Up filter
+def _decode_png(data: bytes, file_path: str) -> "numpy.ndarray":
+    import numpy  # pylint: disable=import-outside-toplevel
+    if not data.startswith(_PNG_SIGNATURE):
+        print_error_and_exit(f"{file_path} is not a PNG file")
+    chunks: dict[bytes, list[bytes]] = {}
+    offset = len(_PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack_from(">I4s", data, offset)
+        chunks.setdefault(chunk_type, []).append(data[offset + 8:offset + 8 + length])
+        # Skip the CRC as well
+        offset += 12 + length
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", chunks[b"IHDR"][0])
+    if bit_depth != 8 or color_type not in _PNG_CHANNEL_COUNTS or interlace != 0:
+        print_error_and_exit(f"Only 8-bit non-interlaced RGB and RGBA PNG files are supported without Pillow, "
+                             f'install it with "pip install Pillow" to compare with {file_path}')
+    channel_count = _PNG_CHANNEL_COUNTS[color_type]
+    rows = numpy.frombuffer(zlib.decompress(b"".join(chunks[b"IDAT"])), dtype=numpy.uint8).reshape(
+        height, 1 + width * channel_count)
+    pixels = rows[:, 1:].reshape(height, width, channel_count).copy()
+    for row_index, row_filter in enumerate(rows[:, 0]):
+        if row_filter == _PNG_FILTER_SUB:
+            # Each byte is relative to the same channel of the previous pixel, uint8 arithmetic wraps around like PNG's
+            pixels[row_index] = numpy.cumsum(pixels[row_index], axis=0, dtype=numpy.uint8)
+        elif row_filter == _PNG_FILTER_UP and row_index > 0:
+            pixels[row_index] += pixels[row_index - 1]
+        elif row_filter not in (_PNG_FILTER_NONE, _PNG_FILTER_UP):
+            print_error_and_exit(f"{file_path} uses PNG filter type {row_filter:d} which requires Pillow, "
+                                 'install it with "pip install Pillow" or save the baseline with "screenshot --raw"')
+    return pixels[:, :, :3]
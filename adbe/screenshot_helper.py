@@ -0,0 +1,177 @@
+import collections
+import concurrent.futures
+import dataclasses
+import os
+import struct
+import time
+import zlib
+from collections.abc import Iterator
+from pathlib import Path
+
+try:
+    from adbe.adb_helper import stream_adb_shell_command
+    from adbe.output_helper import print_error_and_exit, print_message, print_verbose
+except ImportError:
+    from adb_helper import stream_adb_shell_command
+    from output_helper import print_error_and_exit, print_message, print_verbose
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_SCREENSHOT_IO_BUFFER_SIZE = 256 * 1024
+# Screenshots are mostly flat areas of color, so, even the fastest level compresses them well.
+_PNG_COMPRESSION_LEVEL = 1
+# Raw screencap output starts with width, height and pixel format, API 28 and later add the color space as well.
+_RAW_HEADER_FORMAT = "<III"
+_RAW_HEADER_SIZES = (12, 16)
+# Pixel formats from android.graphics.PixelFormat, all of them have 4 bytes per pixel
+_PIXEL_FORMAT_RGBA_8888 = 1
+_PIXEL_FORMAT_RGBX_8888 = 2
+_PIXEL_FORMAT_BGRA_8888 = 5
+_BYTES_PER_PIXEL = 4
+# Raw frames are large, e.g. 18 MB at 1440p, so, only a few of them are kept in memory per encoder process.
+_MAX_PENDING_FRAMES_PER_ENCODER = 2
+
+
+@dataclasses.dataclass(frozen=True)
+class RawFrame:
+    width: int
+    height: int
+    pixel_format: int
+    # Pixel data without the header, row by row
+    pixels: bytes
+
+
+# Streams the screenshot straight into file_path, nothing is written on the device.
+def save_screenshot(file_path: str) -> None:
+    # PNG data is already compressed, compressing it on the wire again only slows it down
+    with stream_adb_shell_command("screencap -p 2>/dev/null", allow_compression=False) as stream:
+        data = stream.read(_SCREENSHOT_IO_BUFFER_SIZE)
+        if not data.startswith(_PNG_SIGNATURE):
+            print_error_and_exit(f"Failed to capture the screenshot: {data[:200]!r}")
+        with Path(file_path).open("wb") as screenshot_file:
+            while data:
+                screenshot_file.write(data)
+                data = stream.read(_SCREENSHOT_IO_BUFFER_SIZE)
+
+
+# Fetches the uncompressed framebuffer, so that the device does not have to spend time on PNG compression.
+def capture_raw_frame() -> RawFrame:
+    # Unlike PNG data, the raw frame compresses well on the wire
+    with stream_adb_shell_command("screencap 2>/dev/null") as stream:
+        data = stream.read()
+    if len(data) < struct.calcsize(_RAW_HEADER_FORMAT):
+        print_error_and_exit(f"Failed to capture the screenshot: {data[:200]!r}")
+    width, height, pixel_format = struct.unpack_from(_RAW_HEADER_FORMAT, data)
+    header_size = len(data) - width * height * _BYTES_PER_PIXEL
+    if header_size not in _RAW_HEADER_SIZES:
+        print_error_and_exit(f"Failed to capture the screenshot: unexpected {len(data):d} bytes for a "
+                             f"{width:d}x{height:d} frame")
+    if pixel_format not in (_PIXEL_FORMAT_RGBA_8888, _PIXEL_FORMAT_RGBX_8888, _PIXEL_FORMAT_BGRA_8888):
+        print_error_and_exit(f"Unsupported pixel format of the screen: {pixel_format:d}")
+    return RawFrame(width=width, height=height, pixel_format=pixel_format, pixels=data[header_size:])
+
+
+# Encodes the frame as PNG or, if the file name ends with ".webp", as WebP and saves it to file_path.
+# Only every downscale-th pixel of every downscale-th row is kept.
+# This is a module-level function, so that it can run in a process pool.
+def save_raw_frame(frame: RawFrame, file_path: str, downscale: int = 1) -> None:
+    width, height, pixels = get_rgba_pixels(frame, downscale)
+    if file_path.lower().endswith(".webp"):
+        _save_as_webp(width, height, pixels, file_path)
+        return
+    Path(file_path).write_bytes(encode_png(width, height, pixels))
+
+
+# Captures count screenshots, one every interval_ms milliseconds, or as fast as the device allows if it can't
+# keep up. The screenshots are saved as file_path with a zero-padded sequence number, e.g. "shot-0001.png".
+# With raw, the frames are encoded on the host in parallel while the subsequent ones are being captured.
+def save_screenshot_burst(file_path: str, count: int, interval_ms: int, *, raw: bool = False,
+                          downscale: int = 1) -> list[str]:
+    if count < 1:
+        print_error_and_exit(f"Burst count must be positive, it is {count:d}")
+    if interval_ms < 0:
+        print_error_and_exit(f"Burst interval can't be negative, it is {interval_ms:d}")
+    path = Path(file_path)
+    file_paths = [str(path.with_name(f"{path.stem}-{index:04d}{path.suffix}")) for index in range(1, count + 1)]
+    start_time = time.monotonic()
+    if raw:
+        _save_raw_frame_burst(_iter_burst_schedule(file_paths, interval_ms), downscale)
+    else:
+        for screenshot_file_path in _iter_burst_schedule(file_paths, interval_ms):
+            save_screenshot(screenshot_file_path)
+            print_verbose(f"Saved screenshot {screenshot_file_path}")
+    duration = time.monotonic() - start_time
+    print_message(
+        f"Captured {count:d} screenshots in {duration:.2f} seconds ({count / max(duration, 0.001):.1f} per second)")
+    return file_paths
+
+
+# Yields the file paths at their scheduled time, relative to the start of the burst so that slow captures do not
+# shift all the subsequent ones.
+def _iter_burst_schedule(file_paths: list[str], interval_ms: int) -> Iterator[str]:
+    start_time = time.monotonic()
+    for index, screenshot_file_path in enumerate(file_paths):
+        delay = start_time + index * interval_ms / 1000 - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield screenshot_file_path
+
+
+def _save_raw_frame_burst(scheduled_file_paths: Iterator[str], downscale: int) -> None:
+    encoder_count = os.cpu_count() or 1
+    pending_encodings: collections.deque[concurrent.futures.Future] = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=encoder_count) as executor:
+        for screenshot_file_path in scheduled_file_paths:
+            pending_encodings.append(
+                executor.submit(save_raw_frame, capture_raw_frame(), screenshot_file_path, downscale))
+            while len(pending_encodings) > encoder_count * _MAX_PENDING_FRAMES_PER_ENCODER:
+                pending_encodings.popleft().result()
+        for pending_encoding in pending_encodings:
+            pending_encoding.result()
+
+
+# Returns the width, the height and the pixels of the frame in RGBA order, see save_raw_frame for downscale.
+def get_rgba_pixels(frame: RawFrame, downscale: int = 1) -> tuple[int, int, bytes]:
+    pixels = bytearray(frame.pixels)
+    if frame.pixel_format == _PIXEL_FORMAT_BGRA_8888:
+        pixels[0::4], pixels[2::4] = pixels[2::4], pixels[0::4]
+    elif frame.pixel_format == _PIXEL_FORMAT_RGBX_8888:
+        # The padding byte is not guaranteed to be opaque
+        pixels[3::4] = b"\xff" * (frame.width * frame.height)
+    if downscale <= 1:
+        return frame.width, frame.height, bytes(pixels)
+
+    # A pixel is a single item of a 4-byte view, so, strided slicing skips whole pixels
+    pixel_view = memoryview(pixels).cast("I")
+    rows = [pixel_view[row_start:row_start + frame.width:downscale]
+            for row_start in range(0, frame.width * frame.height, frame.width * downscale)]
+    return len(rows[0]), len(rows), b"".join(row.tobytes() for row in rows)
+
+
+# Encodes 8-bit RGBA pixels as a PNG image, the rows are not filtered.
+def encode_png(width: int, height: int, rgba_pixels: bytes) -> bytes:
+    stride = width * _BYTES_PER_PIXEL
+    # Every row starts with the filter type, 0 is "None"
+    image_data = b"".join(b"\x00" + rgba_pixels[row_start:row_start + stride]
+                          for row_start in range(0, height * stride, stride))
+    # 8 bits per channel, color type 6 is RGBA
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return b"".join((
+        _PNG_SIGNATURE,
+        _get_png_chunk(b"IHDR", header),
+        _get_png_chunk(b"IDAT", zlib.compress(image_data, _PNG_COMPRESSION_LEVEL)),
+        _get_png_chunk(b"IEND", b""),
+    ))
+
+
+def _get_png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return b"".join((struct.pack(">I", len(data)), chunk_type, data, struct.pack(">I", zlib.crc32(chunk_type + data))))
+
+
+def _save_as_webp(width: int, height: int, rgba_pixels: bytes, file_path: str) -> None:
+    try:
+        # Pillow is an optional dependency, it is only required for WebP
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        print_error_and_exit('Saving screenshots as WebP requires Pillow, install it with "pip install Pillow"')
+        return
+    Image.frombytes("RGBA", (width, height), rgba_pixels).save(file_path, "WEBP", lossless=True)
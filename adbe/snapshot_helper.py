@@ -0,0 +1,245 @@
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import re
+import shlex
+import tarfile
+import tempfile
+from collections.abc import Iterator
+from pathlib import Path
+from typing import BinaryIO
+
+try:
+    from adbe import listing_helper
+    from adbe.adb_helper import (
+        execute_adb_shell_command2,
+        get_file_related_shell_command,
+        start_adb_command,
+        stream_adb_shell_command,
+    )
+    from adbe.output_helper import print_error_and_exit, print_message, print_verbose
+except ImportError:
+    import listing_helper
+    from adb_helper import (
+        execute_adb_shell_command2,
+        get_file_related_shell_command,
+        start_adb_command,
+        stream_adb_shell_command,
+    )
+    from output_helper import print_error_and_exit, print_message, print_verbose
+
+_DATA_DIR_ENV_VAR = "XDG_DATA_HOME"
+# File contents are stored once, named by their SHA-256, however many snapshots have them
+_OBJECTS_DIR_NAME = "objects"
+_SNAPSHOT_NAME_REGEX = re.compile(r"^[\w.-]+$")
+_SHA256_LINE_REGEX = re.compile(r"^([0-9a-f]{64}) [ *](.+)$")
+_COPY_BUFFER_SIZE = 1024 * 1024
+# The device shell has a limit on the command length, the files are sent to tar and rm in batches of this many bytes
+_MAX_ARGUMENTS_LENGTH = 32 * 1024
+# Only these are snapshotted, the symlinks in the data directory, e.g. "lib", are managed by Android
+_SNAPSHOT_FILE_TYPES = ("directory", "file")
+
+
+# Saves the app's data directory as snapshot_name. Only the files whose contents are not in the store already, from
+# this or an older snapshot of any app, are transferred.
+# Works for debuggable apps, via run-as, and for all apps on rooted devices.
+def save_snapshot(app_name: str, snapshot_name: str) -> None:
+    snapshot_path = _get_snapshot_path(app_name, snapshot_name)
+    data_dir = _get_data_dir(app_name)
+    device_entries = _list_device_entries(data_dir)
+    if not device_entries:
+        print_error_and_exit(f"Unable to read {data_dir}, the app must be debuggable or the device rooted")
+    device_hashes = _get_device_hashes(data_dir)
+
+    objects_dir = _get_store_dir() / _OBJECTS_DIR_NAME
+    file_paths_to_transfer = [path for path, entry in device_entries.items() if entry["type"] == "file" and not (
+        path in device_hashes and _get_object_path(objects_dir, device_hashes[path]).exists())]
+    print_verbose(f"Transferring {len(file_paths_to_transfer):d} of "
+                  f"{sum(entry['type'] == 'file' for entry in device_entries.values()):d} files of {app_name}")
+    transferred_size = 0
+    for path, sha256, size in _pull_files(data_dir, file_paths_to_transfer, objects_dir):
+        device_hashes[path] = sha256
+        transferred_size += size
+
+    entries = []
+    for path, entry in sorted(device_entries.items()):
+        if entry["type"] == "file":
+            if path not in device_hashes:
+                # Deleted after it was listed, or not readable
+                continue
+            entry["sha256"] = device_hashes[path]
+        entries.append(entry)
+    _write_json(snapshot_path, {
+        "package": app_name,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "entries": entries,
+    })
+    print_message(f"Saved snapshot {snapshot_name} of {app_name}: {len(entries):d} files and directories, "
+                  f"transferred {len(file_paths_to_transfer):d} files ({transferred_size:d} bytes)")
+
+
+# Force-stops the app and makes its data directory identical to the snapshot. Only the files which differ are deleted
+# and transferred.
+def restore_snapshot(app_name: str, snapshot_name: str) -> None:
+    snapshot_path = _get_snapshot_path(app_name, snapshot_name)
+    if not snapshot_path.exists():
+        print_error_and_exit(f"No snapshot {snapshot_name} of {app_name} found")
+    snapshot_entries = {entry["path"]: entry for entry in json.loads(snapshot_path.read_text(encoding="utf-8"))["entries"]}
+    data_dir = _get_data_dir(app_name)
+    execute_adb_shell_command2(f"am force-stop {shlex.quote(app_name)}")
+    device_entries = _list_device_entries(data_dir)
+    if not device_entries:
+        print_error_and_exit(f"Unable to read {data_dir}, the app must be debuggable or the device rooted")
+    device_hashes = _get_device_hashes(data_dir)
+
+    def _is_unchanged(path: str) -> bool:
+        snapshot_entry = snapshot_entries.get(path)
+        if snapshot_entry is None or snapshot_entry["type"] != device_entries[path]["type"]:
+            return False
+        return snapshot_entry["type"] == "directory" or snapshot_entry["sha256"] == device_hashes.get(path)
+
+    paths_to_delete = [path for path in sorted(device_entries) if path and not _is_unchanged(path)]
+    _delete_device_files(data_dir, paths_to_delete)
+    # The directories are always sent, they are tiny and this restores their modes as well
+    entries_to_send = [entry for path, entry in sorted(snapshot_entries.items()) if path and (
+        entry["type"] == "directory" or path not in device_entries or not _is_unchanged(path))]
+    _push_entries(data_dir, entries_to_send)
+    print_message(f"Restored snapshot {snapshot_name} of {app_name}: deleted {len(paths_to_delete):d} and "
+                  f"transferred {sum(entry['type'] == 'file' for entry in entries_to_send):d} files")
+
+
+def _get_data_dir(app_name: str) -> str:
+    return f"/data/data/{app_name}"
+
+
+def _get_store_dir() -> Path:
+    data_dir = os.environ.get(_DATA_DIR_ENV_VAR) or Path.home() / ".local" / "share"
+    return Path(data_dir) / "adbe" / "snapshots"
+
+
+def _get_snapshot_path(app_name: str, snapshot_name: str) -> Path:
+    if not _SNAPSHOT_NAME_REGEX.match(snapshot_name):
+        print_error_and_exit(f'Invalid snapshot name "{snapshot_name}", only letters, digits, "_", "-" and "." '
+                             "are allowed")
+    return _get_store_dir() / app_name / f"{snapshot_name}.json"
+
+
+def _get_object_path(objects_dir: Path, sha256: str) -> Path:
+    return objects_dir / sha256[:2] / sha256
+
+
+# Returns the directories and the regular files in data_dir, keyed by their path relative to it, "" is data_dir
+def _list_device_entries(data_dir: str) -> dict[str, dict]:
+    entries = {}
+    for file_entry in listing_helper.iter_file_entries(data_dir):
+        if file_entry.type not in _SNAPSHOT_FILE_TYPES:
+            continue
+        path = os.path.relpath(file_entry.path, data_dir) if file_entry.path != data_dir else ""
+        entries[path] = {"path": path, "type": file_entry.type, "mode": file_entry.mode, "mtime": file_entry.mtime,
+                         "owner": file_entry.owner, "group": file_entry.group}
+    return entries
+
+
+# Returns the SHA-256 of every regular file in data_dir, keyed by its relative path. Empty if the device has no
+# sha256sum, and then all the files are transferred.
+def _get_device_hashes(data_dir: str) -> dict[str, str]:
+    hash_cmd = f"find {shlex.quote(data_dir)} -type f -exec sha256sum {{}} + 2>/dev/null"
+    device_hashes = {}
+    with stream_adb_shell_command(get_file_related_shell_command(hash_cmd, data_dir)) as stream:
+        for line in stream:
+            hash_match = _SHA256_LINE_REGEX.match(line.decode("utf-8", errors="surrogateescape").rstrip("\r\n"))
+            if hash_match is not None:
+                device_hashes[os.path.relpath(hash_match.group(2), data_dir)] = hash_match.group(1)
+    return device_hashes
+
+
+def _iter_argument_batches(paths: list[str]) -> Iterator[list[str]]:
+    batch: list[str] = []
+    batch_length = 0
+    for path in paths:
+        if batch and batch_length + len(path) + 3 > _MAX_ARGUMENTS_LENGTH:
+            yield batch
+            batch, batch_length = [], 0
+        batch.append(path)
+        batch_length += len(path) + 3
+    if batch:
+        yield batch
+
+
+# Streams the files from the device with tar and stores them, yields the path, the SHA-256, and the size of each
+def _pull_files(data_dir: str, paths: list[str], objects_dir: Path) -> Iterator[tuple[str, str, int]]:
+    for batch in _iter_argument_batches(paths):
+        tar_cmd = f"tar -cf - -C {shlex.quote(data_dir)} {' '.join(shlex.quote(path) for path in batch)} 2>/dev/null"
+        with stream_adb_shell_command(get_file_related_shell_command(tar_cmd, data_dir)) as stream, \
+                tarfile.open(fileobj=stream, mode="r|") as tar_stream:
+            for member in tar_stream:
+                member_file = tar_stream.extractfile(member) if member.isfile() else None
+                if member_file is None:
+                    continue
+                sha256 = _store_object(member_file, objects_dir)
+                yield os.path.normpath(member.name), sha256, member.size
+
+
+def _store_object(source_file: BinaryIO, objects_dir: Path) -> str:
+    objects_dir.mkdir(parents=True, exist_ok=True)
+    sha256 = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=objects_dir, delete=False) as tmp_file:
+        while data := source_file.read(_COPY_BUFFER_SIZE):
+            sha256.update(data)
+            tmp_file.write(data)
+    object_path = _get_object_path(objects_dir, sha256.hexdigest())
+    object_path.parent.mkdir(exist_ok=True)
+    # The name is the hash of the contents, so, replacing an existing object does not change it
+    os.replace(tmp_file.name, object_path)
+    return sha256.hexdigest()
+
+
+def _delete_device_files(data_dir: str, paths: list[str]) -> None:
+    for batch in _iter_argument_batches(paths):
+        rm_cmd = f"rm -rf {' '.join(shlex.quote(f'{data_dir}/{path}') for path in batch)}"
+        return_code, _, stderr = execute_adb_shell_command2(
+            shlex.quote(get_file_related_shell_command(rm_cmd, data_dir)), ignore_stderr=True)
+        if return_code != 0:
+            print_error_and_exit(f"Failed to delete the files of {data_dir}: {stderr}")
+
+
+# Builds the tar on the fly, and extracts it on the device as it arrives
+def _push_entries(data_dir: str, entries: list[dict]) -> None:
+    objects_dir = _get_store_dir() / _OBJECTS_DIR_NAME
+    tar_cmd = get_file_related_shell_command(f"tar -xf - -C {shlex.quote(data_dir)}", data_dir)
+    # Files extracted as root get the SELinux context of the directory, and not the app's, this fixes them
+    restorecon_cmd = get_file_related_shell_command(f"restorecon -R {shlex.quote(data_dir)} 2>/dev/null", data_dir)
+    with start_adb_command(f"exec-in {shlex.quote(f'{tar_cmd} && {{ {restorecon_cmd}; true; }}')}",
+                           write_stdin=True) as process:
+        with contextlib.suppress(BrokenPipeError), tarfile.open(fileobj=process.stdin, mode="w|") as tar_stream:
+            for entry in entries:
+                tar_info = tarfile.TarInfo(entry["path"])
+                tar_info.mode = int(entry["mode"], 8)
+                tar_info.mtime = entry["mtime"]
+                tar_info.uname, tar_info.gname = entry["owner"], entry["group"]
+                if entry["type"] == "directory":
+                    tar_info.type = tarfile.DIRTYPE
+                    tar_stream.addfile(tar_info)
+                    continue
+                object_path = _get_object_path(objects_dir, entry["sha256"])
+                tar_info.size = object_path.stat().st_size
+                with object_path.open("rb") as object_file:
+                    tar_stream.addfile(tar_info, object_file)
+        with contextlib.suppress(BrokenPipeError):
+            process.stdin.close()
+        # communicate() can't be used since stdin is already closed
+        stdout, stderr = process.stdout.read(), process.stderr.read()
+        process.wait()
+    if process.returncode != 0:
+        print_error_and_exit(f"Failed to extract the snapshot to {data_dir}: "
+                             f"{(stdout + stderr).decode('utf-8', errors='replace').strip()}")
+
+
+def _write_json(file_path: Path, content: dict) -> None:
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    # Replaced atomically, so that an interrupted save does not corrupt an older snapshot of the same name
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=file_path.parent, delete=False) as tmp_file:
+        json.dump(content, tmp_file, indent=1)
+    os.replace(tmp_file.name, file_path)
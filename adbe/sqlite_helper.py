@@ -0,0 +1,153 @@
+import contextlib
+import csv
+import itertools
+import json
+import secrets
+import shlex
+import sqlite3
+import sys
+import tempfile
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+try:
+    from adbe import scratch_helper
+    from adbe.adb_helper import (
+        execute_adb_command2,
+        execute_adb_shell_command2,
+        get_file_access_prefixes,
+        stream_adb_shell_command,
+    )
+    from adbe.output_helper import print_error_and_exit, print_message, print_verbose
+except ImportError:
+    import scratch_helper
+    from adb_helper import (
+        execute_adb_command2,
+        execute_adb_shell_command2,
+        get_file_access_prefixes,
+        stream_adb_shell_command,
+    )
+    from output_helper import print_error_and_exit, print_message, print_verbose
+
+# The files which SQLite might not have merged into the database yet, "-shm" is only an index of the "-wal" file and
+# is rebuilt when the database is opened
+_DATABASE_COMPANION_SUFFIXES = ("-wal", "-journal")
+
+
+# Runs the SQL on an app's database and prints the result as CSV, or as JSON, one object per row.
+# The database is either a path on the device or the name of a database of the app, e.g. "notes.db".
+# The query runs on the device with sqlite3, so, only the result is transferred. Devices without sqlite3, e.g.
+# most production builds, get a copy of the database pulled and queried locally instead.
+def query_database(app_name: str, db_name: str, sql: str, *, json_output: bool = False) -> None:
+    db_path = db_name if db_name.startswith("/") else f"/data/data/{app_name}/databases/{db_name}"
+    access_prefix, has_sqlite3 = _get_database_access(db_path)
+    if access_prefix is None:
+        print_error_and_exit(f"Unable to read {db_path}, it must exist and the app must be debuggable or the device "
+                             "rooted")
+    if has_sqlite3:
+        print_verbose(f'Querying {db_path} on the device with "{access_prefix or "shell"}" access')
+        _query_on_device(db_path, access_prefix, sql, json_output=json_output)
+    else:
+        print_verbose(f"No sqlite3 on the device, querying a copy of {db_path}")
+        _query_copy(db_path, access_prefix, sql, json_output=json_output)
+
+
+# Returns the first access prefix, e.g. "run-as com.example", with which the database is readable, None if it is
+# not readable at all, and whether the device has sqlite3. Both are found in a single round trip.
+def _get_database_access(db_path: str) -> tuple[str | None, bool]:
+    access_prefixes = get_file_access_prefixes(db_path)
+    quoted_db_path = shlex.quote(db_path)
+    branches = [f"{access_prefix} test -r {quoted_db_path} 2>/dev/null; then echo {index:d}"
+                for index, access_prefix in enumerate(access_prefixes)]
+    access_cmd = f"if {'; elif '.join(branches)}; fi; command -v sqlite3 >/dev/null 2>&1 && echo sqlite3"
+    _, stdout, _ = execute_adb_shell_command2(shlex.quote(access_cmd), ignore_stderr=True)
+    lines = (stdout or "").split()
+    access_prefix = access_prefixes[int(lines[0])] if lines and lines[0].isdigit() else None
+    return access_prefix, "sqlite3" in lines
+
+
+def _query_on_device(db_path: str, access_prefix: str, sql: str, *, json_output: bool) -> None:
+    query_cmd = f"{access_prefix} sqlite3 -bail -csv -header {shlex.quote(db_path)} {shlex.quote(sql)}".strip()
+    # The rows are streamed as they are produced, and the errors, which would otherwise be mixed with them, are held
+    # back and sent after a line with the exit code, which no row can contain
+    status_marker = f"adbe-query-status-{secrets.token_hex(8)}"
+    shell_cmd = (f'{{ error=$({query_cmd} 2>&1 >&3); status=$?; }} 3>&1; echo "{status_marker} $status"; '
+                 'echo "$error"')
+    query_status: list[str] = []
+
+    def _iter_result_lines(stream: Iterable[bytes]) -> Iterator[str]:
+        for line in stream:
+            decoded_line = line.decode("utf-8", errors="replace")
+            if decoded_line.startswith(status_marker):
+                query_status.append(decoded_line[len(status_marker):].strip())
+                query_status.append(b"".join(stream).decode("utf-8", errors="replace").strip())
+                return
+            yield decoded_line
+
+    with stream_adb_shell_command(shell_cmd) as stream:
+        _print_rows(csv.reader(_iter_result_lines(stream)), json_output=json_output)
+    if not query_status:
+        print_error_and_exit(f"The query on {db_path} did not complete, is the device still connected?")
+    if query_status[0] != "0":
+        print_error_and_exit(f"Failed to query {db_path}: {query_status[1]}")
+
+
+# Copies the database and the changes which are not merged into it yet with a single command, so that the copies
+# are consistent with each other, pulls them, and runs the SQL locally. The device's database is never modified.
+def _query_copy(db_path: str, access_prefix: str, sql: str, *, json_output: bool) -> None:
+    tmp_db_path = scratch_helper.get_scratch_directory().new_file_path("database", "db")
+    quoted_db_path = shlex.quote(db_path)
+    quoted_tmp_db_path = shlex.quote(tmp_db_path)
+    # The copies are owned by the app with run-as, they must be readable by the shell to be pulled
+    copy_cmds = [f"{access_prefix} cp {quoted_db_path} {quoted_tmp_db_path}",
+                 f"{access_prefix} chmod 644 {quoted_tmp_db_path}"]
+    for suffix in _DATABASE_COMPANION_SUFFIXES:
+        quoted_suffix = shlex.quote(suffix)
+        copy_cmds.append(f"if {access_prefix} test -e {quoted_db_path}{quoted_suffix}; then "
+                         f"{access_prefix} cp {quoted_db_path}{quoted_suffix} {quoted_tmp_db_path}{quoted_suffix} && "
+                         f"{access_prefix} chmod 644 {quoted_tmp_db_path}{quoted_suffix} && echo {quoted_suffix}; fi")
+    return_code, stdout, stderr = execute_adb_shell_command2(shlex.quote(" && ".join(copy_cmds)))
+    if return_code != 0:
+        print_error_and_exit(f"Failed to copy {db_path}: {stderr}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # SQLite finds the companion files by the name of the database
+        local_db_path = Path(tmp_dir) / Path(db_path).name
+        for suffix in ["", *(stdout or "").split()]:
+            return_code, _, stderr = execute_adb_command2(f"pull {tmp_db_path}{suffix} {local_db_path}{suffix}")
+            if return_code != 0:
+                print_error_and_exit(f"Failed to pull {db_path}{suffix}: {stderr}")
+        try:
+            with contextlib.closing(sqlite3.connect(local_db_path)) as connection:
+                cursor = connection.execute(sql)
+                if cursor.description is None:
+                    return
+                header = [column[0] for column in cursor.description]
+                _print_rows(itertools.chain([header], ([_get_csv_value(value) for value in row] for row in cursor)),
+                            json_output=json_output)
+        except sqlite3.Error as e:
+            print_error_and_exit(f"Failed to query {db_path}: {e}")
+
+
+# The values are printed the way sqlite3 prints them in its CSV mode
+def _get_csv_value(value: str | float | bytes | None) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+# The first row is the header
+def _print_rows(rows: Iterator[list[str]], *, json_output: bool) -> None:
+    header = next(rows, None)
+    if header is None:
+        return
+    csv_writer = csv.writer(sys.stdout, lineterminator="\n")
+    if not json_output:
+        csv_writer.writerow(header)
+    for row in rows:
+        if json_output:
+            print_message(json.dumps(dict(zip(header, row)), ensure_ascii=False))
+        else:
+            csv_writer.writerow(row)
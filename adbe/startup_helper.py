@@ -0,0 +1,138 @@
+import dataclasses
+import re
+import shlex
+import statistics
+import time
+
+try:
+    from adbe.adb_helper import ShellSession, open_shell_session
+    from adbe.output_helper import print_error, print_error_and_exit, print_message
+except ImportError:
+    from adb_helper import ShellSession, open_shell_session
+    from output_helper import print_error, print_error_and_exit, print_message
+
+# cold: the app's process is started, warm: only the activity is created, hot: the activity is brought to the front
+STARTUP_MODES = ("cold", "warm", "hot")
+_KEYCODE_HOME = 3
+# Printed by "am start -W", LaunchState only on API 29 and above
+_STATUS_REGEX = re.compile(r"^Status: (\S+)", re.MULTILINE)
+_TOTAL_TIME_REGEX = re.compile(r"^TotalTime: (\d+)", re.MULTILINE)
+_WAIT_TIME_REGEX = re.compile(r"^WaitTime: (\d+)", re.MULTILINE)
+_LAUNCH_STATE_REGEX = re.compile(r"^LaunchState: (\S+)", re.MULTILINE)
+# Lets the app finish drawing, and the previous app settle, before the next step
+_SETTLE_SECONDS = 1.0
+# Tukey's fences, the runs this many interquartile ranges below the first or above the third quartile are outliers
+_OUTLIER_IQR_FACTOR = 1.5
+_MIN_RUNS_FOR_OUTLIER_REJECTION = 4
+
+
+@dataclasses.dataclass(frozen=True)
+class StartupTime:
+    # Until the first frame of the activity was drawn
+    total_time_ms: int
+    # Including the time the system took to start the launch
+    wait_time_ms: int | None
+    launch_state: str | None
+
+
+# Starts the app's launcher activity runs times, each time after bringing the app to the given mode, and returns
+# the startup times of the successful runs.
+# All the commands go through a single shell session, so that starting adb does not add noise to the measurements.
+def measure_startup(app_name: str, *, runs: int, mode: str, drop_caches: bool = False) -> list[StartupTime]:
+    if mode not in STARTUP_MODES:
+        print_error_and_exit(f'Unexpected startup mode "{mode}", expected one of {STARTUP_MODES}')
+    quoted_app_name = shlex.quote(app_name)
+    startup_times = []
+    with open_shell_session() as shell_session:
+        _, output = shell_session.run(
+            f"cmd package resolve-activity --brief -c android.intent.category.LAUNCHER {quoted_app_name}")
+        component = output.strip().splitlines()[-1] if output.strip() else ""
+        if "/" not in component:
+            print_error_and_exit(f"No launcher activity found for {app_name}: {output.strip()}")
+        start_cmd = f"am start -W {'--activity-clear-task ' if mode == 'warm' else ''}-n {shlex.quote(component)}"
+        if mode != "cold":
+            # The app has to be running for a warm or a hot start
+            shell_session.run(f"am start -W -n {shlex.quote(component)}")
+            time.sleep(_SETTLE_SECONDS)
+
+        for run in range(1, runs + 1):
+            if mode == "cold":
+                shell_session.run(f"am force-stop {quoted_app_name}")
+                if drop_caches:
+                    _drop_caches(shell_session)
+            else:
+                shell_session.run(f"input keyevent {_KEYCODE_HOME:d}")
+                time.sleep(_SETTLE_SECONDS)
+            _, output = shell_session.run(start_cmd)
+            startup_time = _parse_startup_time(output)
+            if startup_time is None:
+                print_error(f"Run {run:d}/{runs:d} of {app_name} failed: {output.strip()}")
+            else:
+                startup_times.append(startup_time)
+                _print_run(run, runs, mode, startup_time)
+            time.sleep(_SETTLE_SECONDS)
+    return startup_times
+
+
+# Prints the mean, the median, and the standard deviation of the startup times, without the outliers
+def print_startup_summary(app_name: str, mode: str, startup_times: list[StartupTime]) -> None:
+    kept_startup_times = _reject_outliers(startup_times)
+    rejected_count = len(startup_times) - len(kept_startup_times)
+    print_message(f"{mode.capitalize()} startup of {app_name}, {len(startup_times):d} "
+                  f"{'run' if len(startup_times) == 1 else 'runs'}, "
+                  f"{rejected_count:d} {'outlier' if rejected_count == 1 else 'outliers'} rejected")
+    print_message(f"TotalTime {_get_summary([startup_time.total_time_ms for startup_time in kept_startup_times])}")
+    wait_times_ms = [startup_time.wait_time_ms for startup_time in kept_startup_times
+                     if startup_time.wait_time_ms is not None]
+    if wait_times_ms:
+        print_message(f"WaitTime {_get_summary(wait_times_ms)}")
+
+
+# Page cache is dropped only with root, so that the APK and the app's files are read from the storage again
+def _drop_caches(shell_session: ShellSession) -> None:
+    return_code, output = shell_session.run("sync && su root sh -c 'echo 3 > /proc/sys/vm/drop_caches'")
+    if return_code != 0:
+        print_error_and_exit(f"Failed to drop the caches, the device must be rooted: {output.strip()}")
+
+
+# Returns None if the activity did not start
+def _parse_startup_time(output: str) -> StartupTime | None:
+    status_match = _STATUS_REGEX.search(output)
+    total_time_match = _TOTAL_TIME_REGEX.search(output)
+    if status_match is None or status_match.group(1) != "ok" or total_time_match is None:
+        return None
+    wait_time_match = _WAIT_TIME_REGEX.search(output)
+    launch_state_match = _LAUNCH_STATE_REGEX.search(output)
+    return StartupTime(
+        total_time_ms=int(total_time_match.group(1)),
+        wait_time_ms=int(wait_time_match.group(1)) if wait_time_match else None,
+        launch_state=launch_state_match.group(1) if launch_state_match else None)
+
+
+def _print_run(run: int, runs: int, mode: str, startup_time: StartupTime) -> None:
+    message = f"Run {run:d}/{runs:d}: TotalTime {startup_time.total_time_ms:d} ms"
+    if startup_time.wait_time_ms is not None:
+        message += f", WaitTime {startup_time.wait_time_ms:d} ms"
+    if startup_time.launch_state is not None:
+        message += f" ({startup_time.launch_state})"
+    print_message(message)
+    # e.g. the app's process survived "am force-stop" or the activity was never destroyed
+    if startup_time.launch_state is not None and startup_time.launch_state.lower() != mode:
+        print_error(f"Run {run:d} was a {startup_time.launch_state.lower()} start and not a {mode} one")
+
+
+# The outliers are found by the total time, a run is either kept or rejected as a whole
+def _reject_outliers(startup_times: list[StartupTime]) -> list[StartupTime]:
+    if len(startup_times) < _MIN_RUNS_FOR_OUTLIER_REJECTION:
+        return startup_times
+    first_quartile, _, third_quartile = statistics.quantiles(
+        [startup_time.total_time_ms for startup_time in startup_times], n=4, method="inclusive")
+    max_distance = _OUTLIER_IQR_FACTOR * (third_quartile - first_quartile)
+    return [startup_time for startup_time in startup_times
+            if first_quartile - max_distance <= startup_time.total_time_ms <= third_quartile + max_distance]
+
+
+def _get_summary(times_ms: list[int]) -> str:
+    standard_deviation = statistics.stdev(times_ms) if len(times_ms) > 1 else 0.0
+    return (f"mean: {statistics.mean(times_ms):.1f} ms, median: {statistics.median(times_ms):.1f} ms, "
+            f"stddev: {standard_deviation:.1f} ms")
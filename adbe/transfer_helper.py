@@ -0,0 +1,291 @@
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import shlex
+import shutil
+import time
+from pathlib import Path
+from typing import BinaryIO
+
+try:
+    from adbe.adb_helper import (
+        execute_adb_shell_command2,
+        get_device,
+        get_file_access_prefixes,
+        start_adb_command,
+        stream_adb_shell_command,
+    )
+    from adbe.output_helper import print_error, print_error_and_exit, print_verbose
+    from adbe.scratch_helper import SCRATCH_ROOT_DIR
+except ImportError:
+    from adb_helper import (
+        execute_adb_shell_command2,
+        get_device,
+        get_file_access_prefixes,
+        start_adb_command,
+        stream_adb_shell_command,
+    )
+    from output_helper import print_error, print_error_and_exit, print_verbose
+    from scratch_helper import SCRATCH_ROOT_DIR
+
+# Progress is recorded after every chunk, so, this is also the most that is transferred again after a disconnect.
+_CHUNK_SIZE = 8 * 1024 * 1024
+# Written next to the local file while a pull is in progress, it records how much of the file has been received.
+_PULL_PROGRESS_FILE_SUFFIX = ".adbe-partial"
+_LOCAL_IO_BUFFER_SIZE = 1024 * 1024
+_MAX_ATTEMPTS = 5
+_SECONDS_BETWEEN_ATTEMPTS = 2
+# Ordered by preference, older toybox versions only have md5sum.
+_HASH_TOOLS = {
+    "sha256sum": "sha256",
+    "sha1sum": "sha1",
+    "md5sum": "md5",
+}
+
+
+# Pulls a regular file in chunks, a re-run after an interruption continues from the last received chunk.
+# The transfer is verified by comparing a device-side hash with the hash of the local file.
+def pull_file_resumable(remote_file_path: str, local_file_path: str) -> None:
+    access_prefix, file_type, remote_size, remote_mtime = _stat_remote_file(remote_file_path)
+    if file_type != "regular file":
+        print_error_and_exit(f"Only regular files can be transferred in chunks, {remote_file_path} is a {file_type}")
+    local_path = Path(local_file_path)
+    progress_path = Path(f"{local_file_path}{_PULL_PROGRESS_FILE_SUFFIX}")
+    progress = {
+        "remote_file_path": remote_file_path,
+        "size": remote_size,
+        "mtime": remote_mtime,
+        "chunk_size": _CHUNK_SIZE,
+        "offset": 0,
+    }
+    offset = _read_pull_offset(progress_path, progress) if local_path.exists() else 0
+    if offset > 0:
+        print_verbose(f"Resuming pull of {remote_file_path} from byte {offset:d}/{remote_size:d}")
+    else:
+        # Create or truncate the local file
+        local_path.write_bytes(b"")
+
+    attempt = 1
+    while True:
+        offset = _pull_from_offset(access_prefix, local_path, offset, progress, progress_path)
+        if offset >= remote_size:
+            break
+        if attempt >= _MAX_ATTEMPTS:
+            print_error_and_exit(
+                f"Pull of {remote_file_path} was interrupted at byte {offset:d}/{remote_size:d}, "
+                "run the same command again to resume it")
+        print_error(f"Pull of {remote_file_path} was interrupted at byte {offset:d}/{remote_size:d}, retrying...")
+        attempt += 1
+        time.sleep(_SECONDS_BETWEEN_ATTEMPTS)
+
+    with local_path.open("r+b") as local_file:
+        local_file.truncate(remote_size)
+    # Either the transfer is verified or the progress is useless, so, always start afresh next time.
+    progress_path.unlink(missing_ok=True)
+    if not _verify_hash(access_prefix, remote_file_path, local_path):
+        print_error_and_exit(f"Pull of {remote_file_path} is corrupted, run the same command again to retry")
+
+
+# Pulls a regular file in a single stream, which is compressed on the wire if compression is enabled.
+# Returns false, without pulling anything, if the remote file is not a regular file.
+def pull_file_streamed(remote_file_path: str, local_file_path: str) -> bool:
+    access_prefix, file_type, remote_size, _ = _stat_remote_file(remote_file_path)
+    if file_type != "regular file":
+        return False
+
+    cat_cmd = f"{access_prefix} cat {shlex.quote(remote_file_path)} 2>/dev/null"
+    with Path(local_file_path).open("wb") as local_file, stream_adb_shell_command(cat_cmd) as stream:
+        try:
+            shutil.copyfileobj(stream, local_file, _LOCAL_IO_BUFFER_SIZE)
+        except EOFError:
+            # A compressed stream that was cut off
+            print_verbose(f"Stream of {remote_file_path} ended unexpectedly")
+        received_size = local_file.tell()
+    if received_size != remote_size:
+        print_error_and_exit(f"Pulled {received_size:d} bytes of {remote_file_path} instead of {remote_size:d} bytes")
+    return True
+
+
+# Pushes a regular file in chunks to a partial file in the scratch root directory and returns the path of that file
+# once its hash matches the local file. The partial file name depends only on the local file, so, a re-run continues
+# the interrupted upload.
+def push_file_resumable(local_file_path: str) -> str:
+    local_path = Path(local_file_path)
+    local_stat = local_path.stat()
+    local_size = local_stat.st_size
+    upload_key = hashlib.sha1(
+        f"{local_path.resolve()}:{local_size:d}:{local_stat.st_mtime_ns:d}".encode(), usedforsecurity=False).hexdigest()
+    # Not in the per-invocation scratch directory since it has to outlive the invocation to be resumed
+    partial_file_path = f"{SCRATCH_ROOT_DIR}/adbe-push-{upload_key[:16]}.partial"
+
+    attempt = 1
+    uploaded_size = _get_remote_file_size(partial_file_path)
+    while uploaded_size != local_size:
+        if attempt > _MAX_ATTEMPTS:
+            print_error_and_exit(
+                f"Push of {local_file_path} was interrupted at byte {uploaded_size:d}/{local_size:d}, "
+                "run the same command again to resume it")
+        if attempt > 1:
+            print_error(f"Push of {local_file_path} was interrupted at byte {uploaded_size:d}/{local_size:d}, retrying...")
+            time.sleep(_SECONDS_BETWEEN_ATTEMPTS)
+        # Only whole chunks are trusted, a partially written one is uploaded again.
+        offset = uploaded_size // _CHUNK_SIZE * _CHUNK_SIZE if 0 < uploaded_size < local_size else 0
+        if offset > 0:
+            print_verbose(f"Resuming push of {local_file_path} from byte {offset:d}/{local_size:d}")
+        _push_from_offset(local_path, partial_file_path, offset, local_size)
+        uploaded_size = _get_remote_file_size(partial_file_path)
+        attempt += 1
+
+    if not _verify_hash("", partial_file_path, local_path):
+        execute_adb_shell_command2(shlex.quote(f"rm -f {shlex.quote(partial_file_path)}"))
+        print_error_and_exit(f"Push of {local_file_path} is corrupted, run the same command again to retry")
+    return partial_file_path
+
+
+def _pull_from_offset(access_prefix: str, local_path: Path, offset: int, progress: dict, progress_path: Path) -> int:
+    remote_size = progress["size"]
+    dd_cmd = (f"{access_prefix} dd if={shlex.quote(progress['remote_file_path'])} bs={_CHUNK_SIZE:d} "
+              f"skip={offset // _CHUNK_SIZE:d} 2>/dev/null")
+    buffer = memoryview(bytearray(_CHUNK_SIZE))
+    with local_path.open("r+b") as local_file, stream_adb_shell_command(dd_cmd) as stream:
+        local_file.seek(offset)
+        while offset < remote_size:
+            expected_size = min(_CHUNK_SIZE, remote_size - offset)
+            received_size = _read_fully(stream, buffer[:expected_size])
+            local_file.write(buffer[:received_size])
+            if received_size < expected_size:
+                break
+            local_file.flush()
+            os.fsync(local_file.fileno())
+            offset += received_size
+            progress["offset"] = offset
+            _write_pull_progress(progress_path, progress)
+    return offset
+
+
+def _push_from_offset(local_path: Path, partial_file_path: str, offset: int, local_size: int) -> None:
+    if local_size == 0:
+        execute_adb_shell_command2(shlex.quote(f"mkdir -p {SCRATCH_ROOT_DIR} && touch {shlex.quote(partial_file_path)}"))
+        return
+
+    # Without notrunc, dd truncates the file at the seek offset, which is only fine when starting afresh.
+    conv = " conv=notrunc" if offset > 0 else ""
+    dd_cmd = (f"mkdir -p {SCRATCH_ROOT_DIR} && "
+              f"dd of={shlex.quote(partial_file_path)} bs={_CHUNK_SIZE:d} seek={offset // _CHUNK_SIZE:d}{conv} 2>/dev/null")
+    with local_path.open("rb") as local_file, \
+            mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file, \
+            memoryview(mapped_file) as local_data, \
+            start_adb_command(f"exec-in {shlex.quote(dd_cmd)}", write_stdin=True) as process:
+        try:
+            for start in range(offset, local_size, _CHUNK_SIZE):
+                with local_data[start:start + _CHUNK_SIZE] as chunk:
+                    process.stdin.write(chunk)
+            process.stdin.close()
+        except BrokenPipeError:
+            print_verbose(f"Connection closed while pushing {local_path}")
+            # The unsent data left in the buffer will fail to flush again
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+        process.wait()
+
+
+# Returns the first access prefix ("run-as <package>", "su root" or none) that can read the file along with the
+# file's type, size, and modification time.
+def _stat_remote_file(remote_file_path: str) -> tuple[str, str, int, int]:
+    for access_prefix in get_file_access_prefixes(remote_file_path):
+        stat_cmd = f"{access_prefix} stat -L -c '%F|%s|%Y' {shlex.quote(remote_file_path)}"
+        return_code, stdout, _ = execute_adb_shell_command2(shlex.quote(stat_cmd), ignore_stderr=True)
+        if return_code != 0 or not stdout or stdout.count("|") != 2:
+            continue
+        file_type, size, mtime = stdout.split("|")
+        return access_prefix, file_type, int(size), int(mtime)
+
+    print_error_and_exit(f"Unable to read {remote_file_path}")
+    return "", "", 0, 0
+
+
+# Returns -1 if the file does not exist
+def _get_remote_file_size(remote_file_path: str) -> int:
+    stat_cmd = f"stat -c %s {shlex.quote(remote_file_path)}"
+    return_code, stdout, _ = execute_adb_shell_command2(shlex.quote(stat_cmd), ignore_stderr=True)
+    if return_code != 0 or not stdout or not stdout.isdigit():
+        return -1
+    return int(stdout)
+
+
+def _read_pull_offset(progress_path: Path, expected_progress: dict) -> int:
+    try:
+        progress = json.loads(progress_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return 0
+
+    for key in ("remote_file_path", "size", "mtime", "chunk_size"):
+        if progress.get(key) != expected_progress[key]:
+            print_verbose(f"Previous pull of {expected_progress['remote_file_path']} does not match ({key}), starting afresh")
+            return 0
+    return int(progress.get("offset", 0))
+
+
+def _write_pull_progress(progress_path: Path, progress: dict) -> None:
+    tmp_progress_path = progress_path.with_name(f"{progress_path.name}.tmp")
+    tmp_progress_path.write_text(json.dumps(progress), encoding="utf-8")
+    tmp_progress_path.replace(progress_path)
+
+
+# Reads into the buffer until it is full or the stream ends, returns the number of bytes read.
+def _read_fully(stream: BinaryIO, buffer: memoryview) -> int:
+    total_read = 0
+    while total_read < len(buffer):
+        try:
+            num_read = stream.readinto(buffer[total_read:])
+        except EOFError:
+            # A compressed stream that was cut off
+            break
+        if not num_read:
+            break
+        total_read += num_read
+    return total_read
+
+
+# Returns true if the device-side hash of the remote file matches the hash of the local file.
+def _verify_hash(access_prefix: str, remote_file_path: str, local_path: Path) -> bool:
+    hash_tool = get_device().get_cached("hash_tool", _get_device_hash_tool)
+    if hash_tool is None:
+        print_error(f"No hash tool found on the device, {local_path} has not been verified")
+        return True
+
+    hash_cmd = f"{access_prefix} {hash_tool} {shlex.quote(remote_file_path)}"
+    return_code, stdout, stderr = execute_adb_shell_command2(shlex.quote(hash_cmd))
+    if return_code != 0 or not stdout:
+        print_error_and_exit(f"Failed to compute {hash_tool} of {remote_file_path}, stderr: {stderr}")
+    remote_digest = stdout.split()[0].lower()
+    local_digest = _hash_local_file(local_path, _HASH_TOOLS[hash_tool])
+    if remote_digest != local_digest:
+        print_error(f"{hash_tool} mismatch between {remote_file_path} ({remote_digest}) "
+                    f"and {local_path} ({local_digest})")
+        return False
+    print_verbose(f"Verified {hash_tool} of {remote_file_path}: {local_digest}")
+    return True
+
+
+def _hash_local_file(local_path: Path, algorithm: str) -> str:
+    digest = hashlib.new(algorithm)
+    with local_path.open("rb") as local_file:
+        if os.fstat(local_file.fileno()).st_size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file, \
+                memoryview(mapped_file) as local_data:
+            for start in range(0, len(local_data), _CHUNK_SIZE):
+                with local_data[start:start + _CHUNK_SIZE] as chunk:
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _get_device_hash_tool() -> str | None:
+    # "which" fails if any of the tools is missing but still prints the ones that it found
+    _, stdout, _ = execute_adb_shell_command2(f"which {' '.join(_HASH_TOOLS)}", ignore_stderr=True)
+    if not stdout:
+        return None
+    return stdout.split("\n")[0].split("/")[-1]
@@ -14,8 +14,6 @@ _TEST_PYPI_URL = 'https://test.pypi.org/legacy/'
 
 _PROJECT_NAME = 'adb-enhanced'
 _SRC_FILE_NAMES = [
-    'abe.jar',
-    'apksigner.jar',
     'adb_enhanced.py',
     'adb_helper.py',
     'asyncio_helper.py',
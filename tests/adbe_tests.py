@@ -1,9 +1,12 @@
 import functools
+import json
 import os
 import re
+import struct
 import subprocess
 import sys
 import time
+import zlib
 from collections.abc import Callable
 from pathlib import Path
 from typing import Any
@@ -191,11 +194,24 @@ def test_apps() -> None:
 
 def test_app_start_and_jank() -> None:
     _assert_success(f"start {_TEST_APP_ID}")
+    _assert_success(f"wait-for-activity {_TEST_APP_ID}/")
+    _assert_fail(f"wait-for-activity --timeout 1 {_TEST_NON_EXISTANT_APP_ID}/")
     # Jank requires app to be running.
     _assert_success(f"jank {_TEST_APP_ID}")
+    # The app only renders frames while something changes, so, it is scrolled while its frames are sampled
+    csv_file = "tmp_framestats.csv"
+    with subprocess.Popen("adb shell 'for i in 1 2 3 4 5; do input swipe 500 1200 500 400 200; done'",
+            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps:
+        stdout, _ = _assert_success(f"jank --framestats --duration 2 --csv {csv_file} {_TEST_APP_ID}")
+        ps.communicate()
+    assert "Frame time p50" in stdout, f"No frame time percentiles: {stdout}"
+    csv_header = Path(csv_file).read_text(encoding="utf-8").splitlines()[0].split(",")
+    assert "FrameDurationNs" in csv_header, f"Unexpected CSV header: {csv_header}"
+    _delete_local_file(csv_file)
     # Command should fail for non-existant app
     _assert_fail(f"start {_TEST_NON_EXISTANT_APP_ID}")
     _assert_fail(f"jank {_TEST_NON_EXISTANT_APP_ID}")
+    _assert_fail(f"jank --framestats --duration 1 {_TEST_NON_EXISTANT_APP_ID}")
 
 
 def test_app_stop() -> None:
@@ -234,9 +250,14 @@ def test_app_info_cmd() -> None:
 
 
 def test_app_signature_cmd() -> None:
-    _assert_success(f"app signature {_TEST_APP_ID}")
+    stdout, _ = _assert_success(f"app signature {_TEST_APP_ID}")
+    assert "Signer #1 certificate SHA-256 digest: " in stdout, f"No certificate digest printed: {stdout}"
     # Command should fail for non-existant app
     _assert_fail(f"app signature {_TEST_NON_EXISTANT_APP_ID}")
+    # A local APK file is read directly
+    stdout, _ = _assert_success("app signature ./tests/net.ashishb.deviceinformationhelper_debug_app.apk")
+    assert "certificate DN: C=US, O=Android, CN=Android Debug" in stdout, f"Unexpected signer: {stdout}"
+    _assert_fail("app signature ./tests/adbe_tests.py")
 
 
 def test_app_path_cmd() -> None:
@@ -300,6 +321,89 @@ def test_file_move1() -> None:
     _delete_local_file("tmp_file2")
 
 
+def test_file_push_pull_resume() -> None:
+    local_file1 = "tmp_resume_file1"
+    local_file2 = "tmp_resume_file2"
+    remote_file = "/data/local/tmp/tmp_resume_file"
+    Path(local_file1).write_bytes(os.urandom(3 * 1024 * 1024 + 7))
+
+    _assert_success(f"push --resume {local_file1} {remote_file}")
+    _assert_success(f"pull --resume {remote_file} {local_file2}")
+    assert Path(local_file1).read_bytes() == Path(local_file2).read_bytes(), "Pulled file differs from pushed file"
+    assert not Path(f"{local_file2}.adbe-partial").exists(), "Progress file was not deleted after the pull"
+    # Cleanup
+    _assert_success(f"rm {remote_file}")
+    _delete_local_file(local_file1)
+    _delete_local_file(local_file2)
+
+
+def test_cat() -> None:
+    local_file = "tmp_cat_file"
+    remote_file = "/data/local/tmp/tmp_cat_file"
+    # Binary data with line endings which must survive the round trip unchanged
+    data = b"line1\r\nline2\n\x00\xff" * 1000
+    Path(local_file).write_bytes(data)
+    _assert_success(f"push {local_file} {remote_file}")
+
+    exit_code, stdout_data, stderr_data = _execute_binary(f"cat {remote_file}")
+    assert exit_code == 0 and stdout_data == data, f"cat returned different data, stderr: {stderr_data}"
+    _, stdout_data, _ = _execute_binary(f"cat --range 7-11 {remote_file}")
+    assert stdout_data == data[7:12]
+    _, stdout_data, _ = _execute_binary(f"cat --tail 9 {remote_file}")
+    assert stdout_data == data[-9:]
+    _assert_fail("cat /data/local/tmp/nonexistent_file")
+    # Exists, but can't be read
+    _assert_fail("cat /data/local/tmp")
+    # Cleanup
+    _assert_success(f"rm {remote_file}")
+    _delete_local_file(local_file)
+
+
+def test_compression() -> None:
+    # Compression is enabled only for TCP/IP devices by default, force it on for the tests
+    _assert_success("--compression on apps list all")
+    _assert_success("--compression on ls -l /data/local/tmp")
+    _assert_success("--compression off ls -l /data/local/tmp")
+    _assert_fail("--compression sometimes ls -l /data/local/tmp")
+
+
+def test_tmp_gc() -> None:
+    stale_dir = "/data/local/tmp/adbe-scratch/0-0-stale"
+    stale_dir_creation_cmd = f"adb shell 'mkdir -p {stale_dir} && touch -t 200001010000 {stale_dir}'"
+    with subprocess.Popen(stale_dir_creation_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps:
+        stdout, stderr = ps.communicate()
+        assert ps.returncode == 0, f'Dir creation failed with stdout: "{stdout}" and stderr: "{stderr}"'
+
+    stdout, _ = _assert_success("tmp gc --max-age 1")
+    assert stale_dir in stdout, f"Stale scratch directory was not removed: {stdout}"
+    _assert_success("tmp gc")
+
+
+def test_install() -> None:
+    _assert_fail("install ./tests/nonexistent.apk")
+    _assert_fail("install --max-bandwidth 10 ./tests/net.ashishb.deviceinformationhelper_debug_app.apk "
+                 "./tests/nonexistent.apk")
+    _assert_fail("install --skip-identical ./tests/nonexistent.apk")
+    # A test-only APK, it is installed with -t
+    _assert_success("install ./tests/net.ashishb.deviceinformationhelper_debug_app.apk")
+
+
+def test_install_skip_identical() -> None:
+    apk_path = "./tests/net.ashishb.deviceinformationhelper_debug_app.apk"
+    _assert_success(f"install --skip-identical {apk_path}")
+    stdout, _ = _assert_success(f"install --skip-identical {apk_path}")
+    assert "Skipped" in stdout, f"Identical build was installed again: {stdout}"
+    # The update time, by which another install is detected, has a resolution of a second
+    time.sleep(1)
+    # Installed without adbe, so, adbe can't know that the same build is on the device
+    with subprocess.Popen(f"adb install -r -t {apk_path}",
+            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps:
+        stdout, stderr = ps.communicate()
+        assert ps.returncode == 0, f'Install failed with stdout: "{stdout}" and stderr: "{stderr}"'
+    stdout, _ = _assert_success(f"install --skip-identical {apk_path}")
+    assert "Skipped" not in stdout, f"Build was not installed again after another install: {stdout}"
+
+
 @run_once
 def _install_debug_apk() -> None:
     with subprocess.Popen("adb install -t -r ./tests/net.ashishb.deviceinformationhelper_debug_app.apk",
@@ -328,6 +432,47 @@ def test_file_move2() -> None:
         assert ps2.returncode == 0, "Failed to deleted pulled file development.xml"
 
 
+def test_app_snapshot() -> None:
+    _install_debug_apk()
+    _assert_success(f"app snapshot save {_DEBUG_APP} adbe-test")
+    stdout, _ = _assert_success(f"app snapshot save {_DEBUG_APP} adbe-test")
+    assert "transferred 0 files" in stdout, f"Unchanged files were transferred again: {stdout}"
+    _assert_success(f"clear-data {_DEBUG_APP}")
+    _assert_success(f"app snapshot restore {_DEBUG_APP} adbe-test")
+    _assert_fail(f"app snapshot restore {_DEBUG_APP} nonexistent-snapshot")
+    _assert_fail(f"app snapshot save {_TEST_NON_EXISTANT_APP_ID} adbe-test")
+
+
+def test_app_startup() -> None:
+    _install_debug_apk()
+    stdout, _ = _assert_success(f"startup --runs 2 {_DEBUG_APP}")
+    assert "TotalTime mean: " in stdout, f"No startup summary in {stdout}"
+    _assert_success(f"startup --runs 2 --mode hot {_DEBUG_APP}")
+    _assert_fail(f"startup --runs 2 --mode lukewarm {_DEBUG_APP}")
+    _assert_fail(f"startup --runs 2 {_TEST_NON_EXISTANT_APP_ID}")
+
+
+def test_meminfo() -> None:
+    _assert_success(f"start {_TEST_APP_ID}")
+    stdout, _ = _assert_success(f"meminfo --duration 2 --period 1 {_TEST_APP_ID}")
+    assert "Total PSS: " in stdout, f"No memory usage summary in {stdout}"
+    stdout, _ = _assert_success(f"meminfo --json --duration 1 --period 1 {_TEST_APP_ID}")
+    assert stdout.startswith('{"elapsed_seconds": '), f"Not a JSON object per sample: {stdout}"
+    _assert_fail(f"meminfo --period 0 {_TEST_APP_ID}")
+    _assert_fail(f"meminfo {_TEST_NON_EXISTANT_APP_ID}")
+
+
+def test_db_query() -> None:
+    stdout, _ = _assert_success('db query com.android.providers.contacts contacts2.db '
+                                '"SELECT count(*) AS table_count FROM sqlite_master WHERE type = \'table\'"')
+    assert stdout.startswith("table_count\n"), f"No CSV header in {stdout}"
+    stdout, _ = _assert_success('db query --json com.android.providers.contacts contacts2.db '
+                                '"SELECT name FROM sqlite_master LIMIT 1"')
+    assert stdout.startswith('{"name": '), f"Not a JSON object per row: {stdout}"
+    _assert_fail('db query com.android.providers.contacts contacts2.db "SELECT * FROM nonexistent_table"')
+    _assert_fail(f'db query {_DEBUG_APP} nonexistent.db "SELECT 1"')
+
+
 def test_file_move3() -> None:
     _install_debug_apk()
     tmp_file1 = "/data/local/tmp/development2.xml"
@@ -345,8 +490,60 @@ def test_file_move3() -> None:
         assert ps2.returncode == 0, "Failed to deleted pulled file development.xml"
 
 
+def test_serial_option() -> None:
+    serial = subprocess.run("adb get-serialno", shell=True, capture_output=True, text=True, check=True).stdout.strip()
+    _assert_success(f"-s {serial} ls /data/local/tmp")
+    # The serial used to be ignored
+    _assert_fail("-s nonexistent-serial ls /data/local/tmp")
+
+
+def test_all_devices() -> None:
+    stdout, _ = _assert_success("--all-devices --fan-out-json ls /data/local/tmp")
+    results = [json.loads(line) for line in stdout.splitlines()]
+    assert results, "No per-device results"
+    for result in results:
+        assert result["exit_code"] == 0, f"Failed on {result['serial']}: {result['output']}"
+        stdout, _ = _assert_success(f"-s {result['serial']} ls /data/local/tmp")
+        assert result["output"] == stdout.rstrip("\n"), f"Unexpected output on {result['serial']}"
+    # The command's own "--json" is passed on to every device
+    stdout, _ = _assert_success("--all-devices --fan-out-json ls --json --max-depth 1 /data/local/tmp")
+    for result in [json.loads(line) for line in stdout.splitlines()]:
+        assert result["exit_code"] == 0, f"Failed on {result['serial']}: {result['output']}"
+        entries = [json.loads(line) for line in result["output"].splitlines()]
+        assert entries, f"No files listed on {result['serial']}"
+    _assert_fail(f"--all-devices --fan-out-json start {_TEST_NON_EXISTANT_APP_ID}")
+    _assert_fail("--all-devices -e ls /data/local/tmp")
+    _assert_fail("--fan-out-json ls /data/local/tmp")
+
+
+def test_farm_run() -> None:
+    jobs_file = "tmp_farm_jobs.json"
+    Path(jobs_file).write_text(json.dumps({"jobs": [
+        {"name": "list", "adbe": "ls /data/local/tmp", "all_devices": True, "priority": 1},
+        {"name": "echo", "shell": "echo farm"},
+    ]}), encoding="utf-8")
+    stdout, _ = _assert_success(f"--json farm run {jobs_file}")
+    results = [json.loads(line) for line in stdout.splitlines() if line.startswith("{")]
+    assert results, "No per-job results"
+    for result in results:
+        assert result["status"] == "passed", f"{result['name']} failed on {result['serial']}: {result['output']}"
+
+    Path(jobs_file).write_text(json.dumps({"jobs": [{"shell": "ls /data/local/tmp/nonexistent_dir"}]}),
+                               encoding="utf-8")
+    _assert_fail(f"farm run {jobs_file}")
+    # Cleanup
+    _delete_local_file(jobs_file)
+
+
 def test_list_devices() -> None:
-    _assert_success("devices")
+    stdout, _ = _assert_success("devices")
+    assert "Serial ID: " in stdout, f"No devices listed: {stdout}"
+    stdout, _ = _assert_success("devices --json")
+    device_summaries = [json.loads(line) for line in stdout.splitlines()]
+    assert device_summaries, "No devices listed"
+    for device_summary in device_summaries:
+        assert device_summary["sdk"], f"No SDK version of {device_summary['serial']}"
+        assert device_summary["transport"] in ("usb", "tcpip", "emulator"), device_summary
 
 
 def test_list_top_activity() -> None:
@@ -363,8 +560,48 @@ def test_dump_ui() -> None:
 def test_take_screenshot() -> None:
     png_file = "tmp1.png"
     _assert_success(f"screenshot {png_file} -v")
+    assert Path(png_file).read_bytes().startswith(b"\x89PNG"), "Screenshot is not a PNG file"
+    _assert_success(f"screenshot --burst 3 --interval 100 {png_file}")
+    burst_files = [f"tmp1-{index:04d}.png" for index in range(1, 4)]
+    for burst_file in burst_files:
+        assert Path(burst_file).read_bytes().startswith(b"\x89PNG"), f"{burst_file} is not a PNG file"
+    _assert_success(f"screenshot --raw --downscale 2 {png_file}")
+    assert Path(png_file).read_bytes().startswith(b"\x89PNG"), "Raw screenshot is not a PNG file"
     # Cleanup
     _delete_local_file(png_file)
+    for burst_file in burst_files:
+        _delete_local_file(burst_file)
+
+
+def test_screenshot_diff() -> None:
+    numpy = pytest.importorskip("numpy")
+    png_file = "tmp_baseline.png"
+    modified_png_file = "tmp_modified_baseline.png"
+    diff_file = "tmp_diff.png"
+    _assert_success(f"screenshot --raw {png_file}")
+    # Every color channel of the top 100 rows is changed by 128
+    data = Path(png_file).read_bytes()
+    width, height = struct.unpack(">II", data[16:24])
+    idat_length, = struct.unpack(">I", data[33:37])
+    rows = numpy.frombuffer(zlib.decompress(data[41:41 + idat_length]), dtype=numpy.uint8).reshape(height, -1).copy()
+    rows[:100, 1:] += numpy.tile(numpy.array([128, 128, 128, 0], dtype=numpy.uint8), width)
+    modified_idat = zlib.compress(rows.tobytes())
+    Path(modified_png_file).write_bytes(b"".join((
+        data[:33], struct.pack(">I", len(modified_idat)), b"IDAT", modified_idat,
+        struct.pack(">I", zlib.crc32(b"IDAT" + modified_idat)), data[45 + idat_length:])))
+
+    stdout, _ = _assert_fail(f"screenshot diff --tolerance 10 --diff-output {diff_file} {modified_png_file}")
+    different_pixel_count = int(re.sub(r"\x1b\[\d+m", "", stdout).split()[0])
+    assert different_pixel_count >= width * 100, f"Only {different_pixel_count:d} pixels differ"
+    assert Path(diff_file).read_bytes().startswith(b"\x89PNG"), "Diff image is not a PNG file"
+    # The modified rows and the status bar, whose clock might change in between, are ignored
+    stdout, _ = _assert_success(f"screenshot diff --ignore 0,0,{width:d},200 {modified_png_file}")
+    assert stdout.startswith(f"0 of {width * (height - 200):d} compared pixels"), stdout
+    _assert_fail("screenshot diff nonexistent_baseline.png")
+    # Cleanup
+    _delete_local_file(png_file)
+    _delete_local_file(modified_png_file)
+    _delete_local_file(diff_file)
 
 
 def test_keep_activities() -> None:
@@ -376,6 +613,11 @@ def test_keep_activities() -> None:
 
 def test_ls() -> None:
     _assert_success("ls -l -R /data/local/tmp")
+    stdout, _ = _assert_success("ls --json -R --name '*.tmp' --min-size 1 /data/local/tmp")
+    for line in stdout.splitlines():
+        entry = json.loads(line)
+        assert entry["path"].endswith(".tmp") and entry["size"] >= 1, f"Unexpected entry {entry}"
+    _assert_fail("ls --json /data/local/tmp/nonexistent_dir")
 
 
 def test_stay_awake_while_charging() -> None:
@@ -466,6 +708,21 @@ def _execute(sub_cmd: str) -> tuple[int, str, str]:
     return exit_code, stdout_data, stderr_data
 
 
+def _execute_binary(sub_cmd: str) -> tuple[int, bytes, str]:
+    print(f"Executing cmd: {sub_cmd}")
+    if _TEST_PYTHON_INSTALLATION:
+        cmd = "adbe"
+    else:
+        dir_of_this_script = os.path.split(__file__)[0]
+        adbe_py = Path(dir_of_this_script) / "../adbe/main.py"
+        cmd = f"{_PYTHON_CMD} {adbe_py}"
+    with subprocess.Popen(f"{cmd} {sub_cmd}",
+            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps:
+        stdout_data, stderr_data = ps.communicate()
+        exit_code = ps.returncode
+    return exit_code, stdout_data, stderr_data.decode("utf-8").strip()
+
+
 def _delete_local_file(local_file_path: str) -> None:
     cmd = f"rm {local_file_path}"
     with subprocess.Popen(cmd,
@@ -500,6 +757,10 @@ def main() -> None:
     test_app_info_cmd()
     test_app_signature_cmd()
     test_app_path_cmd()
+    test_app_snapshot()
+    test_app_startup()
+    test_db_query()
+    test_meminfo()
 
     # does not work on CircleCI or Travis CI
     # test_app_backup_command()
@@ -507,10 +768,20 @@ def main() -> None:
     test_file_delete()
     test_file_move1()
     test_file_move2()
+    test_file_push_pull_resume()
+    test_cat()
+    test_compression()
+    test_tmp_gc()
+    test_install()
+    test_install_skip_identical()
     test_list_devices()
+    test_serial_option()
+    test_all_devices()
+    test_farm_run()
     test_list_top_activity()
     test_dump_ui()
     test_take_screenshot()
+    test_screenshot_diff()
     test_keep_activities()
     test_ls()
     test_stay_awake_while_charging()